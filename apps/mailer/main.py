@@ -3,6 +3,7 @@
 import os
 import sys
 import logging
+import logging.handlers
 import traceback
 
 ROOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
@@ -15,7 +16,8 @@ DEFAULT_TEMPLATE_PATH = os.path.abspath(
         "templates/"))
 
 import time
-from util import send_email
+from outbox import Outbox, OutboxWorkerPool, MailerMetrics
+from providers import MandrillProvider, MailChimpProvider, SmtpProvider, StubProvider
 
 from tornado.options import define, options
 import tornado
@@ -27,39 +29,34 @@ define("mailchimp_apikey", help="mailchimp api key")
 define("mailchimp_newsletter_list_id", help="mailchimp newsletter list id")
 define("mandrill_apikey", help="mandrill api key")
 define("mailer_log",default=os.path.join(ROOT_PATH,"logs/","mailer.log"),help="logging")
+define("mailer_provider", default="mandrill", help="mandrill sends through Mandrill, MailChimp and SMTP. stub only logs the emails")
+define("mailer_outbox", default=os.path.join(ROOT_PATH,"db/","mailer_outbox.sqlite"), help="sqlite file of the outbox of emails waiting to be sent")
+define("mailer_workers", type=int, default=4, help="Number of threads sending emails")
+define("mailer_batch_size", type=int, default=50, help="Maximum number of emails sent to a provider at once")
+define("mailer_max_attempts", type=int, default=8, help="Attempts to send an email before giving up")
+define("mailer_retry_backoff", type=float, default=2., help="Seconds before the first retry of an email, doubled on each retry")
+define("mailer_provider_concurrency", type=dict, default={"mandrill": 2, "mailchimp": 1, "smtp": 1}, help="Maximum number of concurrent requests per provider")
+define("mailer_outbox_retention", type=int, default=86400, help="Seconds the emails already sent are kept in the outbox")
+define("mailer_metrics_interval", type=int, default=60, help="Seconds between the metrics reports")
+define("mailer_metrics_file", help="File where the last metrics report is written")
 define("config", default=os.path.join(ROOT_PATH, "config/", "mailer.conf"), help="config file", callback=lambda path: tornado.options.parse_config_file(path, final=False))
 
 import json
 import zmq
-import mailchimp
-import mandrill
 
 def main():
     tornado.options.parse_command_line()
     if not options.trade_pub or\
-       not options.mailchimp_apikey or\
-       not options.mailchimp_newsletter_list_id or\
-       not options.mandrill_apikey or\
        not options.mailer_log :
       tornado.options.print_help()
       return
 
-    mailchimp_api =  mailchimp.Mailchimp(options.mailchimp_apikey)
-    try:
-        mailchimp_api.helper.ping()
-    except mailchimp.Error:
-        print "Invalid MailChimp API key"
-        return
-
-    mandrill_api = mandrill.Mandrill(options.mandrill_apikey)
-    try:
-        mandrill_api.users.ping()
-    except mandrill.Error:
-        print "Invalid Mandrill API key"
-        return
-
-    print mandrill_api.users.senders()
-
+    if options.mailer_provider != 'stub' and\
+       (not options.mailchimp_apikey or\
+        not options.mailchimp_newsletter_list_id or\
+        not options.mandrill_apikey):
+      tornado.options.print_help()
+      return
 
     input_log_file_handler = logging.handlers.TimedRotatingFileHandler(
         options.mailer_log,
@@ -80,100 +77,130 @@ def main():
     log('PARAM', 'BEGIN')
     log('PARAM', 'trade_pub', options.trade_pub)
     log('PARAM', 'mailer_log', options.mailer_log)
+    log('PARAM', 'mailer_provider', options.mailer_provider)
+    log('PARAM', 'mailer_outbox', options.mailer_outbox)
+    log('PARAM', 'mailer_workers', options.mailer_workers)
     log('PARAM', 'END')
 
+    if options.mailer_provider == 'stub':
+        providers = {
+            'mandrill': StubProvider('mandrill', log),
+            'mailchimp': StubProvider('mailchimp', log),
+            'smtp': StubProvider('smtp', log)
+        }
+    else:
+        try:
+            mailchimp_provider = MailChimpProvider(options.mailchimp_apikey, options.mailchimp_newsletter_list_id)
+        except Exception:
+            print "Invalid MailChimp API key"
+            return
+
+        try:
+            mandrill_provider = MandrillProvider(options.mandrill_apikey)
+        except Exception:
+            print "Invalid Mandrill API key"
+            return
+
+        providers = {
+            'mandrill': mandrill_provider,
+            'mailchimp': mailchimp_provider,
+            'smtp': SmtpProvider()
+        }
+
+    outbox = Outbox(options.mailer_outbox)
+    metrics = MailerMetrics()
+    worker_pool = OutboxWorkerPool(outbox, providers, log, metrics,
+                                   workers=options.mailer_workers,
+                                   batch_size=options.mailer_batch_size,
+                                   max_attempts=options.mailer_max_attempts,
+                                   retry_backoff=options.mailer_retry_backoff,
+                                   provider_concurrency=options.mailer_provider_concurrency)
+    worker_pool.start()
+
+    def report_metrics():
+        report = json.dumps(metrics.report(outbox))
+        log('INFO', 'METRICS', report)
+        if options.mailer_metrics_file:
+            with open(options.mailer_metrics_file, 'w') as metrics_file:
+                metrics_file.write(report)
+
     context = zmq.Context()
     socket = context.socket(zmq.SUB)
     socket.connect(options.trade_pub)
     socket.setsockopt(zmq.SUBSCRIBE, "EMAIL")
 
+    next_metrics_time = time.time() + options.mailer_metrics_interval
     while True:
         try:
-            raw_email_message = socket.recv()
-            log('IN', 'TRADE_IN_PUB', raw_email_message)
-
-            msg = JsonMessage(raw_email_message)
-
-            if not msg.isEmail():
-                log('ERROR',
-                    'EXCEPTION',
-                    'Received message is not an email message')
-                continue
-
-            try:
-                sender = u'BitEx Support <suporte@bitex.com.br>'
-                body = ""
-                msg_to = msg.get('To')
-                subject = msg.get('Subject')
-                language = msg.get('Language')
-                content_type = 'plain'
-
-                if msg.has('Template') and msg.get('Template'):
-                    params = {}
-                    if msg.has('Params') and msg.get('Params'):
-                        params = json.loads(msg.get('Params'))
-
-                    template_name = msg.get('Template')
-
-
-                    if template_name  == 'welcome':
-                      # user signup .... let's register him on mailchimp newsletter
-                      try:
-                        mailchimp_api.lists.subscribe(
-                            id = options.mailchimp_newsletter_list_id ,
-                            email = {'email': params['email'] },
-                            merge_vars = {'EMAIL' : params['email'], 'FNAME': params['username'] } )
-
-                      except mailchimp.ListAlreadySubscribedError:
-                        log('ERROR', 'EXCEPTION', params['email'] + ' mailchimp.ListAlreadySubscribedError' )
-                      except mailchimp.Error, e:
-                        log('ERROR', 'EXCEPTION', str(e))
-
-
-                    template_content = []
-                    for k,v in params.iteritems():
-                      template_content.append( { 'name': k, 'content': v  } )
-
-                    message = {
-                      'to': [ {'email': msg_to, 'name': params['username'],'type': 'to' }  ],
-                      'metadata': {'website': 'www.bitex.com.br'},
-                      'global_merge_vars': template_content
-                    }
-
-                    result = mandrill_api.messages.send_template(
-                      template_name= (template_name + '-' + language).lower(),
-                      template_content=template_content,
-                      message=message)
-
-                    log('INFO', 'SUCCESS', str(result))
-                    continue
-
-                elif msg.has('RawData') and msg.get('RawData'):
-                    body = msg.get('RawData')
-
-                log('IN', 'LOGINDEBUG START', "")
-                log('DEBUG',
-                    'EMAIL',
-                    u'{"Sender":"%s","To":"%s","Subject":"%s", "Body":"%s" }' % (sender,
-                                                                                 msg_to,
-                                                                                 subject,
-                                                                                 body))
-                log('IN', 'LOGINDEBUG END', "")
-                send_email(sender, msg_to, subject, body, content_type)
-                log('IN', 'SENT', "")
-
-                log('INFO', 'SUCCESS', msg.get('EmailThreadID'))
-            except Exception as ex:
-                traceback.print_exc()
-                log('ERROR', 'EXCEPTION', str(ex))
-                time.sleep(1)
+            # this loop only writes the emails to the outbox, the worker pool sends them.
+            if socket.poll(max(0, next_metrics_time - time.time()) * 1000):
+                frames = socket.recv_multipart()
+                for raw_email_message in frames[1:]:
+                    log('IN', 'TRADE_IN_PUB', raw_email_message)
+                    enqueue_email(outbox, log, raw_email_message)
+                    metrics.increment('received')
+                worker_pool.notify()
+
+            if time.time() >= next_metrics_time:
+                report_metrics()
+                outbox.purge(options.mailer_outbox_retention)
+                next_metrics_time = time.time() + options.mailer_metrics_interval
 
         except KeyboardInterrupt:
             mail_logger.info('END')
             break
 
         except Exception as ex:
+            traceback.print_exc()
+            log('ERROR', 'EXCEPTION', str(ex))
             time.sleep(1)
 
+def enqueue_email(outbox, log, raw_email_message):
+    msg = JsonMessage(raw_email_message)
+
+    if not msg.isEmail():
+        log('ERROR',
+            'EXCEPTION',
+            'Received message is not an email message')
+        return
+
+    msg_to = msg.get('To')
+    subject = msg.get('Subject')
+    language = msg.get('Language')
+
+    if msg.has('Template') and msg.get('Template'):
+        params = {}
+        if msg.has('Params') and msg.get('Params'):
+            params = json.loads(msg.get('Params'))
+
+        template_name = msg.get('Template')
+
+        if template_name  == 'welcome':
+          # user signup .... let's register him on mailchimp newsletter
+          outbox.enqueue('mailchimp', {'email': params['email'], 'username': params['username']})
+
+        outbox.enqueue('mandrill', {
+            'thread_id': msg.get('EmailThreadID'),
+            'to': msg_to,
+            'subject': subject,
+            'template': template_name,
+            'language': language,
+            'params': params
+        })
+        return
+
+    body = ""
+    if msg.has('RawData') and msg.get('RawData'):
+        body = msg.get('RawData')
+
+    outbox.enqueue('smtp', {
+        'thread_id': msg.get('EmailThreadID'),
+        'sender': u'BitEx Support <suporte@bitex.com.br>',
+        'to': msg_to,
+        'subject': subject,
+        'body': body,
+        'content_type': 'plain'
+    })
+
 if __name__ == '__main__':
     main()
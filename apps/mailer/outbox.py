@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import sqlite3
+import threading
+
+PENDING = 'P'
+SENDING = 'S'
+SENT    = 'D'
+FAILED  = 'F'
+
+
+class PermanentError(str):
+    """Error of a message that would fail again if retried, e.g. a recipient rejected by the provider"""
+
+
+class Outbox(object):
+    """Durable local spool of the emails waiting to be sent.
+
+    Every message received from the trade engine is written here before anything else is done with it, so a
+    slow provider never backs up the zmq subscription and a restart does not lose the emails not yet sent.
+    """
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            '  id           INTEGER PRIMARY KEY AUTOINCREMENT,'
+            '  provider     TEXT    NOT NULL,'
+            '  payload      TEXT    NOT NULL,'
+            '  status       TEXT    NOT NULL,'
+            '  attempts     INTEGER NOT NULL DEFAULT 0,'
+            '  next_attempt REAL    NOT NULL,'
+            '  created      REAL    NOT NULL,'
+            '  last_error   TEXT)')
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS idx_outbox_provider_status_next_attempt'
+            '  ON outbox (provider, status, next_attempt)')
+
+        # messages that were being sent when the mailer stopped go out again
+        self.connection.execute('UPDATE outbox SET status = ? WHERE status = ?', (PENDING, SENDING))
+
+    def enqueue(self, provider, payload):
+        now = time.time()
+        with self.lock:
+            cursor = self.connection.execute(
+                'INSERT INTO outbox (provider, payload, status, next_attempt, created) VALUES (?, ?, ?, ?, ?)',
+                (provider, json.dumps(payload), PENDING, now, now))
+            return cursor.lastrowid
+
+    def claim(self, provider, limit):
+        """Marks up to limit due messages of the provider as being sent and returns them"""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT id, payload, attempts, created FROM outbox'
+                ' WHERE provider = ? AND status = ? AND next_attempt <= ?'
+                ' ORDER BY next_attempt, id LIMIT ?',
+                (provider, PENDING, time.time(), limit)).fetchall()
+            if not rows:
+                return []
+
+            self.connection.executemany('UPDATE outbox SET status = ? WHERE id = ?',
+                                        [(SENDING, row[0]) for row in rows])
+
+        jobs = []
+        for job_id, payload, attempts, created in rows:
+            job = json.loads(payload)
+            job['id'] = job_id
+            job['attempts'] = attempts
+            job['created'] = created
+            jobs.append(job)
+        return jobs
+
+    def complete(self, job_id):
+        with self.lock:
+            self.connection.execute('UPDATE outbox SET status = ?, attempts = attempts + 1 WHERE id = ?',
+                                    (SENT, job_id))
+
+    def retry(self, job_id, next_attempt, error):
+        with self.lock:
+            self.connection.execute(
+                'UPDATE outbox SET status = ?, attempts = attempts + 1, next_attempt = ?, last_error = ? WHERE id = ?',
+                (PENDING, next_attempt, error, job_id))
+
+    def fail(self, job_id, error):
+        with self.lock:
+            self.connection.execute(
+                'UPDATE outbox SET status = ?, attempts = attempts + 1, last_error = ? WHERE id = ?',
+                (FAILED, error, job_id))
+
+    def purge(self, older_than):
+        """Deletes the messages sent before older_than seconds ago. Returns the number of deleted messages"""
+        with self.lock:
+            return self.connection.execute('DELETE FROM outbox WHERE status = ? AND created < ?',
+                                           (SENT, time.time() - older_than)).rowcount
+
+    def get_next_attempt_time(self):
+        with self.lock:
+            return self.connection.execute('SELECT MIN(next_attempt) FROM outbox WHERE status = ?',
+                                           (PENDING,)).fetchone()[0]
+
+    def get_stats(self):
+        """Returns the number of messages waiting per provider and the age in seconds of the oldest one"""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT provider, COUNT(*), MIN(created) FROM outbox WHERE status IN (?, ?) GROUP BY provider',
+                (PENDING, SENDING)).fetchall()
+
+        now = time.time()
+        depth = {}
+        oldest_age = 0
+        for provider, count, created in rows:
+            depth[provider] = count
+            oldest_age = max(oldest_age, now - created)
+        return depth, oldest_age
+
+
+class MailerMetrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.start_time = time.time()
+        self.last_report_time = self.start_time
+        self.last_report_counters = {}
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self, outbox):
+        now = time.time()
+        with self.lock:
+            counters = dict(self.counters)
+
+        elapsed = now - self.last_report_time
+        rates = {}
+        for name, value in counters.iteritems():
+            rates[name] = (value - self.last_report_counters.get(name, 0)) / elapsed if elapsed else 0.
+
+        self.last_report_time = now
+        self.last_report_counters = counters
+
+        depth, oldest_age = outbox.get_stats()
+        return {
+            'uptime': now - self.start_time,
+            'counters': counters,
+            'rates': rates,
+            'outbox_depth': depth,
+            'oldest_age': oldest_age
+        }
+
+
+class OutboxWorkerPool(object):
+    """Bounded pool of threads sending the outbox in batches.
+
+    Each provider has its own concurrency limit, so a slow provider holds at most that many workers while the
+    others keep sending. Failed messages are retried with exponential backoff until max_attempts, unless the
+    provider reports a PermanentError.
+    """
+    def __init__(self, outbox, providers, log, metrics,
+                 workers=4, batch_size=50, max_attempts=8, retry_backoff=2., max_retry_backoff=3600.,
+                 provider_concurrency=None):
+        self.outbox = outbox
+        self.providers = providers
+        self.log = log
+        self.metrics = metrics
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+
+        self.semaphores = {}
+        for name in providers:
+            limit = 1
+            if provider_concurrency and name in provider_concurrency:
+                limit = provider_concurrency[name]
+            self.semaphores[name] = threading.BoundedSemaphore(limit)
+
+        self.wake_up = threading.Event()
+        self.threads = []
+
+    def start(self):
+        for x in xrange(self.workers):
+            thread = threading.Thread(target=self.run, name='mailer-worker-%d' % x)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def notify(self):
+        self.wake_up.set()
+
+    def run(self):
+        while True:
+            has_sent = False
+            for name, provider in self.providers.iteritems():
+                if not self.semaphores[name].acquire(False):
+                    continue
+                try:
+                    jobs = self.outbox.claim(name, self.batch_size)
+                    if jobs:
+                        self.send(provider, jobs)
+                        has_sent = True
+                except Exception as ex:
+                    self.log('ERROR', 'EXCEPTION', str(ex))
+                finally:
+                    self.semaphores[name].release()
+
+            if not has_sent:
+                next_attempt = self.outbox.get_next_attempt_time()
+                timeout = 1.
+                if next_attempt is not None:
+                    timeout = min(timeout, max(0.01, next_attempt - time.time()))
+                self.wake_up.wait(timeout)
+                self.wake_up.clear()
+
+    def send(self, provider, jobs):
+        start = time.time()
+        try:
+            errors = provider.send_batch(jobs)
+        except Exception as ex:
+            errors = [str(ex)] * len(jobs)
+
+        self.metrics.increment(provider.name + '.batches')
+        self.metrics.increment(provider.name + '.send_time', time.time() - start)
+
+        for job, error in zip(jobs, errors):
+            if error is None:
+                self.outbox.complete(job['id'])
+                self.metrics.increment(provider.name + '.sent')
+                self.metrics.increment(provider.name + '.latency', time.time() - job['created'])
+                self.log('INFO', 'SUCCESS', job['id'])
+            elif isinstance(error, PermanentError) or job['attempts'] + 1 >= self.max_attempts:
+                self.outbox.fail(job['id'], error)
+                self.metrics.increment(provider.name + '.failed')
+                self.log('ERROR', 'FAILED', '%s %s' % (job['id'], error))
+            else:
+                backoff = min(self.max_retry_backoff, self.retry_backoff * 2 ** job['attempts'])
+                self.outbox.retry(job['id'], time.time() + backoff, error)
+                self.metrics.increment(provider.name + '.retried')
+                self.log('ERROR', 'RETRY', '%s %s' % (job['id'], error))
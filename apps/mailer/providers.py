@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import json
+import random
+from collections import deque
+
+from util import send_email
+from outbox import PermanentError
+
+# Every provider receives a batch of outbox jobs and returns, in the same order, None for each job that was
+# delivered, the error description for each one that should be retried or a PermanentError for each one that
+# must not be retried.
+
+class MandrillProvider(object):
+    name = 'mandrill'
+
+    def __init__(self, apikey):
+        import mandrill
+        self.api = mandrill.Mandrill(apikey)
+        self.api.users.ping()
+
+    def send_batch(self, jobs):
+        # a single send_template call per template delivers the emails of all the recipients of the batch. The
+        # merge vars and the results are keyed by email, so an address is only sent once in each call
+        errors = [None] * len(jobs)
+
+        calls = []
+        calls_by_template = {}
+        for index, job in enumerate(jobs):
+            template_name = (job['template'] + '-' + job['language']).lower()
+            email = job['to'].lower()
+            for call in calls_by_template.setdefault(template_name, []):
+                if email not in call[1]:
+                    break
+            else:
+                call = (template_name, set(), [])
+                calls_by_template[template_name].append(call)
+                calls.append(call)
+            call[1].add(email)
+            call[2].append(index)
+
+        for template_name, emails, indexes in calls:
+            to = []
+            merge_vars = []
+            for index in indexes:
+                job = jobs[index]
+                to.append({'email': job['to'], 'name': job['params'].get('username'), 'type': 'to'})
+                merge_vars.append({
+                    'rcpt': job['to'],
+                    'vars': [{'name': k, 'content': v} for k, v in job['params'].iteritems()]
+                })
+
+            message = {
+                'to': to,
+                'preserve_recipients': False,
+                'metadata': {'website': 'www.bitex.com.br'},
+                'merge_vars': merge_vars
+            }
+
+            try:
+                results = self.api.messages.send_template(template_name=template_name,
+                                                          template_content=[],
+                                                          message=message)
+            except Exception as ex:
+                for index in indexes:
+                    errors[index] = str(ex)
+                continue
+
+            status_by_email = {}
+            for result in results:
+                status_by_email[result['email'].lower()] = result
+            for index in indexes:
+                result = status_by_email.get(jobs[index]['to'].lower())
+                if not result:
+                    errors[index] = 'no result from mandrill'
+                elif result['status'] in ('rejected', 'invalid'):
+                    errors[index] = PermanentError(json.dumps(result))
+
+        return errors
+
+
+class MailChimpProvider(object):
+    name = 'mailchimp'
+
+    def __init__(self, apikey, newsletter_list_id):
+        import mailchimp
+        self.mailchimp = mailchimp
+        self.api = mailchimp.Mailchimp(apikey)
+        self.api.helper.ping()
+        self.newsletter_list_id = newsletter_list_id
+
+    def send_batch(self, jobs):
+        batch = []
+        for job in jobs:
+            batch.append({
+                'email': {'email': job['email']},
+                'merge_vars': {'EMAIL': job['email'], 'FNAME': job['username']}
+            })
+
+        result = self.api.lists.batch_subscribe(id=self.newsletter_list_id,
+                                                batch=batch,
+                                                double_optin=True,
+                                                update_existing=True)
+
+        # the errors of each email (invalid or banned addresses...) would happen again, the request failing
+        # as a whole raises and is retried
+        errors = [None] * len(jobs)
+        error_by_email = {}
+        for error in result.get('errors', []):
+            error_by_email[error['email']['email']] = PermanentError(error.get('error'))
+        for index, job in enumerate(jobs):
+            errors[index] = error_by_email.get(job['email'])
+        return errors
+
+
+class SmtpProvider(object):
+    name = 'smtp'
+
+    def send_batch(self, jobs):
+        errors = []
+        for job in jobs:
+            try:
+                send_email(job['sender'], job['to'], job['subject'], job['body'], job['content_type'])
+                errors.append(None)
+            except Exception as ex:
+                errors.append(str(ex))
+        return errors
+
+
+class StubProvider(object):
+    """Only logs the emails. Used to run the mailer without sending anything, it keeps the last ones sent"""
+    def __init__(self, name, log, failure_rate=0., keep=100):
+        self.name = name
+        self.log = log
+        self.failure_rate = failure_rate
+        self.sent = deque(maxlen=keep)
+        self.sent_count = 0
+
+    def send_batch(self, jobs):
+        errors = []
+        for job in jobs:
+            if self.failure_rate and random.random() < self.failure_rate:
+                errors.append('stub failure')
+                continue
+            self.log('DEBUG', 'STUB_' + self.name.upper(), json.dumps(job))
+            self.sent.append(job)
+            self.sent_count += 1
+            errors.append(None)
+        return errors
@@ -0,0 +1,125 @@
+__author__ = 'rodrigo'
+
+import os
+import time
+import tempfile
+import unittest
+
+from outbox import Outbox, OutboxWorkerPool, MailerMetrics, PermanentError, PENDING, SENT, FAILED
+from providers import StubProvider
+
+class ScriptedProvider(object):
+    """Answers every job with the next error of its script, None once the script is over"""
+    name = 'scripted'
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.batches = []
+
+    def send_batch(self, jobs):
+        self.batches.append([ job['id'] for job in jobs ])
+        return [ self.errors.pop(0) if self.errors else None for job in jobs ]
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        self.outbox = Outbox(self.filename)
+
+    def tearDown(self):
+        self.outbox.connection.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.filename + suffix):
+                os.remove(self.filename + suffix)
+
+    def get_statuses(self):
+        return self.outbox.connection.execute('SELECT id, status, attempts FROM outbox ORDER BY id').fetchall()
+
+    def create_pool(self, provider, **kwargs):
+        return OutboxWorkerPool(self.outbox, {provider.name: provider}, lambda *args: None, MailerMetrics(),
+                                retry_backoff=0., **kwargs)
+
+    def test_claim_and_complete(self):
+        first = self.outbox.enqueue('smtp', {'to': 'a@x.com'})
+        second = self.outbox.enqueue('smtp', {'to': 'b@x.com'})
+        self.outbox.enqueue('mandrill', {'to': 'c@x.com'})
+
+        jobs = self.outbox.claim('smtp', 10)
+        self.assertEqual([ (first, 'a@x.com', 0), (second, 'b@x.com', 0) ],
+                         [ (job['id'], job['to'], job['attempts']) for job in jobs ])
+        self.assertEqual([], self.outbox.claim('smtp', 10))  # already being sent
+
+        self.outbox.complete(first)
+        self.assertEqual((first, SENT, 1), self.get_statuses()[0])
+
+    def test_sending_messages_go_out_again_after_a_restart(self):
+        job_id = self.outbox.enqueue('smtp', {'to': 'a@x.com'})
+        self.outbox.claim('smtp', 10)
+        self.outbox.connection.close()
+
+        self.outbox = Outbox(self.filename)
+        self.assertEqual([ job_id ], [ job['id'] for job in self.outbox.claim('smtp', 10) ])
+
+    def test_retry_waits_for_the_next_attempt(self):
+        job_id = self.outbox.enqueue('smtp', {'to': 'a@x.com'})
+        self.outbox.claim('smtp', 10)
+        self.outbox.retry(job_id, time.time() + 60, 'timeout')
+
+        self.assertEqual([], self.outbox.claim('smtp', 10))
+        self.assertEqual((job_id, PENDING, 1), self.get_statuses()[0])
+        self.assertTrue(self.outbox.get_next_attempt_time() > time.time())
+        self.assertEqual({'smtp': 1}, self.outbox.get_stats()[0])
+
+    def test_purge_keeps_the_recent_and_the_failed_messages(self):
+        old_id = self.outbox.enqueue('smtp', {'to': 'a@x.com'})
+        recent_id = self.outbox.enqueue('smtp', {'to': 'b@x.com'})
+        failed_id = self.outbox.enqueue('smtp', {'to': 'c@x.com'})
+        self.outbox.claim('smtp', 10)
+        self.outbox.complete(old_id)
+        self.outbox.complete(recent_id)
+        self.outbox.fail(failed_id, 'rejected')
+        self.outbox.connection.execute('UPDATE outbox SET created = created - 3600 WHERE id IN (?, ?)',
+                                       (old_id, failed_id))
+
+        self.assertEqual(1, self.outbox.purge(60))
+        self.assertEqual([ (recent_id, SENT, 1), (failed_id, FAILED, 1) ], self.get_statuses())
+
+    def test_worker_pool_retries_until_max_attempts(self):
+        job_id = self.outbox.enqueue('scripted', {'to': 'a@x.com'})
+        provider = ScriptedProvider('timeout', 'timeout', 'timeout')
+        pool = self.create_pool(provider, max_attempts=3)
+
+        for x in xrange(3):
+            pool.send(provider, self.outbox.claim('scripted', 10))
+        self.assertEqual([ [job_id] ] * 3, provider.batches)
+        self.assertEqual([ (job_id, FAILED, 3) ], self.get_statuses())
+
+    def test_worker_pool_does_not_retry_a_permanent_error(self):
+        rejected_id = self.outbox.enqueue('scripted', {'to': 'a@x.com'})
+        delivered_id = self.outbox.enqueue('scripted', {'to': 'b@x.com'})
+        provider = ScriptedProvider(PermanentError('rejected'))
+        pool = self.create_pool(provider)
+
+        pool.send(provider, self.outbox.claim('scripted', 10))
+        self.assertEqual([ (rejected_id, FAILED, 1), (delivered_id, SENT, 1) ], self.get_statuses())
+        self.assertEqual(1, pool.metrics.counters['scripted.failed'])
+
+    def test_worker_pool_sends_through_the_stub(self):
+        provider = StubProvider('smtp', lambda *args: None, keep=2)
+        pool = self.create_pool(provider, workers=2)
+        for x in xrange(5):
+            self.outbox.enqueue('smtp', {'to': 'user%d@x.com' % x})
+
+        pool.start()
+        pool.notify()
+        deadline = time.time() + 5
+        while provider.sent_count < 5 and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(5, provider.sent_count)
+        self.assertEqual([ 'user3@x.com', 'user4@x.com' ], [ job['to'] for job in provider.sent ])
+        self.assertEqual({}, self.outbox.get_stats()[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -51,11 +51,8 @@ def send_email(sender, recipient, subject, body, content_type='plain'):
     msg['To'] = formataddr((recipient_name, recipient_addr))
     msg['Subject'] = Header(unicode(subject), header_charset)
 
-    try:
-        # Send the message via SMTP to localhost:25
-        smtp = SMTP("127.0.0.1")
-        smtp.ehlo()
-        smtp.sendmail(sender_addr, recipient, msg.as_string())
-        smtp.quit()
-    except Exception as ex:
-        pass
+    # Send the message via SMTP to localhost:25. Errors are raised, so the outbox can retry the email
+    smtp = SMTP("127.0.0.1")
+    smtp.ehlo()
+    smtp.sendmail(sender_addr, recipient, msg.as_string())
+    smtp.quit()
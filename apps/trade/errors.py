@@ -31,3 +31,6 @@ class InvalidClientIDError(TradeRuntimeError):
 
 class InvalidParameter(TradeRuntimeError):
   error_description = "Invalid Parameter"
+
+class ProfilerRunningError(TradeRuntimeError):
+  error_description = "Profiler is already running"
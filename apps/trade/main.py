@@ -11,6 +11,7 @@ import tornado
 define("trade_in", help="zmq input queue")
 define("trade_pub",help="zmq publisher queue")
 define("trade_log", help="logging" )
+define("trade_log_format", default="text", help="text writes the replay log through the logging module. binary writes a buffered, length prefixed log from a background thread")
 define("session_timeout_limit", type=int, help="Session timeout")
 define("db_echo", default=False,help="Prints every database command on the stdout" )
 define("db_engine",  help="SQLAlchemy database engine string")
@@ -18,7 +19,13 @@ define("test_mode", default=False, help="Test mode")
 define("satoshi_mode", default=False, help="Satoshi mode")
 define("dev_mode", default=False, help="Dev mode")
 define("global_email_language", help="template email language")
+define("trade_email_digest_window", type=int, default=0, help="Seconds the trade execution emails of a user are collected into a single digest email. 0 sends one email per execution")
 define("verification_bonus", type=dict, help="Verification bonus details")
+define("traders_rank_persist_interval", type=int, default=300, help="Seconds between the writes of the changed traders rank balances to the database")
+define("message_latency_budget", type=dict, help="Latency budget in milliseconds per message class (order_entry, default, query)")
+define("trade_metrics_file", help="file where the engine metrics are written every trade_metrics_interval seconds")
+define("trade_metrics_interval", type=int, default=60, help="Seconds between the dumps of the engine metrics")
+define("trade_profile_dir", help="directory where the collapsed stacks of the sampling profiler are written. Defaults to the temp directory")
 
 define("config", help="config file", callback=lambda path: tornado.options.parse_config_file(path, final=False))
 
@@ -58,6 +58,38 @@ class MarketDataPublisher(object):
     application.publish( 'MD_INCREMENTAL_' + symbol + '.' + entry_type , md )
 
 
+  @staticmethod
+  def publish_cancel_orders(symbol, entry_type, order_positions ):
+    # the orders on the top of the book go in a single delete thru
+    top_count = 0
+    while top_count < len(order_positions) and order_positions[top_count] == top_count + 1:
+      top_count += 1
+
+    # the deletes go from the bottom of the book up, so the positions of the next ones don't change
+    entry_list = []
+    for order_position in reversed(order_positions[top_count:]):
+      entry_list.append( {
+        "MDUpdateAction":"2",  # Delete
+        "Symbol": symbol,
+        "MDEntryType": entry_type,
+        "MDEntryPositionNo": order_position,
+      })
+
+    if top_count:
+      entry_list.append( {
+        "MDUpdateAction":"3",  # Delete Thru
+        "Symbol": symbol,
+        "MDEntryType": entry_type,
+        "MDEntryPositionNo": top_count,
+      })
+
+    md = {
+      "MsgType":"X",
+      "MDBkTyp": '3', # Order Depth
+      "MDIncGrp": entry_list
+    }
+    application.publish( 'MD_INCREMENTAL_' + symbol + '.' + entry_type , md )
+
   @staticmethod
   def publish_new_order(symbol, entry_type, order_position, order ):
     md = {
@@ -81,6 +113,28 @@ class MarketDataPublisher(object):
     }
     application.publish( 'MD_INCREMENTAL_' + symbol + '.' + entry_type , md )
 
+  @staticmethod
+  def publish_update_order(symbol, entry_type, order_position, order ):
+    md = {
+      "MsgType":"X",
+      "MDBkTyp": '3', # Order Depth
+      "MDIncGrp": [{
+        "MDUpdateAction":"1",  # Update
+        "Symbol": symbol,
+        "MDEntryType": entry_type,
+        "MDEntryPositionNo": order_position + 1,
+        "MDEntryID": order.id,
+        "MDEntryPx": order.price,
+        "MDEntrySize": order.leaves_qty,
+        "MDEntryDate": order.created.date(),
+        "MDEntryTime": order.created.time(),
+        "OrderID": order.id,
+        "Username": order.account_username,
+        "Broker": order.broker_username
+      }]
+    }
+    application.publish( 'MD_INCREMENTAL_' + symbol + '.' + entry_type , md )
+
   @staticmethod
   def publish_trades(symbol, trades):
     md_trades = []
@@ -108,8 +162,8 @@ class MarketDataPublisher(object):
     application.publish( 'MD_TRADE_' + symbol , md )
 
   @staticmethod
-  def generate_trade_history( session, page_size = None, offset = None, sort_column = None, sort_order='ASC' ):
-    trades = Trade.get_last_trades(session, page_size, offset, sort_column, sort_order)
+  def generate_trade_history( session, page_size = None, offset = None, sort_column = None, sort_order='ASC', cursor=None ):
+    trades = Trade.get_last_trades(session, page_size, offset, sort_column, sort_order, cursor)
     trade_list = []
     for trade in  trades:
         trade_list.append([
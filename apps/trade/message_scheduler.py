@@ -0,0 +1,110 @@
+import re
+import time
+from collections import deque
+
+ORDER_ENTRY = 'order_entry'
+DEFAULT     = 'default'
+QUERY       = 'query'
+
+# classes in the order they are served when none of them is over its latency budget
+MESSAGE_CLASSES = ( ORDER_ENTRY, DEFAULT, QUERY )
+
+ORDER_ENTRY_MESSAGE_TYPES = ( 'D',    # NewOrderSingle
+                              'E',    # NewOrderList
+                              'F',    # OrderCancelRequest
+                              'G',    # OrderCancelReplaceRequest
+                              'q' )   # OrderMassCancelRequest
+
+QUERY_MESSAGE_TYPES = ( 'V',    # MarketDataRequest
+                        'x',    # SecurityListRequest
+                        'U2',   # UserBalanceRequest
+                        'U4',   # OrdersListRequest
+                        'U20',  # DepositMethodsRequest
+                        'U26',  # WithdrawListRequest
+                        'U28',  # BrokerListRequest
+                        'U30',  # DepositListRequest
+                        'U32',  # TradeHistoryRequest
+                        'U34',  # LedgerListRequest
+                        'U36',  # TradersRankRequest
+                        'U42',  # PositionRequest
+                        'B2',   # CustomerListRequest
+                        'B4',   # CustomerRequest
+                        'A0',   # DbQueryRequest
+                        'A2',   # TraceStatsRequest
+                        'A4',   # EngineMetricsRequest
+                        'A6',   # ProfilerRequest
+                        'A8' )  # MemoryRequest
+
+DEFAULT_LATENCY_BUDGET = {
+  ORDER_ENTRY : 5,
+  DEFAULT     : 50,
+  QUERY       : 500
+}
+
+MSG_TYPE_REGEX = re.compile(r'"MsgType"\s*:\s*"([^"]+)"')
+
+def get_message_class(raw_message):
+  match = MSG_TYPE_REGEX.search(raw_message, 20)
+  if not match:
+    return DEFAULT
+
+  msg_type = match.group(1)
+  if msg_type in ORDER_ENTRY_MESSAGE_TYPES:
+    return ORDER_ENTRY
+  if msg_type in QUERY_MESSAGE_TYPES:
+    return QUERY
+  return DEFAULT
+
+
+class MessageScheduler(object):
+  def __init__(self, latency_budget=None):
+    self.queues = {}
+    self.latency_budget = {}
+    for message_class in MESSAGE_CLASSES:
+      self.queues[message_class] = deque()
+
+      budget = DEFAULT_LATENCY_BUDGET[message_class]
+      if latency_budget and message_class in latency_budget:
+        budget = latency_budget[message_class]
+      self.latency_budget[message_class] = budget / 1000.
+
+    self.pending = 0
+
+  def has_pending(self):
+    return self.pending > 0
+
+  def push(self, identity, raw_message):
+    message_class = get_message_class(raw_message)
+    self.queues[message_class].append( (time.time(), identity, raw_message) )
+    self.pending += 1
+    return message_class
+
+  def pop(self):
+    if not self.pending:
+      return None
+
+    now = time.time()
+
+    # starvation protection: a message that already waited longer than its class budget is served
+    # before anything else, the oldest one first.
+    next_class = None
+    next_enqueued_time = None
+    for message_class in MESSAGE_CLASSES:
+      queue = self.queues[message_class]
+      if not queue:
+        continue
+      enqueued_time = queue[0][0]
+      if now - enqueued_time > self.latency_budget[message_class]:
+        if next_enqueued_time is None or enqueued_time < next_enqueued_time:
+          next_class = message_class
+          next_enqueued_time = enqueued_time
+
+    if next_class is None:
+      for message_class in MESSAGE_CLASSES:
+        if self.queues[message_class]:
+          next_class = message_class
+          break
+
+    enqueued_time, identity, raw_message = self.queues[next_class].popleft()
+    self.pending -= 1
+    return identity, raw_message, enqueued_time
@@ -0,0 +1,101 @@
+import os
+import json
+import time
+
+from bitex.histogram import StageHistograms
+
+class TradeMetrics(object):
+  """Counters and latency histograms of the trade engine.
+
+  Every request is measured from the moment it is dequeued until its reply is ready, per MsgType. The time spent
+  in each phase of a request (match, sql, commit, log) is summed while the request is processed and recorded
+  when it ends, so the phase histograms tell how much of a request went to each of them. The phases overlap,
+  sql includes the statements of the commit and of the matching. The publish phase is recorded by the publisher
+  thread for each request it sends.
+  """
+  def __init__(self):
+    self.start_time = time.time()
+    self.counters = {}    # MsgType => [ requests, errors ]
+    self.latencies = StageHistograms()
+    self.phases = StageHistograms()
+    self.request_phases = {}
+
+    self.last_rates_time = self.start_time
+    self.last_rates_counters = {}
+    self.rates = {}
+
+  def start_request(self):
+    self.request_phases = {}
+
+  def add_phase_time(self, phase, elapsed):
+    self.request_phases[phase] = self.request_phases.get(phase, 0) + elapsed
+
+  def end_request(self, msg_type, elapsed, is_error=False):
+    counters = self.counters.get(msg_type)
+    if counters is None:
+      counters = self.counters[msg_type] = [0, 0]
+    counters[0] += 1
+    if is_error:
+      counters[1] += 1
+
+    self.latencies.record(msg_type, elapsed * 1000)
+    for phase, phase_elapsed in self.request_phases.iteritems():
+      self.phases.record(phase, phase_elapsed * 1000)
+    self.request_phases = {}
+
+  def record_phase(self, phase, elapsed):
+    self.phases.record(phase, elapsed * 1000)
+
+  def update_rates(self):
+    """ requests per second of every MsgType since the last call """
+    now = time.time()
+    elapsed = now - self.last_rates_time
+    counters = dict( (msg_type, values[0]) for msg_type, values in self.counters.items() )
+
+    self.rates = {}
+    for msg_type, count in counters.iteritems():
+      self.rates[msg_type] = (count - self.last_rates_counters.get(msg_type, 0)) / elapsed if elapsed else 0.
+
+    self.last_rates_time = now
+    self.last_rates_counters = counters
+
+  def get_report(self, application):
+    from execution import matcher_dict
+
+    now = time.time()
+    msg_types = {}
+    latencies = self.latencies.to_dict()
+    for msg_type, (requests, errors) in self.counters.items():
+      msg_types[msg_type] = {
+        'Requests'  : requests,
+        'Errors'    : errors,
+        'Rate'      : self.rates.get(msg_type, 0.),
+        'Latency'   : latencies.get(msg_type)
+      }
+
+    books = {}
+    resting_orders = 0
+    for symbol, order_matcher in matcher_dict.items():
+      books[symbol] = { 'Bids': len(order_matcher.buy_side), 'Asks': len(order_matcher.sell_side) }
+      resting_orders += len(order_matcher.buy_side) + len(order_matcher.sell_side)
+
+    return {
+      'Timestamp'         : now,
+      'Uptime'            : now - self.start_time,
+      'MsgTypes'          : msg_types,
+      'Phases'            : self.phases.to_dict(),
+      'Books'             : books,
+      'RestingOrders'     : resting_orders,
+      'Sessions'          : len(application.session_manager.sessions),
+      'IdentityMap'       : len(application.db_session().identity_map),
+      'PendingRequests'   : application.scheduler.pending,
+      'PublishPipeline'   : len(application.publish_pipeline)
+    }
+
+  def dump(self, application, filename):
+    # written aside and renamed, so a reader never sees a partial file
+    self.update_rates()
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as metrics_file:
+      json.dump(self.get_report(application), metrics_file, indent=2, sort_keys=True)
+    os.rename(tmp_filename, filename)
@@ -7,15 +7,17 @@ import logging
 import hmac, base64, struct, hashlib, time, uuid
 
 import datetime
-from bitex.utils import smart_str
+import bisect
+from bitex.utils import smart_str, encode_cursor, decode_cursor
 from bitex.errors import OrderNotFound
+from bitex.matching import OrderMixin
 
 from sqlalchemy import ForeignKey
 from sqlalchemy import create_engine
-from sqlalchemy import desc, func
+from sqlalchemy import desc, func, cast, event, inspect, Index, bindparam
 from sqlalchemy.sql.expression import and_, or_, exists
 from sqlalchemy import Column, Integer, String, DateTime, Boolean, Numeric, Text, Date, UniqueConstraint, UnicodeText
-from sqlalchemy.orm import  relationship, backref
+from sqlalchemy.orm import  relationship, backref, Session as SessionBase
 from sqlalchemy.ext.declarative import declarative_base
 import json
 
@@ -28,6 +30,7 @@ engine = create_engine( options.db_engine, echo=options.db_echo)
 Base = declarative_base()
 
 from trade_application import application
+from errors import InvalidMessageError
 
 from tornado import template
 
@@ -35,6 +38,31 @@ from sqlalchemy.ext.declarative import DeclarativeMeta
 
 import onetimepass
 
+def page_query(query, entity, page_size, offset, cursor=None):
+  query = query.order_by(entity.created.desc(), entity.id.desc())
+
+  # keyset paging: start right after the (created, id) pointed by the cursor instead of skipping offset rows
+  if cursor:
+    try:
+      created, record_id = decode_cursor(cursor)
+      if isinstance(entity.id.type, Integer):
+        record_id = int(record_id)
+    except ValueError:
+      raise InvalidMessageError()
+    query = query.filter( or_( entity.created < created,
+                               and_( entity.created == created, entity.id < record_id ) ) )
+  elif offset:
+    query = query.offset(offset)
+
+  if page_size:
+    query = query.limit(page_size)
+  return query
+
+def get_next_cursor(records, page_size):
+  if not page_size or len(records) < page_size:
+    return None
+  return encode_cursor(records[-1].created, records[-1].id)
+
 class AlchemyJSONEncoder(json.JSONEncoder):
   def default(self, obj):
     if isinstance(obj.__class__, DeclarativeMeta):
@@ -79,6 +107,7 @@ class BrokerDoesNotExistsException(Exception):
 
 class Currency(Base):
   __tablename__   = 'currencies'
+  format_python_cache = {}  # code => format_python, currencies never change while the engine is running
   code            = Column(String(4), primary_key=True)
   sign            = Column(String(2))
   description     = Column(String(15), nullable=False)
@@ -99,9 +128,9 @@ class Currency(Base):
 
   @staticmethod
   def format_number(session, currency_code, number):
-    #TODO: Optimize this query because this data never changes
-    currency = Currency.get_currency(session, currency_code)
-    return currency.format_python.format( number )
+    if currency_code not in Currency.format_python_cache:
+      Currency.format_python_cache[currency_code] = Currency.get_currency(session, currency_code).format_python
+    return Currency.format_python_cache[currency_code].format( number )
 
   def __repr__(self):
     return u"<Currency(code=%r, sign=%r, description=%r, is_crypto=%r, pip=%r, format_python=%r, format_js=%r, human_format_python=%r, human_format_js=%r)>" % (
@@ -148,7 +177,7 @@ class User(Base):
   is_system       = Column(Boolean, nullable=False, default=False)
   is_broker       = Column(Boolean, nullable=False, default=False)
 
-  created         = Column(DateTime, default=datetime.datetime.now, nullable=False)
+  created         = Column(DateTime, default=datetime.datetime.now, nullable=False, index=True)
   last_login      = Column(DateTime, default=datetime.datetime.now, nullable=False)
 
   two_factor_enabled  = Column(Boolean, nullable=False, default=False)
@@ -159,6 +188,9 @@ class User(Base):
 
   withdraw_email_validation  = Column(Boolean, nullable=False, default=True)
 
+  SEARCH_ENTITY = 'U'
+  SEARCH_FIELDS = ('username', 'email')
+
 
   def __repr__(self):
     return u"<User(id=%r, username=%r, email=%r,  broker_id=%r, " \
@@ -179,6 +211,9 @@ class User(Base):
   def account_id(self):
     return self.id
 
+  def get_search_terms(self):
+    return SearchIndex.extract_terms( self.username, self.email )
+
 
   def set_password(self, raw_password):
     import random
@@ -214,7 +249,7 @@ class User(Base):
     return None
 
   @staticmethod
-  def get_list(session, broker_id, status_list, country = None, state=None, client_id=None,  page_size = None, offset = None, sort_column = None, sort_order='ASC'):
+  def get_list(session, broker_id, status_list, country = None, state=None, client_id=None,  page_size = None, offset = None, sort_column = None, sort_order='ASC', cursor=None):
     query = session.query(User).filter( User.verified.in_( status_list ) ).filter(User.broker_id==broker_id)
 
     if country:
@@ -223,8 +258,21 @@ class User(Base):
       query = query.filter(User.state == state)
 
     if client_id:
-      query = query.filter( or_( User.username.like(client_id), User.email.like(client_id) ) )
+      query = query.filter( User.id.in_( SearchIndex.search(session, 'U', broker_id, client_id, Integer) ) )
 
+    if not sort_column:
+      # the customers keep their order by id, the cursor starts right after the id of the last one
+      query = query.order_by(User.id)
+      if cursor:
+        try:
+          query = query.filter(User.id > int(decode_cursor(cursor)[1]))
+        except ValueError:
+          raise InvalidMessageError()
+      elif offset:
+        query = query.offset(offset)
+      if page_size:
+        query = query.limit(page_size)
+      return query
 
     if page_size:
       query = query.limit(page_size)
@@ -573,17 +621,6 @@ class Balance(Base):
     return u"<Balance(id=%r, account_id=%r, account_name=%r, broker_id=%r, broker_name=%r, currency=%r, balance=%r)>" % (
       self.id, self.account_id, self.account_name,  self.broker_id, self.broker_name, self.currency, self.balance )
 
-  @staticmethod
-  def get_balances_by_rank(session, currency = 'BTC'):
-    entries = session.query(Balance).filter_by(currency = currency).order_by(Balance.balance.desc())
-
-    result_rank = []
-    for i, balance in enumerate(entries):
-        if balance.balance > 0:
-            result_rank.append([i+1, balance.account_name, balance.broker_name, balance.balance])
-
-    return result_rank
-
   @staticmethod
   def get_balances_by_account(session, account_id):
     return session.query(Balance).filter_by(account_id = account_id)
@@ -619,14 +656,140 @@ class Balance(Base):
 
     session.add(balance_obj)
 
-    balance_update_msg = dict()
-    balance_update_msg['MsgType'] = 'U3'
-    balance_update_msg['ClientID'] = account_id
-    balance_update_msg[broker_id] = { currency: balance_obj.balance }
-    application.publish( account_id,  balance_update_msg  )
+    TradersRank.update_balance( account_id, account_name, broker_id, broker_name, currency, balance_obj.balance )
+
+    application.publish_balance_update( account_id, broker_id, currency, balance_obj.balance )
 
     return balance_obj.balance
 
+class TradersRankBook(object):
+  """In memory ranking of the balances of one currency, kept sorted by balance"""
+  def __init__(self):
+    self.keys = []     # sorted list of (-balance, account_id, broker_id)
+    self.entries = {}  # (account_id, broker_id) => [balance, account_name, broker_name]
+    self.changed_keys = set()  # the entries not yet written to the database
+    self.is_persisted = False
+
+  def update(self, account_id, account_name, broker_id, broker_name, balance):
+    entry = self.entries.get( (account_id, broker_id) )
+    if entry:
+      if entry[0] == balance:
+        return
+      del self.keys[ bisect.bisect_left(self.keys, (-entry[0], account_id, broker_id)) ]
+
+    self.entries[ (account_id, broker_id) ] = [ balance, account_name, broker_name ]
+    bisect.insort( self.keys, (-balance, account_id, broker_id) )
+    self.changed_keys.add( (account_id, broker_id) )
+
+  def get_page(self, offset, page_size=None):
+    end = len(self.keys)
+    if page_size:
+      end = min(end, offset + page_size)
+
+    result_rank = []
+    for rank in xrange(offset, end):
+      negative_balance, account_id, broker_id = self.keys[rank]
+      if negative_balance >= 0:
+        break
+      balance, account_name, broker_name = self.entries[ (account_id, broker_id) ]
+      result_rank.append([rank + 1, account_name, broker_name, balance])
+    return result_rank
+
+
+class TradersRank(Base):
+  __tablename__         = 'traders_rank'
+  currency              = Column(String(4),     primary_key=True)
+  account_id            = Column(Integer,       primary_key=True)
+  broker_id             = Column(Integer,       primary_key=True)
+  account_name          = Column(String(15),    nullable=False)
+  broker_name           = Column(String(30),    nullable=False)
+  balance               = Column(Integer,       nullable=False)
+  __table_args__ = ( Index('idx_traders_rank_currency_balance', 'currency', 'balance'), )
+
+  RANKED_CURRENCIES = ('BTC',)
+
+  # only the trade engine keeps the ranking in memory. Other processes read the persisted copy.
+  rank_books = {}
+  pending_updates = []
+
+  def __repr__(self):
+    return u"<TradersRank(currency=%r, account_id=%r, account_name=%r, broker_id=%r, broker_name=%r, balance=%r)>" % (
+      self.currency, self.account_id, self.account_name, self.broker_id, self.broker_name, self.balance )
+
+  @staticmethod
+  def load(session):
+    for currency in TradersRank.RANKED_CURRENCIES:
+      book = TradersRankBook()
+      for balance in session.query(Balance).filter_by(currency = currency):
+        book.update( balance.account_id, balance.account_name, balance.broker_id, balance.broker_name, balance.balance )
+      TradersRank.rank_books[currency] = book
+
+  @staticmethod
+  def update_balance(account_id, account_name, broker_id, broker_name, currency, balance):
+    # applied only once the transaction commits
+    if currency in TradersRank.rank_books:
+      TradersRank.pending_updates.append( (currency, account_id, account_name, broker_id, broker_name, balance) )
+
+  @staticmethod
+  def apply_pending_updates():
+    for currency, account_id, account_name, broker_id, broker_name, balance in TradersRank.pending_updates:
+      TradersRank.rank_books[currency].update( account_id, account_name, broker_id, broker_name, balance )
+    TradersRank.pending_updates = []
+
+  @staticmethod
+  def discard_pending_updates():
+    TradersRank.pending_updates = []
+
+  @staticmethod
+  def get_page(session, currency, page_size, offset):
+    if currency in TradersRank.rank_books:
+      return TradersRank.rank_books[currency].get_page(offset, page_size)
+
+    # the same order as the keys of the TradersRankBook
+    query = session.query(TradersRank).filter_by(currency = currency).filter(TradersRank.balance > 0).order_by(
+      TradersRank.balance.desc(), TradersRank.account_id, TradersRank.broker_id).offset(offset)
+    if page_size:
+      query = query.limit(page_size)
+    return [ [ offset + rank + 1, entry.account_name, entry.broker_name, entry.balance ]
+             for rank, entry in enumerate(query) ]
+
+  @staticmethod
+  def persist(session):
+    """Writes the balances that changed since the last call. The first call replaces the whole table"""
+    table = TradersRank.__table__
+    for currency, book in TradersRank.rank_books.iteritems():
+      if book.is_persisted:
+        keys = book.changed_keys
+        if not keys:
+          continue
+        session.execute( table.delete().where( and_( table.c.currency == currency,
+                                                     table.c.account_id == bindparam('key_account_id'),
+                                                     table.c.broker_id == bindparam('key_broker_id') ) ),
+                         [ { 'key_account_id': account_id, 'key_broker_id': broker_id } for account_id, broker_id in keys ] )
+      else:
+        keys = book.entries.keys()
+        session.execute( table.delete().where( table.c.currency == currency ) )
+
+      records = []
+      for account_id, broker_id in keys:
+        balance, account_name, broker_name = book.entries[ (account_id, broker_id) ]
+        if balance > 0:
+          records.append( { 'currency': currency,
+                            'account_id': account_id,
+                            'account_name': account_name,
+                            'broker_id': broker_id,
+                            'broker_name': broker_name,
+                            'balance': balance } )
+      if records:
+        session.execute( table.insert(), records )
+      book.changed_keys = set()
+      book.is_persisted = True
+    session.commit()
+
+event.listen(SessionBase, 'after_commit', lambda session: TradersRank.apply_pending_updates() )
+event.listen(SessionBase, 'after_rollback', lambda session: TradersRank.discard_pending_updates() )
+
+
 class Ledger(Base):
   __tablename__         = 'ledger'
   id                    = Column(Integer,       primary_key=True)
@@ -642,8 +805,8 @@ class Ledger(Base):
   operation             = Column(String(1),     nullable=False)
   amount                = Column(Integer,       nullable=False)
   balance               = Column(Integer,       nullable=False)
-  reference             = Column(String(25),    nullable=False)
-  created               = Column(DateTime,      default=datetime.datetime.now, nullable=False)
+  reference             = Column(String(25),    nullable=False, index=True)
+  created               = Column(DateTime,      default=datetime.datetime.now, nullable=False, index=True)
   description           = Column(String(255))
 
   def __repr__(self):
@@ -656,7 +819,7 @@ class Ledger(Base):
 
 
   @staticmethod
-  def get_list(session, broker_id, account_id, operation_list, page_size, offset, currency=None, filter_array=[]):
+  def get_list(session, broker_id, account_id, operation_list, page_size, offset, currency=None, filter_array=[], cursor=None):
     query = session.query(Ledger).filter( Ledger.operation.in_( operation_list ) ).filter(Ledger.broker_id==broker_id)
 
     if currency:
@@ -678,14 +841,7 @@ class Ledger(Base):
                                      Ledger.reference == filter
                                      ))
 
-    query = query.order_by(desc(Ledger.created))
-
-    if page_size:
-      query = query.limit(page_size)
-    if offset:
-      query = query.offset(offset)
-
-    return query
+    return page_query(query, Ledger, page_size, offset, cursor)
 
   @staticmethod
   def transfer(session, from_account_id, from_account_name, from_broker_id, from_broker_name, to_account_id, to_account_name, to_broker_id, to_broker_name, currency, amount, reference=None, description=None):
@@ -765,130 +921,151 @@ class Ledger(Base):
 
 
   @staticmethod
-  def execute_order(session, order, counter_order, symbol, qty, price, trade_id):
+  def execute_order(session, order, counter_order, symbol, qty, price, trade_id, postings=None):
     total_value = int(float(price) * float(qty)/1e8)
 
+    flush_postings = postings is None
+    if flush_postings:
+      postings = LedgerPostings(session)
+
       # adjust balances
     to_symbol = symbol[:3].upper()   #BTC
     from_symbol = symbol[3:].upper() #USD
 
-    balance = Balance.update_balance(session, 'DEBIT' if order.is_buy else 'CREDIT', order.account_id, order.account_username, order.broker_id, order.broker_username, from_symbol, total_value )
-    order_record_debit = Ledger( currency         = from_symbol,
-                                 account_id       = order.account_id,
-                                 account_name     = order.account_username,
-                                 broker_id        = order.broker_id,
-                                 broker_name      = order.broker_username,
-                                 payee_id         = counter_order.account_id,
-                                 payee_name       = counter_order.account_username,
-                                 payee_broker_id  = counter_order.broker_id,
-                                 payee_broker_name= counter_order.broker_username,
-                                 operation        = 'D'  if order.is_buy else 'C',
-                                 amount           = total_value,
-                                 balance          = balance,
-                                 reference        = trade_id,
-                                 description      = 'T')
-    session.add(order_record_debit)
-
-
-    balance = Balance.update_balance(session, 'CREDIT' if order.is_buy else 'DEBIT', counter_order.account_id, counter_order.account_username, counter_order.broker_id, counter_order.broker_username, from_symbol, total_value )
-    counter_order_record_credit = Ledger(currency     = from_symbol,
-                                         account_id   = counter_order.account_id,
-                                         account_name = counter_order.account_username,
-                                         broker_id    = counter_order.broker_id,
-                                         broker_name  = counter_order.broker_username,
-                                         payee_id     = order.account_id,
-                                         payee_name   = order.account_username,
-                                         payee_broker_id = order.broker_id,
-                                         payee_broker_name= order.broker_username,
-                                         operation    = 'C'  if order.is_buy else 'D',
-                                         amount       = total_value,
-                                         balance      = balance,
-                                         reference    = trade_id,
-                                         description  = 'T')
-    session.add(counter_order_record_credit)
-
-
-    balance = Balance.update_balance(session, 'CREDIT' if order.is_buy else 'DEBIT', order.account_id, order.account_username, order.broker_id, order.broker_username, to_symbol, qty )
-    order_record_credit = Ledger(currency     = to_symbol,
-                                 account_id   = order.account_id,
-                                 account_name = order.account_username,
-                                 broker_id    = order.broker_id,
-                                 broker_name  = order.broker_username,
-                                 payee_id     = counter_order.account_id,
-                                 payee_name   = counter_order.account_username,
-                                 payee_broker_id = counter_order.broker_id,
-                                 payee_broker_name = counter_order.broker_username,
-                                 operation    = 'C'  if order.is_buy else 'D',
-                                 amount       = qty,
-                                 balance      = balance,
-                                 reference    = trade_id,
-                                 description  = 'T')
-    session.add(order_record_credit)
-
-    balance = Balance.update_balance(session, 'DEBIT' if order.is_buy else 'CREDIT', counter_order.account_id, counter_order.account_username, counter_order.broker_id, counter_order.broker_username, to_symbol, qty )
-    counter_order_record_debit = Ledger(currency     = to_symbol,
-                                        account_id   = counter_order.account_id,
-                                        account_name = counter_order.account_username,
-                                        broker_id    = counter_order.broker_id,
-                                        broker_name  = counter_order.broker_username,
-                                        payee_id     = order.account_id,
-                                        payee_name   = order.account_username,
-                                        payee_broker_id = order.broker_id,
-                                        payee_broker_name= order.broker_username,
-                                        operation    = 'D' if order.is_buy else 'C',
-                                        amount       = qty,
-                                        balance      = balance,
-                                        reference    = trade_id,
-                                        description  = 'T')
-    session.add(counter_order_record_debit)
-
-    def process_execution_fee(session,trade_id, order, currency, amount ):
-      balance = Balance.update_balance(session, 'DEBIT', order.account_id, order.account_username, order.broker_id, order.broker_username, currency, amount )
-      order_fee_record = Ledger(currency          = currency,
-                                account_id        = order.account_id,
-                                account_name      = order.account_username,
-                                broker_id         = order.broker_id,
-                                broker_name       = order.broker_username,
-                                payee_id          = order.broker_id,
-                                payee_name        = order.broker_username,
-                                payee_broker_id   = order.broker_id,
-                                payee_broker_name = order.broker_username,
-                                operation         = 'D',
-                                amount            = amount,
-                                balance           = balance,
-                                reference         = trade_id,
-                                description       = 'TF')
-      session.add(order_fee_record)
-
-      balance = Balance.update_balance(session, 'CREDIT', order.broker_id, order.broker_username, order.broker_id, order.broker_username, currency, amount )
-      broker_fee_record  = Ledger(currency          = currency,
-                                  account_id        = order.broker_id,
-                                  account_name      = order.broker_username,
-                                  broker_id         = order.broker_id,
-                                  broker_name       = order.broker_username,
-                                  payee_id          = order.account_id,
-                                  payee_name        = order.account_username,
-                                  payee_broker_id   = order.broker_id,
-                                  payee_broker_name = order.broker_username,
-                                  operation         = 'C',
-                                  amount            = amount,
-                                  balance           = balance,
-                                  reference         = trade_id,
-                                  description       = 'TF')
-      session.add(broker_fee_record)
+    postings.post('D' if order.is_buy else 'C', from_symbol, total_value,
+                  order.account_id, order.account_username, order.broker_id, order.broker_username,
+                  counter_order.account_id, counter_order.account_username, counter_order.broker_id, counter_order.broker_username,
+                  trade_id, 'T')
+
+    postings.post('C' if order.is_buy else 'D', from_symbol, total_value,
+                  counter_order.account_id, counter_order.account_username, counter_order.broker_id, counter_order.broker_username,
+                  order.account_id, order.account_username, order.broker_id, order.broker_username,
+                  trade_id, 'T')
+
+    postings.post('C' if order.is_buy else 'D', to_symbol, qty,
+                  order.account_id, order.account_username, order.broker_id, order.broker_username,
+                  counter_order.account_id, counter_order.account_username, counter_order.broker_id, counter_order.broker_username,
+                  trade_id, 'T')
+
+    postings.post('D' if order.is_buy else 'C', to_symbol, qty,
+                  counter_order.account_id, counter_order.account_username, counter_order.broker_id, counter_order.broker_username,
+                  order.account_id, order.account_username, order.broker_id, order.broker_username,
+                  trade_id, 'T')
+
+    def process_execution_fee(trade_id, order, currency, amount ):
+      postings.post('D', currency, amount,
+                    order.account_id, order.account_username, order.broker_id, order.broker_username,
+                    order.broker_id, order.broker_username, order.broker_id, order.broker_username,
+                    trade_id, 'TF')
+
+      postings.post('C', currency, amount,
+                    order.broker_id, order.broker_username, order.broker_id, order.broker_username,
+                    order.account_id, order.account_username, order.broker_id, order.broker_username,
+                    trade_id, 'TF')
 
     order_fee_currency = to_symbol if order.is_buy else from_symbol
     order_fee_base_amount = qty if order.is_buy else total_value
     order_fee_amount =  order_fee_base_amount * (order.fee / 10000.)
     if order_fee_amount:
-      process_execution_fee(session, trade_id, order,order_fee_currency, order_fee_amount )
+      process_execution_fee(trade_id, order,order_fee_currency, order_fee_amount )
 
 
     counter_order_fee_currency = to_symbol if counter_order.is_buy else from_symbol
     counter_order_fee_base_amount = qty if counter_order.is_buy else total_value
     counter_order_fee_amount =  counter_order_fee_base_amount * (counter_order.fee / 10000.)
     if counter_order_fee_amount:
-      process_execution_fee(session, trade_id, counter_order,counter_order_fee_currency, counter_order_fee_amount )
+      process_execution_fee(trade_id, counter_order,counter_order_fee_currency, counter_order_fee_amount )
+
+    if flush_postings:
+      postings.flush()
+
+
+class LedgerPostings(object):
+  """Accumulates the ledger records and balance deltas of one or more trades, netted per
+  (account_id, broker_id, currency), and writes them with one UPDATE per balance and one bulk insert"""
+  def __init__(self, session):
+    self.session = session
+    self.balances = {}  # (account_id, broker_id, currency) => balance before the postings, None if there is no row
+    self.deltas = {}    # (account_id, broker_id, currency) => [delta, account_name, broker_name]
+    self.keys = []      # keys in the order they were first touched
+    self.records = []
+
+  def _load(self, key):
+    if key not in self.balances:
+      account_id, broker_id, currency = key
+      balance_obj = self.session.query(Balance).filter_by(account_id = account_id ).filter_by(broker_id = broker_id ).filter_by(currency = currency).first()
+      self.balances[key] = balance_obj.balance if balance_obj else None
+    return self.balances[key]
+
+  def get_balance(self, account_id, broker_id, currency):
+    key = (account_id, broker_id, currency.strip().upper())
+    balance = self._load(key) or 0
+    if key in self.deltas:
+      balance += self.deltas[key][0]
+    return balance
+
+  def post(self, operation, currency, amount,
+           account_id, account_name, broker_id, broker_name,
+           payee_id, payee_name, payee_broker_id, payee_broker_name,
+           reference, description):
+    key = (account_id, broker_id, currency)
+    self._load(key)
+    if key not in self.deltas:
+      self.deltas[key] = [0, account_name, broker_name]
+      self.keys.append(key)
+
+    if operation == 'C':
+      self.deltas[key][0] += amount
+    else:
+      self.deltas[key][0] -= amount
+
+    self.records.append({ 'currency'          : currency,
+                          'account_id'        : account_id,
+                          'account_name'      : account_name,
+                          'broker_id'         : broker_id,
+                          'broker_name'       : broker_name,
+                          'payee_id'          : payee_id,
+                          'payee_name'        : payee_name,
+                          'payee_broker_id'   : payee_broker_id,
+                          'payee_broker_name' : payee_broker_name,
+                          'operation'         : operation,
+                          'amount'            : amount,
+                          'balance'           : self.get_balance(account_id, broker_id, currency),
+                          'reference'         : reference,
+                          'created'           : datetime.datetime.now(),
+                          'description'       : description })
+
+  def flush(self):
+    if not self.records:
+      return
+
+    now = datetime.datetime.now()
+    for key in self.keys:
+      account_id, broker_id, currency = key
+      delta, account_name, broker_name = self.deltas[key]
+      balance = self.get_balance(account_id, broker_id, currency)
+
+      if self.balances[key] is None:
+        self.session.add(Balance(account_id  = account_id,
+                                 account_name= account_name,
+                                 currency    = currency,
+                                 broker_id   = broker_id,
+                                 broker_name = broker_name,
+                                 balance     = balance,
+                                 last_update = now))
+      elif delta:
+        self.session.query(Balance).filter_by(account_id = account_id ).filter_by(broker_id = broker_id ).filter_by(currency = currency).update(
+          { Balance.balance: Balance.balance + delta, Balance.last_update: now }, synchronize_session='evaluate')
+
+      TradersRank.update_balance( account_id, account_name, broker_id, broker_name, currency, balance )
+      application.publish_balance_update( account_id, broker_id, currency, balance )
+
+    self.session.execute( Ledger.__table__.insert(), self.records )
+
+    self.balances = {}
+    self.deltas = {}
+    self.keys = []
+    self.records = []
 
 
 class Broker(Base):
@@ -1177,38 +1354,192 @@ class UserEmail(Base):
     session.add(user_email)
     session.flush()
 
+    user_email.publish()
+    return  user_email
+
+  def publish(self):
     user_msg = {
       'MsgType'       : 'C',
-      'EmailThreadID' : user_email.id,
-      'OrigTime'      : user_email.created,
-      'To'            : user_email.user.email,
-      'Subject'       : subject,
-      'Language'      : language,
+      'EmailThreadID' : self.id,
+      'OrigTime'      : self.created,
+      'To'            : self.user.email,
+      'Subject'       : self.subject,
+      'Language'      : self.language,
       'EmailType'     : '0',
       'RawDataLength' : 0,
       'RawData'       : '',
       'Template'      : '',
       'Params'        : '{}'
     }
-    application.publish( user_id, user_msg )
+    application.publish( self.user_id, user_msg )
 
     msg = deepcopy( user_msg )
 
-    if body:
-      msg['RawData'] = body
-      msg['RawDataLength'] = len(body)
+    if self.body:
+      msg['RawData'] = self.body
+      msg['RawDataLength'] = len(self.body)
 
-    if template:
-      msg['Template'] = template
+    if self.template:
+      msg['Template'] = self.template
 
-    if language:
-      msg['Language'] = language
-
-    if params:
-      msg['Params'] = params
+    if self.params:
+      msg['Params'] = self.params
 
     application.publish( 'EMAIL' , msg )
-    return  user_email
+
+
+class TradeNotification(Base):
+  """Trade executions waiting for their emails. They are written in the transaction of the trade and, once it
+  commits, turned into emails, one per execution, or one digest per user for every digest window"""
+  __tablename__   = 'trade_notifications'
+  id              = Column(Integer,       primary_key=True)
+  user_id         = Column(Integer,       ForeignKey('users.id'), nullable=False)
+  order_id        = Column(Integer,       nullable=False)
+  trade_id        = Column(Integer,       nullable=False)
+  executed_when   = Column(DateTime,      nullable=False)
+  symbol          = Column(String(12),    nullable=False)
+  qty             = Column(Integer,       nullable=False)
+  price           = Column(Integer,       nullable=False)
+  created         = Column(DateTime,      nullable=False, index=True)  # UTC, opens the digest window
+
+  # the table is only read at startup and when the oldest notification not yet sent is due
+  is_recording      = False
+  is_email_due      = True
+  pending_time      = None  # when the first notification committed since the last read was committed
+  next_digest_time  = None
+
+  def __repr__(self):
+    return u"<TradeNotification(id=%r, user_id=%r, order_id=%r, trade_id=%r, executed_when=%r, symbol=%r, qty=%r, price=%r, created=%r)>" % (
+      self.id, self.user_id, self.order_id, self.trade_id, self.executed_when, self.symbol, self.qty, self.price, self.created )
+
+  @staticmethod
+  def notify(session, user_id, order_id, trade_id, executed_when, symbol, qty, price):
+    session.add( TradeNotification( user_id       = user_id,
+                                    order_id      = order_id,
+                                    trade_id      = trade_id,
+                                    executed_when = executed_when,
+                                    symbol        = symbol,
+                                    qty           = qty,
+                                    price         = price,
+                                    created       = datetime.datetime.utcnow() ) )
+    TradeNotification.is_recording = True
+
+  @staticmethod
+  def on_commit():
+    if TradeNotification.is_recording and TradeNotification.pending_time is None:
+      TradeNotification.pending_time = time.time()
+    TradeNotification.is_recording = False
+
+  @staticmethod
+  def on_rollback():
+    TradeNotification.is_recording = False
+
+  @staticmethod
+  def get_next_email_time(digest_window):
+    if TradeNotification.is_email_due:
+      return time.time()
+
+    next_email_time = TradeNotification.next_digest_time
+    if TradeNotification.pending_time is not None:
+      pending_email_time = TradeNotification.pending_time + (digest_window or 0)
+      if next_email_time is None or pending_email_time < next_email_time:
+        next_email_time = pending_email_time
+    return next_email_time
+
+  def format_execution(self, session):
+    return {
+      'order_id': self.order_id,
+      'trade_id': self.trade_id,
+      'executed_when': self.executed_when,
+      'qty': Currency.format_number( session, self.symbol[:3], self.qty / 1.e8 ),
+      'price': Currency.format_number( session, self.symbol[3:], self.price / 1.e8 ),
+      'total': Currency.format_number( session, self.symbol[3:], self.qty/1.e8 * self.price / 1.e8 )
+    }
+
+  @staticmethod
+  def create_emails(session, digest_window, language):
+    """Creates the emails that are due and deletes their notifications, with a single flush. Only the due
+    notifications are read, see get_next_email_time. The caller commits.
+    Returns the number of notifications processed"""
+    TradeNotification.is_email_due = False
+    TradeNotification.pending_time = None
+    TradeNotification.next_digest_time = None
+
+    notifications = session.query(TradeNotification)
+    if digest_window:
+      # the digest of an user is due once his oldest notification is older than the window
+      due_before = datetime.datetime.utcnow() - datetime.timedelta(seconds=digest_window)
+      due_user_ids = session.query(TradeNotification.user_id).filter(TradeNotification.created <= due_before).distinct()
+      notifications = notifications.filter(TradeNotification.user_id.in_(due_user_ids))
+
+    notifications_by_user = {}
+    user_ids = []
+    notifications_to_send = []
+    for notification in notifications.order_by(TradeNotification.id):
+      if notification.user_id not in notifications_by_user:
+        notifications_by_user[notification.user_id] = []
+        user_ids.append(notification.user_id)
+      notifications_by_user[notification.user_id].append(notification)
+      if not digest_window:
+        notifications_to_send.append( (notification.user_id, [ notification ]) )
+
+    if digest_window:
+      for user_id in user_ids:
+        notifications_to_send.append( (user_id, notifications_by_user[user_id]) )
+
+    users = {}
+    if user_ids:
+      users = dict( (user.id, user) for user in session.query(User).filter(User.id.in_(user_ids)) )
+
+    user_emails = []
+    notification_ids = []
+    for user_id, notifications in notifications_to_send:
+      notification_ids.extend( notification.id for notification in notifications )
+
+      user = users.get(user_id)
+      if not user:
+        continue
+
+      if len(notifications) == 1:
+        template = 'order-execution'
+        params = notifications[0].format_execution(session)
+      else:
+        template = 'order-execution-digest'
+        # the email templates only have plain merge tags, so the list of executions goes in already rendered
+        execution_lines = []
+        for notification in notifications:
+          execution_lines.append( u'{order_id} / {trade_id} - {created:%Y-%m-%d %H:%M:%S} (UTC) - {qty} @ {price} = {total}'.format(
+            created=notification.created, **notification.format_execution(session) ) )
+        params = {
+          'count': len(notifications),
+          'executions': u'<br/>'.join(execution_lines)
+        }
+      params['username'] = user.username
+
+      user_emails.append( UserEmail( user_id  = user_id,
+                                     user     = user,
+                                     subject  = 'E',
+                                     template = template,
+                                     language = language,
+                                     params   = json.dumps(params, cls=JsonEncoder) ) )
+
+    if notification_ids:
+      session.query(TradeNotification).filter(TradeNotification.id.in_(notification_ids)).delete(synchronize_session=False)
+      session.add_all(user_emails)
+      session.flush()
+
+    if digest_window:
+      oldest_created = session.query(func.min(TradeNotification.created)).scalar()
+      if oldest_created is not None:
+        TradeNotification.next_digest_time = time.time() + digest_window - \
+            (datetime.datetime.utcnow() - oldest_created).total_seconds()
+
+    for user_email in user_emails:
+      user_email.publish()
+    return len(notification_ids)
+
+event.listen(SessionBase, 'after_commit', lambda session: TradeNotification.on_commit() )
+event.listen(SessionBase, 'after_rollback', lambda session: TradeNotification.on_rollback() )
 
 class Withdraw(Base):
   __tablename__   = 'withdraws'
@@ -1236,6 +1567,14 @@ class Withdraw(Base):
   fixed_fee       = Column(Integer,    nullable=False, default=0)
   paid_amount     = Column(Integer,    nullable=False, default=0, index=True)
 
+  SEARCH_ENTITY = 'W'
+  SEARCH_FIELDS = ('data', 'client_order_id')
+
+  def get_search_terms(self):
+    terms = SearchIndex.extract_terms( self.id, self.client_order_id, self.username )
+    terms.update( SearchIndex.extract_json_terms(self.data) )
+    return SearchIndex.extract_suffixes(terms)
+
   def as_dict(self):
     import json
     obj = { c.name: getattr(self, c.name) for c in self.__table__.columns if c.name != 'data' }
@@ -1393,7 +1732,7 @@ class Withdraw(Base):
 
 
   @staticmethod
-  def get_list(session, broker_id, account_id, status_list, page_size, offset, filter_array) :
+  def get_list(session, broker_id, account_id, status_list, page_size, offset, filter_array, cursor=None) :
     query = session.query(Withdraw).filter( Withdraw.status.in_( status_list ) ).filter(Withdraw.broker_id==broker_id)
 
     if account_id:
@@ -1401,23 +1740,17 @@ class Withdraw(Base):
 
     for filter in filter_array:
       if filter:
+        search_ids = SearchIndex.search(session, 'W', broker_id, filter, Integer)
         if filter.isdigit():
-          query = query.filter( or_( Withdraw.data.like('%' + filter + '%' ),
+          query = query.filter( or_( Withdraw.id.in_( search_ids ),
                                      Withdraw.currency == filter,
                                      Withdraw.amount == int(filter) * 1e8,
                                      ))
         else:
-          query = query.filter( or_( Withdraw.data.like('%' + filter + '%'),
+          query = query.filter( or_( Withdraw.id.in_( search_ids ),
                                      Withdraw.currency == filter ) )
 
-    query = query.order_by(Withdraw.created.desc())
-
-    if page_size:
-      query = query.limit(page_size)
-    if offset:
-      query = query.offset(offset)
-
-    return query
+    return page_query(query, Withdraw, page_size, offset, cursor)
 
   @staticmethod
   def create(session, user, broker,  currency, amount, method, data, client_order_id):
@@ -1478,7 +1811,7 @@ class Withdraw(Base):
       self.broker_username, self.data, self.percent_fee, self.fixed_fee,
       self.confirmation_token, self.status, self.created, self.reason_id, self.reason, self.paid_amount)
 
-class Order(Base):
+class Order(OrderMixin, Base):
   __tablename__   = 'orders'
 
   id              = Column(Integer,       primary_key=True)
@@ -1529,44 +1862,6 @@ class Order(Base):
                self.symbol, self.side, self.type, self.price,  self.order_qty, self.cum_qty, self.leaves_qty,
                self.created, self.last_price, self.cxl_qty , self.last_qty, self.status, self.average_price, self.fee)
 
-  def __cmp__(self, other):
-    if self.is_buy and other.is_buy:
-      if self.type == '1' and other.type == '2':
-        return -1
-      elif self.type == '1' and other.type == '1':
-        if self.created > other.created:
-          return -1
-        else:
-          return 1
-      elif self.price > other.price:
-        return -1
-      elif self.price < other.price:
-        return  1
-      #elif self.created > other.created:
-      #  return  -1
-      else:
-        return  0
-    elif self.is_sell and other.is_sell:
-      if self.price < other.price:
-        return -1
-      elif self.price > other.price:
-        return  1
-      #elif self.created < other.created:
-      #  return  -1
-      else:
-        return  0
-
-  def has_match(self, other):
-    if (self.is_buy and other.is_sell) or (self.is_sell and other.is_buy):
-      if ( self.type == '1' and other.type == '2') or (self.type == '2' and other.type == '1'):
-        return True  # if one of the orders is a market order
-
-    if self.is_buy and other.is_sell and self.price >= other.price:
-        return True
-    elif self.is_sell and other.is_buy and self.price <= other.price:
-        return True
-    return  False
-
   @staticmethod
   def create(session,user_id,account_id,user,username,account_user,account_username,broker_user,
              broker_username,client_order_id,symbol,side,type,price,order_qty, time_in_force, fee):
@@ -1600,36 +1895,23 @@ class Order(Base):
     return session.query(Order).filter(Order.status.in_( status_list  )).filter_by( id = order_id  ).first()
 
   @staticmethod
-  def get_list_by_user_id(session, status_list, user_id, page_size=None, offset=None ):
-    if not page_size:
-      return session.query(Order).filter(Order.status.in_(status_list)).filter_by( user_id = user_id ).order_by(Order.created.desc())
-    else:
-      return session.query(Order).filter(Order.status.in_(status_list)).filter_by( user_id = user_id ).order_by(Order.created.desc()).limit( page_size ).offset( offset )
+  def get_list_by_user_id(session, status_list, user_id, page_size=None, offset=None, cursor=None ):
+    query = session.query(Order).filter(Order.status.in_(status_list)).filter_by( user_id = user_id )
+    return page_query(query, Order, page_size, offset, cursor)
 
   @staticmethod
-  def get_list_by_account_id(session, status_list, user_id, page_size=None, offset=None ):
-    if not page_size:
-      return session.query(Order).filter(Order.status.in_(status_list)).filter_by( account_id = user_id ).order_by(Order.created.desc())
-    else:
-      return session.query(Order).filter(Order.status.in_(status_list)).filter_by( account_id = user_id ).order_by(Order.created.desc()).limit( page_size ).offset( offset )
-
-  def match(self, other, execute_qty):
-    if (self.is_buy and other.is_sell) or (self.is_sell and other.is_buy):
-      if ( self.type == '1' and other.type == '2') or (self.type == '2' and other.type == '1'):
-        return min( execute_qty, other.leaves_qty)
-
-    if self.is_buy and other.is_sell:
-      if self.price >= other.price:
-        return min( execute_qty, other.leaves_qty)
-    elif self.is_sell and other.is_buy:
-      if self.price <= other.price:
-        return min( execute_qty, other.leaves_qty)
-    return  0
-
-  def get_available_qty_to_execute(self, session, side, qty, price):
+  def get_list_by_account_id(session, status_list, user_id, page_size=None, offset=None, cursor=None ):
+    query = session.query(Order).filter(Order.status.in_(status_list)).filter_by( account_id = user_id )
+    return page_query(query, Order, page_size, offset, cursor)
+
+  def get_available_qty_to_execute(self, session, side, qty, price, postings=None):
     """This function returns qty that are available for execution"""
-    balance_price =  Balance.get_balance(session, self.account_id, self.broker_id, self.symbol[3:])
-    balance_qty   =  Balance.get_balance(session, self.account_id, self.broker_id, self.symbol[:3])
+    if postings:
+      balance_price =  postings.get_balance(self.account_id, self.broker_id, self.symbol[3:])
+      balance_qty   =  postings.get_balance(self.account_id, self.broker_id, self.symbol[:3])
+    else:
+      balance_price =  Balance.get_balance(session, self.account_id, self.broker_id, self.symbol[3:])
+      balance_qty   =  Balance.get_balance(session, self.account_id, self.broker_id, self.symbol[:3])
 
     if side == '1' : # buy
       qty_to_buy = min( qty, int((float(balance_price)/float(price)) * 1e8))
@@ -1639,51 +1921,6 @@ class Order(Base):
       return qty_to_sell
     return  qty
 
-  def cancel_qty(self, qty):
-    if qty == 0:
-      return
-    self.cxl_qty += qty
-    self.leaves_qty -= qty
-    self._adjust_status()
-
-  def _adjust_status(self):
-    if self.cum_qty == self.order_qty:
-      self.status = '2' # Fill
-    elif self.cum_qty + self.cxl_qty == self.order_qty :
-      self.status = '4' # Canceled
-    elif 0 < self.cum_qty < self.order_qty :
-      self.status = '1' # Partial fill
-    else:
-      self.status = '0' # New Order
-
-  def execute(self, qty, price ):
-    if qty == 0:
-      return
-
-    self.average_price = ((price * qty) + (self.cum_qty * self.average_price )) / ( self.cum_qty + qty )
-    self.cum_qty += qty
-    self.leaves_qty -= qty
-    self.last_price = price
-    self.last_qty = qty
-    self._adjust_status()
-
-  @property
-  def is_cancelled(self):
-    return self.status == '4'
-
-  @property
-  def has_leaves_qty(self):
-    return self.leaves_qty > 0
-
-
-  @property
-  def is_buy(self):
-    return self.side == '1'
-
-  @property
-  def is_sell(self):
-    return  self.side == '2'
-
 class Trade(Base):
   __tablename__     = 'trade'
   id                = Column(Integer,        primary_key=True)
@@ -1705,7 +1942,7 @@ class Trade(Base):
        self.side, self.symbol, self.size, self.price, self.created, self.trade_type)
 
   @staticmethod
-  def create(session, order,counter_order, symbol, size,price):
+  def create(session, order,counter_order, symbol, size,price, postings=None):
     buyer_username = order.account_user.username
     seller_username = counter_order.account_user.username
     if order.is_sell:
@@ -1725,13 +1962,15 @@ class Trade(Base):
                     created           = datetime.datetime.now())
     session.add(trade)
 
-    Ledger.execute_order(session, order, counter_order, symbol, size, price, str(order.id) + '.' + str(counter_order.id))
+    Ledger.execute_order(session, order, counter_order, symbol, size, price, str(order.id) + '.' + str(counter_order.id), postings)
 
     return trade
 
 
   @staticmethod
-  def get_last_trades(session, page_size = None, offset = None, sort_column = None, sort_order='ASC'):
+  def get_last_trades(session, page_size = None, offset = None, sort_column = None, sort_order='ASC', cursor=None):
+    if not sort_column:
+      return page_query(session.query(Trade), Trade, page_size, offset, cursor)
 
     trades = session.query(Trade).order_by(
         Trade.created.desc())
@@ -1780,6 +2019,14 @@ class Deposit(Base):
   reason_id               = Column(Integer)
   reason                  = Column(String)
 
+  SEARCH_ENTITY = 'D'
+  SEARCH_FIELDS = ('data', 'client_order_id', 'broker_deposit_ctrl_num')
+
+  def get_search_terms(self):
+    terms = SearchIndex.extract_terms( self.id, self.client_order_id, self.broker_deposit_ctrl_num, self.username )
+    terms.update( SearchIndex.extract_json_terms(self.data) )
+    return SearchIndex.extract_suffixes(terms)
+
   def __repr__(self):
     return u"<Deposit(id=%r, user_id=%r, account_id=%r, username=%r, broker_id=%r, deposit_option_id=%r, " \
            u"deposit_option_name=%r, broker_deposit_ctrl_num=%r," \
@@ -1827,7 +2074,7 @@ class Deposit(Base):
     return deposit
 
   @staticmethod
-  def get_list(session, broker_id, account_id, status_list, page_size, offset, filter_array=[]):
+  def get_list(session, broker_id, account_id, status_list, page_size, offset, filter_array=[], cursor=None):
     query = session.query(Deposit).filter( Deposit.status.in_( status_list ) ).filter(Deposit.broker_id==broker_id)
 
     if account_id:
@@ -1835,8 +2082,9 @@ class Deposit(Base):
 
     if filter_array:
       for filter in filter_array:
+        search_ids = SearchIndex.search(session, 'D', broker_id, filter)
         if filter.isdigit():
-          query = query.filter( or_( Deposit.data.like('%' + filter + '%' ),
+          query = query.filter( or_( Deposit.id.in_( search_ids ),
                                      Deposit.currency == filter,
                                      Deposit.deposit_option_name == filter,
                                      Deposit.value == int(filter) * 1e8,
@@ -1844,19 +2092,11 @@ class Deposit(Base):
                                      Deposit.broker_deposit_ctrl_num == int(filter),
                                      ))
         else:
-          query = query.filter( or_( Deposit.data.like('%' + filter + '%'),
+          query = query.filter( or_( Deposit.id.in_( search_ids ),
                                      Deposit.currency == filter,
                                      Deposit.deposit_option_name == filter ) )
 
-    query = query.order_by(Deposit.created.desc())
-
-    if page_size:
-      query = query.limit(page_size)
-    if offset:
-      query = query.offset(offset)
-
-
-    return query
+    return page_query(query, Deposit, page_size, offset, cursor)
 
 
   @staticmethod
@@ -2283,7 +2523,118 @@ class DepositMethods(Base):
 
     return deposit
 
+class SearchIndex(Base):
+  __tablename__   = 'search_index'
+  id              = Column(Integer,       primary_key=True)
+  entity          = Column(String(1),     nullable=False)  # D-Deposit, W-Withdraw, U-User
+  entity_id       = Column(String(32),    nullable=False, index=True)
+  broker_id       = Column(Integer)
+  term            = Column(String(255),   nullable=False)
+
+  __table_args__ = ( Index('idx_search_index_entity_broker_term', 'entity', 'broker_id', 'term'), )
+
+  MIN_TERM_LENGTH = 2
+  MAX_TERM_LENGTH = 255
+
+  def __repr__(self):
+    return u"<SearchIndex(id=%r, entity=%r, entity_id=%r, broker_id=%r, term=%r)>" % (
+      self.id, self.entity, self.entity_id, self.broker_id, self.term)
+
+  @staticmethod
+  def normalize_term(term):
+    if isinstance(term, bool) or term is None:
+      return None
+    if not isinstance(term, basestring):
+      term = unicode(term)
+    elif not isinstance(term, unicode):
+      term = term.decode('utf-8', 'ignore')
+    term = term.strip().lower()
+    if len(term) < SearchIndex.MIN_TERM_LENGTH or len(term) > SearchIndex.MAX_TERM_LENGTH:
+      return None
+    return term
+
+  @staticmethod
+  def extract_terms(*values):
+    terms = set()
+    for value in values:
+      if isinstance(value, dict):
+        terms.update( SearchIndex.extract_terms( *value.values() ) )
+      elif isinstance(value, (list, tuple)):
+        terms.update( SearchIndex.extract_terms( *value ) )
+      else:
+        term = SearchIndex.normalize_term(value)
+        if term:
+          terms.add(term)
+    return terms
+
+  @staticmethod
+  def extract_suffixes(terms):
+    # a prefix match over every suffix of a term is a substring match over the term
+    suffixes = set()
+    for term in terms:
+      suffixes.update( term[i:] for i in xrange(len(term)) )
+    return suffixes
+
+  @staticmethod
+  def extract_json_terms(raw_json):
+    try:
+      return SearchIndex.extract_terms( json.loads(raw_json) )
+    except (TypeError, ValueError):
+      return set()
+
+  @staticmethod
+  def search(session, entity, broker_id, term, id_type=String):
+    """Returns a subquery with the ids of the entities that have an indexed term starting with term"""
+    if not isinstance(term, unicode):
+      term = str(term).decode('utf-8', 'ignore')
+    term = term.replace('%', '').strip().lower()
+
+    query = session.query( cast(SearchIndex.entity_id, id_type) ).filter(SearchIndex.entity == entity)\
+                                                                 .filter(SearchIndex.broker_id == broker_id)
+    if not term:
+      return query.filter(SearchIndex.id == None).subquery()
+
+    # a range instead of LIKE 'term%' so the (entity, broker_id, term) index is used on every database
+    return query.filter(SearchIndex.term >= term)\
+                .filter(SearchIndex.term < term[:-1] + unichr(ord(term[-1]) + 1)).subquery()
+
+  @staticmethod
+  def index_terms(connection, entity, entity_id, broker_id, terms):
+    table = SearchIndex.__table__
+    connection.execute( table.delete().where( and_( table.c.entity == entity, table.c.entity_id == str(entity_id) ) ) )
+    if terms:
+      connection.execute( table.insert(), [ { 'entity': entity,
+                                              'entity_id': str(entity_id),
+                                              'broker_id': broker_id,
+                                              'term': term } for term in terms ] )
+
+  @staticmethod
+  def rebuild(session):
+    connection = session.connection()
+    connection.execute( SearchIndex.__table__.delete() )
+    for entity_class in (User, Deposit, Withdraw):
+      for record in session.query(entity_class):
+        SearchIndex.index_terms(connection, record.SEARCH_ENTITY, record.id, record.broker_id, record.get_search_terms())
+    session.commit()
+
+
+def _on_searchable_insert(mapper, connection, target):
+  SearchIndex.index_terms(connection, target.SEARCH_ENTITY, target.id, target.broker_id, target.get_search_terms())
+
+def _on_searchable_update(mapper, connection, target):
+  state = inspect(target)
+  for field in target.SEARCH_FIELDS:
+    if state.attrs[field].history.has_changes():
+      SearchIndex.index_terms(connection, target.SEARCH_ENTITY, target.id, target.broker_id, target.get_search_terms())
+      return
+
+for searchable_class in (User, Deposit, Withdraw):
+  event.listen(searchable_class, 'after_insert', _on_searchable_insert)
+  event.listen(searchable_class, 'after_update', _on_searchable_update)
+
+
 Base.metadata.create_all(engine)
 
 def db_bootstrap(session):
-  pass
+  if not session.query(exists().where(SearchIndex.id != None)).scalar():
+    SearchIndex.rebuild(session)
@@ -0,0 +1,38 @@
+import os
+import sys
+ROOT_PATH = os.path.abspath( os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'libs'))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'apps'))
+
+
+from tornado.options import define, options
+import tornado
+
+define("query_in", help="zmq query service input queue")
+define("query_log", help="logging" )
+define("query_log_format", default="text", help="text or binary replay log format")
+define("query_db_engine",  help="SQLAlchemy database engine string used by the query service, usually a read replica. Defaults to db_engine")
+define("db_echo", default=False,help="Prints every database command on the stdout" )
+define("db_engine",  help="SQLAlchemy database engine string")
+define("test_mode", default=False, help="Test mode")
+define("satoshi_mode", default=False, help="Satoshi mode")
+define("dev_mode", default=False, help="Dev mode")
+define("global_email_language", help="template email language")
+
+define("config", help="config file", callback=lambda path: tornado.options.parse_config_file(path, final=False))
+
+from trade_application import application
+
+def main():
+  tornado.options.parse_command_line()
+  if not options.query_in or \
+     not options.query_log or \
+     not options.db_engine:
+    tornado.options.print_help()
+    return
+
+  application.initialize_query_service()
+  application.run_query_service()
+
+if __name__ == "__main__":
+  main()
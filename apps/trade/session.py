@@ -54,9 +54,18 @@ class Session(object):
     elif msg.type == 'D':  # New Order Single
       return processNewOrderSingle(self, msg)
 
+    elif msg.type == 'E':  # New Order List
+      return processNewOrderList(self, msg)
+
     elif  msg.type == 'F' : # Cancel Order Request
       return processCancelOrderRequest(self, msg)
 
+    elif  msg.type == 'G' : # Order Cancel Replace Request
+      return processOrderCancelReplaceRequest(self, msg)
+
+    elif  msg.type == 'q' : # Order Mass Cancel Request
+      return processOrderMassCancelRequest(self, msg)
+
     elif msg.type == 'x': # Security List Request
       return processSecurityListRequest(self, msg)
 
@@ -134,4 +143,16 @@ class Session(object):
 
     elif msg.type == 'A0':  # Request Query in Database
       return processRequestDatabaseQuery(self, msg)
+
+    elif msg.type == 'A2':  # Trace Stats Request
+      return processTraceStatsRequest(self, msg)
+
+    elif msg.type == 'A4':  # Engine Metrics Request
+      return processEngineMetricsRequest(self, msg)
+
+    elif msg.type == 'A6':  # Profiler Request
+      return processProfilerRequest(self, msg)
+
+    elif msg.type == 'A8':  # Memory Request
+      return processMemoryRequest(self, msg)
     raise InvalidMessageError()
@@ -0,0 +1,89 @@
+import json
+import unittest
+
+import message_scheduler
+from message_scheduler import MessageScheduler, get_message_class, ORDER_ENTRY, DEFAULT, QUERY
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 1000.
+
+  def time(self):
+    return self.now
+
+def raw_message(msg_type, req_id):
+  return 'REQ,SESSIONID0123456789,' + json.dumps({'MsgType': msg_type, 'ReqID': req_id})
+
+class TestMessageScheduler(unittest.TestCase):
+  def setUp(self):
+    self.clock = FakeClock()
+    self.real_time = message_scheduler.time
+    message_scheduler.time = self.clock
+
+  def tearDown(self):
+    message_scheduler.time = self.real_time
+
+  def push(self, scheduler, msg_type, req_id, waited_ms=0):
+    self.clock.now -= waited_ms / 1000.
+    scheduler.push(req_id, raw_message(msg_type, req_id))
+    self.clock.now += waited_ms / 1000.
+
+  def pop_all(self, scheduler):
+    served = []
+    while scheduler.has_pending():
+      served.append(scheduler.pop()[0])
+    return served
+
+  def test_message_classes(self):
+    self.assertEqual(ORDER_ENTRY, get_message_class(raw_message('D', 1)))
+    self.assertEqual(ORDER_ENTRY, get_message_class(raw_message('F', 1)))
+    self.assertEqual(QUERY, get_message_class(raw_message('U4', 1)))
+    self.assertEqual(DEFAULT, get_message_class(raw_message('BE', 1)))
+    self.assertEqual(DEFAULT, get_message_class('REQ,SESSIONID0123456789,'))
+
+  def test_classes_are_served_by_priority(self):
+    scheduler = MessageScheduler()
+    self.push(scheduler, 'U4', 'query')
+    self.push(scheduler, 'BE', 'default')
+    self.push(scheduler, 'D', 'order_entry_1')
+    self.push(scheduler, 'F', 'order_entry_2')
+
+    self.assertEqual(['order_entry_1', 'order_entry_2', 'default', 'query'], self.pop_all(scheduler))
+    self.assertEqual(None, scheduler.pop())
+
+  def test_latency_budgets(self):
+    scheduler = MessageScheduler({ORDER_ENTRY: 1, QUERY: 20})
+    self.assertEqual(0.001, scheduler.latency_budget[ORDER_ENTRY])
+    self.assertEqual(0.05, scheduler.latency_budget[DEFAULT])
+    self.assertEqual(0.02, scheduler.latency_budget[QUERY])
+
+    # a query within its budget waits for the order entry
+    self.push(scheduler, 'U4', 'query', waited_ms=19)
+    self.push(scheduler, 'D', 'order_entry')
+    self.assertEqual(['order_entry', 'query'], self.pop_all(scheduler))
+
+    # a query over its budget goes first
+    self.push(scheduler, 'U4', 'query', waited_ms=21)
+    self.push(scheduler, 'D', 'order_entry')
+    self.assertEqual(['query', 'order_entry'], self.pop_all(scheduler))
+
+  def test_oldest_overdue_first_when_a_class_is_starved(self):
+    scheduler = MessageScheduler()
+    self.push(scheduler, 'BE', 'default', waited_ms=60)
+    self.push(scheduler, 'U4', 'query', waited_ms=600)
+    self.push(scheduler, 'D', 'order_entry_overdue', waited_ms=10)
+    self.push(scheduler, 'D', 'order_entry')
+
+    self.assertEqual(['query', 'default', 'order_entry_overdue', 'order_entry'], self.pop_all(scheduler))
+
+  def test_pop_returns_the_enqueued_time(self):
+    scheduler = MessageScheduler()
+    self.push(scheduler, 'D', 'order_entry', waited_ms=3)
+    identity, message, enqueued_time = scheduler.pop()
+    self.assertEqual('order_entry', identity)
+    self.assertEqual(raw_message('D', 'order_entry'), message)
+    self.assertAlmostEqual(self.clock.now - 0.003, enqueued_time)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -3,14 +3,25 @@ import zmq
 import time
 import datetime
 import traceback
+import threading
+from collections import deque
 
 from tornado.options import  options
 
 from sqlalchemy.orm import scoped_session, sessionmaker
 import json
 from bitex.json_encoder import JsonEncoder
+from bitex.utils import encode_cursor
+from bitex.histogram import StageHistograms
+from bitex.profiler import SamplingProfiler
+from bitex.memory import HeapSnapshots
+from bitex.message import JsonMessage, InvalidMessageException, QUERY_SERVICE_MESSAGE_TYPES
 
 from errors import *
+from metrics import TradeMetrics
+
+# stamps of a traced request, in the order they happen. GatewayForward is stamped by the gateway, before sending it
+ENGINE_TRACE_STAMPS = ( 'GatewayForward', 'EngineReceive', 'EngineDequeue', 'Match', 'Commit', 'Reply', 'Publish' )
 
 class TradeApplication(object):
 
@@ -22,23 +33,87 @@ class TradeApplication(object):
 
   def initialize(self):
     self.publish_queue = []
+    self.balance_updates = {}
     self.options = options
+    self.metrics = TradeMetrics()
+    self.metrics_dump_time = time.time() + self.options.trade_metrics_interval
+    self.profiler = SamplingProfiler('trade', self.options.trade_profile_dir)
+    self.heap_snapshots = HeapSnapshots()
+
+    # requests carrying a Trace field are stamped at every stage and recorded once they are published
+    self.trace = None
+    self.trace_stages = StageHistograms()
 
-    from models import engine, db_bootstrap
+    from models import engine, db_bootstrap, TradersRank
     self.db_session = scoped_session(sessionmaker(bind=engine))
     db_bootstrap(self.db_session)
 
+    from sqlalchemy import event
+    from sqlalchemy.orm.session import Session as SessionBase
+    event.listen(SessionBase, 'before_commit', self.on_before_commit)
+    event.listen(SessionBase, 'after_commit', self.on_after_commit)
+    event.listen(engine, 'before_cursor_execute', self.on_before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', self.on_after_cursor_execute)
+
+    TradersRank.load(self.db_session)
+    self.persist_traders_rank()
+
     from session_manager import SessionManager
     self.session_manager = SessionManager(timeout_limit=self.options.session_timeout_limit)
 
+    from message_scheduler import MessageScheduler
+    self.scheduler = MessageScheduler(self.options.message_latency_budget)
+
     self.context = zmq.Context()
-    self.input_socket = self.context.socket(zmq.REP)
+    self.input_socket = self.context.socket(zmq.ROUTER)
     self.input_socket.bind(self.options.trade_in)
 
     self.publisher_socket = self.context.socket(zmq.PUB)
     self.publisher_socket.bind(self.options.trade_pub)
 
-    input_log_file_handler = logging.handlers.TimedRotatingFileHandler( self.options.trade_log, when='MIDNIGHT')
+    self.initialize_replay_logger(self.options.trade_log, self.options.trade_log_format)
+
+    # the publications are serialized, logged and sent by the publisher thread, the only one using the publisher_socket
+    self.publish_pipeline = deque()
+    self.publish_pipeline_event = threading.Event()
+    self.publisher_thread = threading.Thread(target=self.run_publisher, name='publisher')
+    self.publisher_thread.daemon = True
+    self.publisher_thread.start()
+
+    self.log_start_data()
+
+  def initialize_query_service(self):
+    self.publish_queue = []
+    self.balance_updates = {}
+    self.options = options
+    self.metrics = TradeMetrics()
+
+    from sqlalchemy import create_engine
+    query_engine = create_engine( self.options.query_db_engine or self.options.db_engine, echo=self.options.db_echo)
+    self.db_session = scoped_session(sessionmaker(bind=query_engine, autoflush=False))
+
+    self.context = zmq.Context()
+    self.input_socket = self.context.socket(zmq.REP)
+    self.input_socket.bind(self.options.query_in)
+
+    self.initialize_replay_logger(self.options.query_log, self.options.query_log_format)
+
+    self.log('PARAM','BEGIN')
+    self.log('PARAM','query_in'              ,self.options.query_in)
+    self.log('PARAM','query_log'             ,self.options.query_log)
+    self.log('PARAM','query_db_engine'       ,self.options.query_db_engine)
+    self.log('PARAM','db_engine'             ,self.options.db_engine)
+    self.log('PARAM','END')
+
+  def initialize_replay_logger(self, filename, log_format='text'):
+    self.replay_log_writer = None
+    if log_format == 'binary':
+      from bitex.replay_log import ReplayLogWriter
+      self.replay_log_writer = ReplayLogWriter(filename)
+      self.replay_log_writer.info('START')
+      return
+
+    input_log_file_handler = logging.handlers.TimedRotatingFileHandler( filename, when='MIDNIGHT')
     formatter = logging.Formatter('%(asctime)s - %(message)s')
     input_log_file_handler.setFormatter(formatter)
 
@@ -47,11 +122,17 @@ class TradeApplication(object):
     self.replay_logger.addHandler(input_log_file_handler)
     self.replay_logger.info('START')
 
-    self.log_start_data()
 
+  def log(self, command, key, value=None):
+    start = time.time()
+    self.write_log(command, key, value)
+    self.metrics.add_phase_time('log', time.time() - start)
 
+  def write_log(self, command, key, value=None):
+    if self.replay_log_writer:
+      self.replay_log_writer.log(command, key, value)
+      return
 
-  def log(self, command, key, value=None):
     log_msg = command + ',' + key
     if value:
       try:
@@ -72,6 +153,7 @@ class TradeApplication(object):
     self.log('PARAM','trade_in'              ,self.options.trade_in)
     self.log('PARAM','trade_pub'             ,self.options.trade_pub)
     self.log('PARAM','trade_log'             ,self.options.trade_log)
+    self.log('PARAM','trade_log_format'      ,self.options.trade_log_format)
     self.log('PARAM','session_timeout_limit' ,self.options.session_timeout_limit)
     self.log('PARAM','db_echo'               ,self.options.db_echo)
     self.log('PARAM','db_engine'             ,self.options.db_engine)
@@ -80,6 +162,11 @@ class TradeApplication(object):
     self.log('PARAM','satoshi_mode'          ,self.options.satoshi_mode)
     self.log('PARAM','global_email_language' ,self.options.global_email_language)
     self.log('PARAM','verification_bonus'    ,self.options.verification_bonus)
+    self.log('PARAM','message_latency_budget',self.options.message_latency_budget)
+    self.log('PARAM','traders_rank_persist_interval',self.options.traders_rank_persist_interval)
+    self.log('PARAM','trade_metrics_file'    ,self.options.trade_metrics_file)
+    self.log('PARAM','trade_metrics_interval',self.options.trade_metrics_interval)
+    self.log('PARAM','trade_profile_dir'     ,self.options.trade_profile_dir)
     self.log('PARAM','END')
 
 
@@ -127,113 +214,393 @@ class TradeApplication(object):
   def publish(self, key, data):
     self.publish_queue.append([ key, data ])
 
-  def run(self):
-    from bitex.message import JsonMessage, InvalidMessageException
-    from market_data_publisher import MarketDataPublisher
-    from execution import OrderMatcher
+  def publish_balance_update(self, account_id, broker_id, currency, balance):
+    # all the balance changes of an account within a request go out as a single U3 carrying the final balances,
+    # queued in the position of the first change.
+    balance_update_msg = self.balance_updates.get(account_id)
+    if balance_update_msg is None:
+      balance_update_msg = dict()
+      balance_update_msg['MsgType'] = 'U3'
+      balance_update_msg['ClientID'] = account_id
+      self.balance_updates[account_id] = balance_update_msg
+      self.publish( account_id, balance_update_msg )
+
+    balance_update_msg.setdefault(broker_id, {})[currency] = balance
+
+  def load_order_book(self, symbols=None):
+    """ matches the open orders of the database. The books of the given symbols are discarded and loaded again """
+    from execution import OrderMatcher, matcher_dict
     from models import Order
 
     orders = self.db_session.query(Order).filter(Order.status.in_(("0", "1"))).order_by(Order.created)
+    if symbols is not None:
+      for symbol in symbols:
+        matcher_dict.pop(symbol, None)
+      orders = orders.filter(Order.symbol.in_(symbols))
+
     for order in orders:
       OrderMatcher.get( order.symbol  ).match(self.db_session, order)
 
+  def run(self):
+    self.load_order_book()
+
     while True:
-      raw_message = self.input_socket.recv()
+      self.receive_messages(block=not self.scheduler.has_pending(), timeout=self.get_poll_timeout())
+
+      if self.scheduler.has_pending():
+        identity, raw_message, receive_time = self.scheduler.pop()
+        response_message = self.process_message(raw_message, receive_time)
+
+        # send the response
+        if isinstance(response_message, unicode):
+          response_message = response_message.encode('utf-8')
+        self.input_socket.send_multipart( [ identity, '', response_message ] )
+        self.stamp_trace('Reply')
+
+      self.process_trade_emails()
+
+      self.flush_publish_queue()
 
-      msg_header              = raw_message[:3]
-      session_id              = raw_message[4:20]
-      json_raw_message        = raw_message[21:].strip()
+      if time.time() > self.traders_rank_persist_time:
+        self.persist_traders_rank()
 
+      if time.time() > self.metrics_dump_time:
+        self.dump_metrics()
+
+      if self.profiler.is_expired():
+        self.stop_profiler()
+
+  def get_poll_timeout(self):
+    timeout = self.get_trade_emails_timeout()
+    if self.options.trade_metrics_file:
+      metrics_timeout = max(0, self.metrics_dump_time - time.time())
+      if timeout is None or metrics_timeout < timeout:
+        timeout = metrics_timeout
+    profiler_timeout = self.profiler.get_timeout()
+    if profiler_timeout is not None and (timeout is None or profiler_timeout < timeout):
+      timeout = profiler_timeout
+    return timeout
+
+  def dump_metrics(self):
+    if self.options.trade_metrics_file:
       try:
-        msg = None
-        if json_raw_message:
-          try:
-            msg = JsonMessage(json_raw_message)
-          except InvalidMessageException, e:
-            self.log('IN', 'TRADE_IN_REQ_ERROR',  raw_message)
-            raise InvalidMessageError()
-
-          # never write passwords in the log file
-          if msg.has('Password'):
-            raw_message = raw_message.replace(msg.get('Password'), '*')
-          if msg.has('NewPassword'):
-            raw_message = raw_message.replace(msg.get('NewPassword'), '*')
-
-        self.log('IN', 'TRADE_IN_REQ' ,raw_message )
-
-        if msg:
-          if msg.isMarketDataRequest(): # Market Data Request
-            req_id = msg.get('MDReqID')
-            market_depth = msg.get('MarketDepth')
-            instruments = msg.get('Instruments')
-            entries = msg.get('MDEntryTypes')
-            transact_time = msg.get('TransactTime')
-
-            timestamp = None
-            if transact_time:
-              timestamp = transact_time
-            else:
-              trade_date = msg.get('TradeDate')
-              if not trade_date:
-                trade_date = time.strftime("%Y%m%d", time.localtime())
-
-              self.log('OUT', 'TRADEDATE', trade_date)
-              timestamp = datetime.datetime.strptime(trade_date, "%Y%m%d")
-
-            self.log('OUT', 'TIMESTAMP', timestamp )
-            
-            if len(instruments) > 1:
-              raise  InvalidMessageError()
-
-            instrument = instruments[0]
-
-            om = OrderMatcher.get(instrument)
-            response_message = MarketDataPublisher.generate_md_full_refresh( application.db_session, instrument, market_depth, om, entries, req_id, timestamp )
-            response_message = 'REP,' + json.dumps( response_message , cls=JsonEncoder)
-          elif msg.isTradeHistoryRequest():
-
-              page        = msg.get('Page', 0)
-              page_size   = msg.get('PageSize', 100)
-              offset      = page * page_size
-
-              columns = [ 'TradeID'           , 'Market',  'Side', 'Price', 'Size',
-                          'Buyer'             , 'Seller', 'Created' ]
-
-              trade_list = MarketDataPublisher.generate_trade_history(application.db_session, page_size, offset )
-
-              response_message = 'REP,' + json.dumps( {
-                  'MsgType'           : 'U33', # TradeHistoryResponse
-                  'TradeHistoryReqID' : -1,
-                  'Page'              : page,
-                  'PageSize'          : page_size,
-                  'Columns'           : columns,
-                  'TradeHistoryGrp'   : trade_list
-              }, cls=JsonEncoder )
+        self.metrics.dump(self, self.options.trade_metrics_file)
+      except Exception:
+        traceback.print_exc()
+    self.metrics_dump_time = time.time() + self.options.trade_metrics_interval
+
+  def stop_profiler(self):
+    try:
+      status = self.profiler.stop()
+      self.log('OUT', 'TRADE_PROFILE', json.dumps(status, cls=JsonEncoder))
+    except Exception:
+      traceback.print_exc()
+
+  def get_memory_structures(self):
+    from models import Broker, Currency, TradersRank
+    from execution import matcher_dict
+
+    structures = {
+      'Sessions'                    : self.session_manager.sessions,
+      'IdentityMap'                 : self.db_session().identity_map,
+      'Broker.mem_cache'            : Broker.mem_cache,
+      'Currency.format_python_cache': Currency.format_python_cache,
+      'TradersRank.rank_books'      : TradersRank.rank_books,
+      'TradersRank.pending_updates' : TradersRank.pending_updates,
+      'PendingRequests'             : self.scheduler.queues,
+      'PublishPipeline'             : self.publish_pipeline
+    }
+    for symbol, order_matcher in matcher_dict.items():
+      structures['Books.' + symbol + '.Bids'] = order_matcher.buy_side
+      structures['Books.' + symbol + '.Asks'] = order_matcher.sell_side
+    return structures
+
+  def persist_traders_rank(self):
+    from models import TradersRank
+    try:
+      TradersRank.persist(self.db_session)
+    except Exception:
+      traceback.print_exc()
+      self.db_session.rollback()
+    self.traders_rank_persist_time = time.time() + self.options.traders_rank_persist_interval
+
+  def get_trade_emails_timeout(self):
+    from models import TradeNotification
+    next_email_time = TradeNotification.get_next_email_time(self.options.trade_email_digest_window)
+    if next_email_time is None:
+      return None
+    return max(0, next_email_time - time.time())
+
+  def process_trade_emails(self):
+    from models import TradeNotification
+    next_email_time = TradeNotification.get_next_email_time(self.options.trade_email_digest_window)
+    if next_email_time is None or next_email_time > time.time():
+      return
+
+    try:
+      TradeNotification.create_emails(self.db_session,
+                                      self.options.trade_email_digest_window,
+                                      self.options.global_email_language)
+      self.db_session.commit() # also ends the read transaction when nothing was due
+    except Exception:
+      traceback.print_exc()
+      self.db_session.rollback()
+
+  def receive_messages(self, block, timeout=None):
+    # the input socket is a ROUTER, so every request waiting on it can be read before we reply to any of them
+    # and the scheduler decides which one is served first.
+    if block and timeout is not None and not self.input_socket.poll(timeout * 1000):
+      return
+    flags = 0 if block else zmq.NOBLOCK
+    while True:
+      try:
+        frames = self.input_socket.recv_multipart(flags)
+      except zmq.Again:
+        return
+      self.scheduler.push( frames[0], frames[-1] )
+      flags = zmq.NOBLOCK
+
+  def start_trace(self, msg, receive_time):
+    trace = msg.get('Trace')
+    if not isinstance(trace, dict):
+      self.trace = None
+      return
+    self.trace = dict(trace)
+    self.trace['MsgType'] = msg.type
+    if receive_time:
+      self.trace['EngineReceive'] = receive_time
+    self.trace['EngineDequeue'] = time.time()
+
+  def on_before_commit(self, session):
+    self.commit_start_time = time.time()
+
+  def on_after_commit(self, session):
+    self.metrics.add_phase_time('commit', time.time() - self.commit_start_time)
+    self.stamp_trace('Commit')
+
+  def on_before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+    self.sql_start_time = time.time()
+
+  def on_after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+    self.metrics.add_phase_time('sql', time.time() - self.sql_start_time)
+
+  def stamp_trace(self, stamp):
+    # only the first time, the commits of the trade emails must not move the commit of the request
+    if self.trace is not None and stamp not in self.trace:
+      self.trace[stamp] = time.time()
+
+  def process_message(self, raw_message, receive_time=None):
+    from market_data_publisher import MarketDataPublisher
+    from execution import OrderMatcher
+
+    self.trace = None
+    self.metrics.start_request()
+    start_time = time.time()
+
+    msg_header              = raw_message[:3]
+    session_id              = raw_message[4:20]
+    json_raw_message        = raw_message[21:].strip()
 
+    try:
+      msg = None
+      if json_raw_message:
+        try:
+          msg = JsonMessage(json_raw_message)
+        except (InvalidMessageException, ValueError), e:
+          # every request must be in the replay log
+          self.log('IN', 'TRADE_IN_REQ_ERROR',  raw_message)
+          raise InvalidMessageError()
+
+        # never write passwords in the log file
+        if msg.has('Password'):
+          raw_message = raw_message.replace(msg.get('Password'), '*')
+        if msg.has('NewPassword'):
+          raw_message = raw_message.replace(msg.get('NewPassword'), '*')
+
+      self.log('IN', 'TRADE_IN_REQ' ,raw_message )
+
+      if msg:
+        self.profiler.set_tag(msg.type)
+        if msg.has('Trace'):
+          self.start_trace(msg, receive_time)
+
+        if msg.isMarketDataRequest(): # Market Data Request
+          req_id = msg.get('MDReqID')
+          market_depth = msg.get('MarketDepth')
+          instruments = msg.get('Instruments')
+          entries = msg.get('MDEntryTypes')
+          transact_time = msg.get('TransactTime')
+
+          timestamp = None
+          if transact_time:
+            timestamp = transact_time
           else:
-            response_message = self.session_manager.process_message( msg_header, session_id, msg )
+            trade_date = msg.get('TradeDate')
+            if not trade_date:
+              trade_date = time.strftime("%Y%m%d", time.localtime())
+
+            self.log('OUT', 'TRADEDATE', trade_date)
+            timestamp = datetime.datetime.strptime(trade_date, "%Y%m%d")
+
+          self.log('OUT', 'TIMESTAMP', timestamp )
+
+          if len(instruments) > 1:
+            raise  InvalidMessageError()
+
+          instrument = instruments[0]
+
+          om = OrderMatcher.get(instrument)
+          response_message = MarketDataPublisher.generate_md_full_refresh( self.db_session, instrument, market_depth, om, entries, req_id, timestamp )
+          response_message = 'REP,' + json.dumps( response_message , cls=JsonEncoder)
+        elif msg.isTradeHistoryRequest():
+          response_message = 'REP,' + self.process_trade_history_request(msg)
         else:
           response_message = self.session_manager.process_message( msg_header, session_id, msg )
+      else:
+        response_message = self.session_manager.process_message( msg_header, session_id, msg )
 
-      except TradeRuntimeError, e:
-        self.db_session.rollback()
-        self.session_manager.close_session(session_id)
-        response_message = 'ERR,{"MsgType":"ERROR", "Description":"' + e.error_description.replace("'", "") + '", "Detail": ""}'
+    except TradeRuntimeError, e:
+      self.db_session.rollback()
+      self.session_manager.close_session(session_id)
+      response_message = 'ERR,{"MsgType":"ERROR", "Description":"' + e.error_description.replace("'", "") + '", "Detail": ""}'
 
-      except Exception,e:
-        traceback.print_exc()
-        self.db_session.rollback()
-        self.session_manager.close_session(session_id)
-        response_message = 'ERR,{"MsgType":"ERROR", "Description":"Unknow error", "Detail": "'  + str(e) + '"}'
+    except Exception,e:
+      traceback.print_exc()
+      self.db_session.rollback()
+      self.session_manager.close_session(session_id)
+      response_message = 'ERR,{"MsgType":"ERROR", "Description":"Unknow error", "Detail": "'  + str(e) + '"}'
+
+    self.log('OUT', 'TRADE_IN_REP', response_message )
+
+    self.metrics.end_request(msg.type if msg else msg_header,
+                             time.time() - start_time,
+                             response_message.startswith('ERR'))
+    self.profiler.set_tag(None)
+    return response_message
+
+  def process_trade_history_request(self, msg):
+    from market_data_publisher import MarketDataPublisher
+
+    page        = msg.get('Page', 0)
+    page_size   = msg.get('PageSize', 100)
+    cursor      = msg.get('Cursor')
+    offset      = page * page_size
+
+    columns = [ 'TradeID'           , 'Market',  'Side', 'Price', 'Size',
+                'Buyer'             , 'Seller', 'Created' ]
+
+    trade_list = MarketDataPublisher.generate_trade_history(self.db_session, page_size, offset, cursor=cursor )
+
+    next_cursor = None
+    if page_size and len(trade_list) == page_size:
+      next_cursor = encode_cursor( trade_list[-1][7], trade_list[-1][0] )
 
-      # send the response
-      self.log('OUT', 'TRADE_IN_REP', response_message )
+    return json.dumps( {
+        'MsgType'           : 'U33', # TradeHistoryResponse
+        'TradeHistoryReqID' : -1,
+        'Page'              : page,
+        'PageSize'          : page_size,
+        'NextCursor'        : next_cursor,
+        'Columns'           : columns,
+        'TradeHistoryGrp'   : trade_list
+    }, cls=JsonEncoder )
+
+  def run_query_service(self):
+    while True:
+      raw_message = self.input_socket.recv()
+      response_message = self.process_query_message(raw_message)
       self.input_socket.send_unicode(response_message)
 
-      # publish all publications
-      for key, message in self.publish_queue:
-        self.log('OUT', 'TRADE_PUB', str([key, message]) )
-        self.publisher_socket.send_multipart( [str(key),  json.dumps(message, cls=JsonEncoder)] )
-      self.publish_queue = []
+  def process_query_message(self, raw_message):
+    from session import Session
+    from models import User
+
+    try:
+      msg_header, user_id, json_raw_message = raw_message.split(',', 2)
+    except ValueError:
+      msg_header, user_id, json_raw_message = None, None, None
+
+    self.log('IN', 'QUERY_IN_REQ' ,raw_message )
+
+    try:
+      if msg_header != 'QRY':
+        raise InvalidOptCodeError()
+
+      try:
+        msg = JsonMessage(json_raw_message)
+      except InvalidMessageException, e:
+        raise InvalidMessageError()
+
+      if msg.type not in QUERY_SERVICE_MESSAGE_TYPES:
+        raise InvalidMessageError()
+
+      if msg.isTradeHistoryRequest():
+        response_message = 'REP,' + self.process_trade_history_request(msg)
+      else:
+        # a new session for every request, so the changes to the user are always seen
+        session = Session( 'QRY' + user_id )
+        if user_id:
+          session.set_user( User.get_user(self.db_session, user_id=int(user_id)) )
+
+        response_message = 'REP,' + session.process_message(msg)
+
+    except TradeRuntimeError, e:
+      response_message = 'ERR,{"MsgType":"ERROR", "Description":"' + e.error_description.replace("'", "") + '", "Detail": ""}'
+
+    except Exception,e:
+      traceback.print_exc()
+      response_message = 'ERR,{"MsgType":"ERROR", "Description":"Unknow error", "Detail": "'  + str(e) + '"}'
+
+    # never hold a read transaction open between requests, it would block the trade engine writes on sqlite
+    self.db_session.rollback()
+    self.publish_queue = []
+    self.balance_updates = {}
+
+    self.log('OUT', 'QUERY_IN_REP', response_message )
+    return response_message
+
+  def flush_publish_queue(self):
+    if self.publish_queue or self.trace:
+      self.publish_pipeline.append( (self.publish_queue, self.trace) )
+      self.publish_pipeline_event.set()
+    self.publish_queue = []
+    self.balance_updates = {}
+    self.trace = None
+
+  def run_publisher(self):
+    while True:
+      self.publish_pipeline_event.wait()
+      self.publish_pipeline_event.clear()
+      while self.publish_pipeline:
+        publish_queue, trace = self.publish_pipeline.popleft()
+        try:
+          start_time = time.time()
+          self.send_publications(publish_queue)
+          self.metrics.record_phase('publish', time.time() - start_time)
+          if trace:
+            self.record_trace(trace)
+        except Exception:
+          traceback.print_exc()
+
+  def record_trace(self, trace):
+    trace['Publish'] = time.time()
+    self.trace_stages.record_trace(trace, ENGINE_TRACE_STAMPS)
+    self.write_log('OUT', 'TRADE_TRACE', json.dumps(trace) )
+
+  def send_publications(self, publish_queue):
+    # the messages of a request that share a topic go out as a single multipart message, one json frame each
+    topics = []
+    frames_by_topic = {}
+    for key, message in publish_queue:
+      self.write_log('OUT', 'TRADE_PUB', str([key, message]) )
+
+      topic = str(key)
+      if topic not in frames_by_topic:
+        frames_by_topic[topic] = [ topic ]
+        topics.append(topic)
+      frames_by_topic[topic].append( json.dumps(message, cls=JsonEncoder) )
+
+    for topic in topics:
+      self.publisher_socket.send_multipart( frames_by_topic[topic] )
 
 application = TradeApplication.instance()
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import time
 import datetime
 from bitex.message import JsonMessage
 from bitex.json_encoder import  JsonEncoder
@@ -9,9 +10,9 @@ import json
 
 from models import  User, Order, UserPasswordReset, Deposit, DepositMethods, \
   NeedSecondFactorException, UserAlreadyExistsException, BrokerDoesNotExistsException, \
-  Withdraw, Broker, Instrument, Currency, Balance, Ledger, Position, PositionLedger, TrustedAddress
+  Withdraw, Broker, Instrument, Currency, Balance, Ledger, Position, PositionLedger, TrustedAddress, TradersRank, get_next_cursor
 
-from execution import OrderMatcher
+from execution import OrderMatcher, matcher_dict
 
 from decorators import *
 
@@ -188,8 +189,7 @@ def processLogin(session, msg):
   }
   return json.dumps(login_response, cls=JsonEncoder)
 
-@login_required
-def processNewOrderSingle(session, msg):
+def createOrderFromMessage(session, msg):
   from errors import NotAuthorizedError, InvalidClientIDError
 
   if msg.has('ClientID') and not session.user.is_broker:
@@ -277,7 +277,7 @@ def processNewOrderSingle(session, msg):
   # process the new order.
   order = Order.create(application.db_session,
                        user_id          = session.user.id,
-                       account_id       = msg.get('ClientID', account_id ),
+                       account_id       = account_id,
                        user             = session.user,
                        username         = session.user.username,
                        account_user     = account_user,
@@ -292,42 +292,120 @@ def processNewOrderSingle(session, msg):
                        order_qty        = msg.get('OrderQty'),
                        time_in_force    = msg.get('TimeInForce', '1'),
                        fee              = fee)
+  return order
+
+@login_required
+def processNewOrderSingle(session, msg):
+  order = createOrderFromMessage(session, msg)
   application.db_session.flush() # just to assign an ID for the order.
 
+  match_start_time = time.time()
   OrderMatcher.get(msg.get('Symbol')).match(application.db_session, order)
+  application.metrics.add_phase_time('match', time.time() - match_start_time)
+  application.stamp_trace('Match')
   application.db_session.commit()
 
   return ""
 
 @login_required
-def processCancelOrderRequest(session, msg):
-  order_list = []
+def processNewOrderList(session, msg):
+  orders = [ createOrderFromMessage(session, order_msg) for order_msg in msg.new_order_list ]
+  application.db_session.flush() # just to assign an ID for the orders.
+
+  # the orders are matched in the sequence of the list, and all the publications of the list go out together
+  publish_queue_length = len(application.publish_queue)
+  match_start_time = time.time()
+  try:
+    for order in orders:
+      OrderMatcher.get(order.symbol).match(application.db_session, order)
+  except Exception:
+    # none of the list is kept: the books changed by the orders already matched are loaded again from the
+    # database as it was before the list, and their publications are dropped
+    application.db_session.rollback()
+    application.load_order_book(set( order.symbol for order in orders ))
+    del application.publish_queue[publish_queue_length:]
+    application.balance_updates = {}
+    raise
+  application.metrics.add_phase_time('match', time.time() - match_start_time)
+  application.stamp_trace('Match')
+  application.db_session.commit()
+
+  return ""
+
+def getOpenOrderFromMessage(session, msg):
   if  msg.has('OrigClOrdID'):
-    order = Order.get_order_by_client_order_id(application.db_session, ("0","1"), session.user.id,  msg.get('OrigClOrdID') )
-    if order:
-      order_list.append(order)
-  elif msg.has('OrderID'):
-    order = Order.get_order_by_order_id(application.db_session, ("0","1"),  msg.get('OrderID') )
+    return Order.get_order_by_client_order_id(application.db_session, ("0","1"), session.user.id,  msg.get('OrigClOrdID') )
+
+  order = Order.get_order_by_order_id(application.db_session, ("0","1"),  msg.get('OrderID') )
+  if order:
+    if order.user_id == session.user.id:  # user/broker changing his own order
+      return order
+    elif order.account_id == session.user.id:  # user changing an order sent by his broker
+      return order
+    elif order.account_user.broker_id == session.user.id:  # broker changing an order sent by an user
+      return order
+  return None
 
+@login_required
+def processCancelOrderRequest(session, msg):
+  match_start_time = time.time()
+  if  msg.has('OrigClOrdID') or msg.has('OrderID'):
+    order = getOpenOrderFromMessage(session, msg)
     if order:
-      if order.user_id == session.user.id:  # user/broker cancelling his own order
-        order_list.append(order)
-      elif order.account_id == session.user.id:  # user cancelling an order sent by his broker
-        order_list.append(order)
-      elif order.account_user.broker_id == session.user.id:  # broker cancelling an order sent by an user
-        order_list.append(order)
+      OrderMatcher.get( order.symbol ).cancel(application.db_session, order)
   else:
     # user cancelling all the orders he sent.
-    orders = Order.get_list_by_user_id( application.db_session, ("0","1"), session.user.id )
-    for order in orders:
-      order_list.append(order)
+    for order_matcher in matcher_dict.values():
+      order_matcher.mass_cancel(application.db_session, user_id=session.user.id)
+  application.metrics.add_phase_time('match', time.time() - match_start_time)
+  application.stamp_trace('Match')
+  application.db_session.commit()
+
+  return ""
 
-  for order in order_list:
-    OrderMatcher.get( order.symbol ).cancel(application.db_session, order)
+@login_required
+def processOrderCancelReplaceRequest(session, msg):
+  order = getOpenOrderFromMessage(session, msg)
+  if not order:
+    return ""
+
+  match_start_time = time.time()
+  OrderMatcher.get( order.symbol ).replace(application.db_session,
+                                           order,
+                                           msg.get('OrderQty'),
+                                           msg.get('Price'),
+                                           msg.get('ClOrdID'))
+  application.metrics.add_phase_time('match', time.time() - match_start_time)
+  application.stamp_trace('Match')
   application.db_session.commit()
 
   return ""
 
+@login_required
+def processOrderMassCancelRequest(session, msg):
+  if msg.get('MassCancelRequestType') == '1': # orders of a security
+    order_matchers = [ matcher_dict[msg.get('Symbol')] ] if msg.get('Symbol') in matcher_dict else []
+  else: # all orders
+    order_matchers = matcher_dict.values()
+
+  total_affected_orders = 0
+  match_start_time = time.time()
+  for order_matcher in order_matchers:
+    total_affected_orders += len(order_matcher.mass_cancel(application.db_session,
+                                                           account_id=session.user.account_id,
+                                                           side=msg.get('Side')))
+  application.metrics.add_phase_time('match', time.time() - match_start_time)
+  application.stamp_trace('Match')
+  application.db_session.commit()
+
+  return json.dumps({
+    'MsgType': 'r',
+    'ClOrdID': msg.get('ClOrdID'),
+    'MassCancelRequestType': msg.get('MassCancelRequestType'),
+    'MassCancelResponse': msg.get('MassCancelRequestType'),
+    'TotalAffectedOrders': total_affected_orders
+  }, cls=JsonEncoder)
+
 
 def convertCamelCase2Underscore(name):
   import re
@@ -439,11 +517,11 @@ def processTradersRankRequest(session, msg):
 
   columns = [ 'Rank', 'Trader',  'Broker', 'Amount' ]
 
-  traders_list = Balance.get_balances_by_rank( application.db_session )
+  traders_list = TradersRank.get_page( application.db_session, 'BTC', page_size, offset )
 
   response_msg = {
     'MsgType'           : 'U37',
-    'DepositListReqID'  : msg.get('TradersRankReqID'),
+    'TradersRankReqID'  : msg.get('TradersRankReqID'),
     'Page'              : page,
     'PageSize'          : page_size,
     'Columns'           : columns,
@@ -626,12 +704,13 @@ def processRequestForOpenOrders(session, msg):
   page        = msg.get('Page', 0)
   page_size   = msg.get('PageSize', 100)
   status_list = msg.get('StatusList', ['0', '1'] )
+  cursor      = msg.get('Cursor')
   offset      = page * page_size
 
   if session.user.is_broker:
-    orders = Order.get_list_by_user_id(application.db_session, status_list, session.user.id, page_size, offset)
+    orders = Order.get_list_by_user_id(application.db_session, status_list, session.user.id, page_size, offset, cursor).all()
   else:
-    orders = Order.get_list_by_account_id(application.db_session, status_list, session.user.id, page_size, offset)
+    orders = Order.get_list_by_account_id(application.db_session, status_list, session.user.id, page_size, offset, cursor).all()
 
   order_list = []
   columns = [ 'ClOrdID','OrderID','CumQty','OrdStatus','LeavesQty','CxlQty','AvgPx',
@@ -665,6 +744,7 @@ def processRequestForOpenOrders(session, msg):
     'OrdersReqID': msg.get('OrdersReqID'),
     'Page':        page,
     'PageSize':    page_size,
+    'NextCursor':  get_next_cursor(orders, page_size),
     'Columns':     columns,
     'OrdListGrp' : order_list
   }
@@ -1001,6 +1081,7 @@ def processWithdrawListRequest(session, msg):
   page_size   = msg.get('PageSize', 100)
   status_list = msg.get('StatusList', ['1', '2'] )
   filter      = msg.get('Filter',[])
+  cursor      = msg.get('Cursor')
   offset      = page * page_size
 
   user = session.user
@@ -1013,11 +1094,11 @@ def processWithdrawListRequest(session, msg):
 
   if user.is_broker:
     if msg.has('ClientID'):
-      withdraws = Withdraw.get_list(application.db_session, user.id, int(msg.get('ClientID')), status_list, page_size, offset, filter  )
+      withdraws = Withdraw.get_list(application.db_session, user.id, int(msg.get('ClientID')), status_list, page_size, offset, filter, cursor  ).all()
     else:
-      withdraws = Withdraw.get_list(application.db_session, user.id, None, status_list, page_size, offset, filter  )
+      withdraws = Withdraw.get_list(application.db_session, user.id, None, status_list, page_size, offset, filter, cursor  ).all()
   else:
-    withdraws = Withdraw.get_list(application.db_session, user.broker_id, user.id, status_list, page_size, offset, filter  )
+    withdraws = Withdraw.get_list(application.db_session, user.broker_id, user.id, status_list, page_size, offset, filter, cursor  ).all()
 
   withdraw_list = []
   columns = [ 'WithdrawID'   , 'Method'   , 'Currency'     , 'Amount' , 'Data',
@@ -1050,6 +1131,7 @@ def processWithdrawListRequest(session, msg):
     'WithdrawListReqID' : msg.get('WithdrawListReqID'),
     'Page'              : page,
     'PageSize'          : page_size,
+    'NextCursor'        : get_next_cursor(withdraws, page_size),
     'Columns'           : columns,
     'WithdrawListGrp'   : withdraw_list
   }
@@ -1147,6 +1229,78 @@ def processRequestDatabaseQuery(session, msg):
   }
   return json.dumps(result, cls=JsonEncoder)
 
+@login_required
+@staff_user_required
+def processTraceStatsRequest(session, msg):
+  response_msg = {
+    'MsgType'         : 'A3',
+    'TraceStatsReqID' : msg.get('TraceStatsReqID'),
+    'Stages'          : application.trace_stages.to_dict()
+  }
+  if msg.get('Reset'):
+    application.trace_stages.reset()
+  return json.dumps(response_msg, cls=JsonEncoder)
+
+@login_required
+@staff_user_required
+def processEngineMetricsRequest(session, msg):
+  response_msg = {
+    'MsgType'           : 'A5',
+    'EngineMetricsReqID': msg.get('EngineMetricsReqID'),
+    'Metrics'           : application.metrics.get_report(application)
+  }
+  return json.dumps(response_msg, cls=JsonEncoder)
+
+@login_required
+@staff_user_required
+def processProfilerRequest(session, msg):
+  from errors import ProfilerRunningError
+
+  action = msg.get('Action')
+  if action == 'start':
+    if application.profiler.running:
+      raise ProfilerRunningError()
+    application.profiler.start(msg.get('Seconds'), msg.get('Interval', 5) / 1000., msg.get('Mode', 'cpu'))
+  elif action == 'stop':
+    application.stop_profiler()
+
+  response_msg = {
+    'MsgType'       : 'A7',
+    'ProfilerReqID' : msg.get('ProfilerReqID'),
+    'Profiler'      : application.profiler.get_status()
+  }
+  return json.dumps(response_msg, cls=JsonEncoder)
+
+@login_required
+@staff_user_required
+def processMemoryRequest(session, msg):
+  from bitex.memory import get_memory_report
+  from errors import InvalidParameter
+
+  action = msg.get('Action')
+  limit = msg.get('Limit', 50)
+
+  response_msg = {
+    'MsgType'     : 'A9',
+    'MemoryReqID' : msg.get('MemoryReqID'),
+    'Action'      : action
+  }
+  if action == 'report':
+    response_msg['Memory'] = get_memory_report(application.get_memory_structures(), limit)
+  elif action == 'snapshot':
+    response_msg['Snapshot'] = application.heap_snapshots.take(msg.get('Name'),
+                                                               application.get_memory_structures())
+  elif action == 'diff':
+    try:
+      response_msg['Diff'] = application.heap_snapshots.diff(msg.get('From'),
+                                                             msg.get('To'),
+                                                             limit,
+                                                             application.get_memory_structures())
+    except KeyError:
+      raise InvalidParameter()
+  response_msg['Snapshots'] = application.heap_snapshots.list()
+  return json.dumps(response_msg, cls=JsonEncoder)
+
 @login_required
 @broker_user_required
 def processCustomerListRequest(session, msg):
@@ -1158,13 +1312,14 @@ def processCustomerListRequest(session, msg):
   client_id   = msg.get('ClientID', None)
   sort_column = msg.get('Sort', None)
   sort_order  = msg.get('SortOrder', 'ASC')
+  cursor      = msg.get('Cursor')
   offset      = page * page_size
 
   if client_id:
     if len(client_id) == 1:
       client_id = client_id[0]
 
-  user_list = User.get_list(application.db_session, session.user.id ,status_list, country, state, client_id, page_size, offset, sort_column, sort_order)
+  user_list = User.get_list(application.db_session, session.user.id ,status_list, country, state, client_id, page_size, offset, sort_column, sort_order, cursor).all()
 
   result_set = []
   columns = [ 'ID'              , 'Username'       , 'Email'             , 'State'              , 'CountryCode'     ,
@@ -1193,6 +1348,7 @@ def processCustomerListRequest(session, msg):
     'CustomerListReqID' : msg.get('CustomerListReqID'),
     'Page'              : page,
     'PageSize'          : page_size,
+    'NextCursor'        : get_next_cursor(user_list, page_size) if not sort_column else None, # keyset order only
     'Columns'           : columns,
     'CustomerListGrp'   : result_set
   }
@@ -1384,6 +1540,7 @@ def processLedgerListRequest(session, msg):
   operation_list  = msg.get('OperationList', ['C', 'D'] )
   currency        = msg.get('Currency')
   filter          = msg.get('Filter',[])
+  cursor          = msg.get('Cursor')
   offset          = page * page_size
 
   user = session.user
@@ -1403,7 +1560,7 @@ def processLedgerListRequest(session, msg):
       broker_id = int(msg.get('BrokerID'))
 
 
-  records = Ledger.get_list(application.db_session, broker_id, account_id, operation_list, page_size, offset, currency, filter  )
+  records = Ledger.get_list(application.db_session, broker_id, account_id, operation_list, page_size, offset, currency, filter, cursor  ).all()
 
   record_list = []
   columns = [ 'LedgerID',       'Currency',     'Operation',
@@ -1435,6 +1592,7 @@ def processLedgerListRequest(session, msg):
     'LedgerListReqID'   : msg.get('LedgerListReqID'),
     'Page'              : page,
     'PageSize'          : page_size,
+    'NextCursor'        : get_next_cursor(records, page_size),
     'Columns'           : columns,
     'LedgerListGrp'     : record_list
   }
@@ -1446,6 +1604,7 @@ def processDepositListRequest(session, msg):
   page_size   = msg.get('PageSize', 100)
   status_list = msg.get('StatusList', ['0', '1', '2', '4', '8'] )
   filter      = msg.get('Filter',[])
+  cursor      = msg.get('Cursor')
 
 
   offset      = page * page_size
@@ -1454,11 +1613,11 @@ def processDepositListRequest(session, msg):
 
   if user.is_broker:
     if msg.has('ClientID'):
-      deposits = Deposit.get_list(application.db_session, user.id, int(msg.get('ClientID')), status_list, page_size, offset, filter  )
+      deposits = Deposit.get_list(application.db_session, user.id, int(msg.get('ClientID')), status_list, page_size, offset, filter, cursor  ).all()
     else:
-      deposits = Deposit.get_list(application.db_session, user.id, None, status_list, page_size, offset, filter  )
+      deposits = Deposit.get_list(application.db_session, user.id, None, status_list, page_size, offset, filter, cursor  ).all()
   else:
-    deposits = Deposit.get_list(application.db_session, user.broker_id, user.id, status_list, page_size, offset, filter  )
+    deposits = Deposit.get_list(application.db_session, user.broker_id, user.id, status_list, page_size, offset, filter, cursor  ).all()
 
 
   deposit_list = []
@@ -1498,6 +1657,7 @@ def processDepositListRequest(session, msg):
     'DepositListReqID'  : msg.get('DepositListReqID'),
     'Page'              : page,
     'PageSize'          : page_size,
+    'NextCursor'        : get_next_cursor(deposits, page_size),
     'Columns'           : columns,
     'DepositListGrp'    : deposit_list
   }
@@ -40,12 +40,17 @@ import urllib
 import urllib2
 import json
 import uuid
+import random
 from json import loads
 from bitex.json_encoder import JsonEncoder
+from bitex.utils import encode_cursor
+from bitex.histogram import StageHistograms
+from bitex.profiler import SamplingProfiler
+from bitex.memory import HeapSnapshots
 
 import zmq
-from bitex.message import JsonMessage, InvalidMessageException
-from bitex.zmq_client import TradeClient, TradeClientException
+from bitex.message import JsonMessage, InvalidMessageException, QUERY_SERVICE_MESSAGE_TYPES
+from bitex.zmq_client import TradeClient, QueryClient, TradeClientException
 
 import calendar, time
 from time import mktime
@@ -57,8 +62,13 @@ from zmq.eventloop.zmqstream import ZMQStream
 define("callback_url")
 define("port", type=int  ,help="port")
 define("gateway_log", help="logging" )
+define("gateway_log_format", default="text", help="text writes the replay log through the logging module. binary writes a buffered, length prefixed log from a background thread")
 define("trade_in", help="trade zmq queue")
 define("trade_pub",help="trade zmq publish queue")
+define("gateway_trace_rate", type=float, default=0., help="fraction of the requests forwarded to trade carrying a Trace field, stamped on every stage until they are answered. Off by default, 0.01 traces one request in a hundred")
+define("gateway_metrics_allowed_ips", default="", help="comma separated addresses allowed to read the /_metrics, /_profile and /_memory endpoints. They are off while empty. Behind a reverse proxy every request comes from the proxy address")
+define("gateway_profile_dir", help="directory where the collapsed stacks of the /_profile sampling profiler are written. Defaults to the temp directory")
+define("query_in", help="query service zmq queue. When set, read-only list requests are routed to the query service instead of trade")
 define("url_payment_processor",help="blockchain api_receive url", default='https://blockchain.info/api/receive')
 define("session_timeout_limit", default=0, help="Session timeout")
 define("db_echo",default=False, help="Prints every database command on the stdout")
@@ -76,9 +86,10 @@ if not options.trade_in or \
   tornado.options.print_help()
   exit(0)
 
-input_log_file_handler = logging.handlers.TimedRotatingFileHandler( options.gateway_log, when='MIDNIGHT')
-formatter = logging.Formatter('%(asctime)s - %(message)s')
-input_log_file_handler.setFormatter(formatter)
+if options.gateway_log_format != 'binary':
+  input_log_file_handler = logging.handlers.TimedRotatingFileHandler( options.gateway_log, when='MIDNIGHT')
+  formatter = logging.Formatter('%(asctime)s - %(message)s')
+  input_log_file_handler.setFormatter(formatter)
 
 
 from market_data_helper import MarketDataPublisher, MarketDataSubscriber, generate_md_full_refresh, generate_trade_history, SecurityStatusPublisher, generate_security_status
@@ -89,12 +100,15 @@ from process_deposit_handler import ProcessDepositHandler
 from verification_webhook_handler import VerificationWebHookHandler
 from deposit_receipt_webhook_handler import  DepositReceiptWebHookHandler
 from rest_api_handler import RestApiHandler
+from metrics_handler import MetricsHandler, ProfileHandler, MemoryHandler, GatewayMetrics
 import datetime
 
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 from models import Trade
 
+GATEWAY_TRACE_STAMPS = ('GatewayReceive', 'GatewayForward', 'GatewayReply', 'GatewaySend')
+
 class WebSocketHandler(websocket.WebSocketHandler):
 
     def __init__(self, application, request, **kwargs):
@@ -116,7 +130,9 @@ class WebSocketHandler(websocket.WebSocketHandler):
         self.user_response = None
 
     def on_trade_publish(self, message):
-        self.write_message(str(message[1]))
+        self.application.metrics.increment('zmq_trade_received', len(message) - 1)
+        for raw_message in message[1:]:
+            self.write_message(str(raw_message))
 
     def open(self):
         try:
@@ -134,13 +150,31 @@ class WebSocketHandler(websocket.WebSocketHandler):
 
     def write_message(self, message, binary=False):
         self.application.log('OUT', self.trade_client.connection_id, message )
+        self.application.metrics.increment('ws_messages_out')
+        self.application.metrics.increment('ws_bytes_out', len(message))
         super(WebSocketHandler, self).write_message(message, binary)
 
+    def get_write_buffer_size(self):
+        # bytes accepted by write_message and not yet sent to the client
+        stream = getattr(self, 'stream', None)
+        if stream is None or stream.closed():
+            return 0
+        return sum(len(chunk) for chunk in stream._write_buffer)
+
     def close(self):
       self.application.log('DEBUG', self.remote_ip, 'WebSocketHandler.close() invoked' )
       super(WebSocketHandler, self).close()
 
     def on_message(self, raw_message):
+        try:
+            self.process_client_message(raw_message)
+        finally:
+            self.application.profiler.set_tag(None)
+
+    def process_client_message(self, raw_message):
+        receive_time = time.time()
+        self.application.metrics.increment('ws_messages_in')
+        self.application.metrics.increment('ws_bytes_in', len(raw_message))
         if not self.trade_client.isConnected():
             return
 
@@ -156,6 +190,7 @@ class WebSocketHandler(websocket.WebSocketHandler):
             self.close()
             return
 
+        self.application.profiler.set_tag(req_msg.type)
 
         if req_msg.isUserRequest():
             if req_msg.has('Password'):
@@ -247,11 +282,40 @@ class WebSocketHandler(websocket.WebSocketHandler):
                     }))
                     return
 
+        if self.application.query_client and req_msg.type in QUERY_SERVICE_MESSAGE_TYPES:
+            self.on_query_request(req_msg)
+            return
+
+        trace = None
+        if options.gateway_trace_rate and random.random() < options.gateway_trace_rate:
+            trace = {'GatewayReceive': receive_time, 'GatewayForward': time.time()}
+            req_msg.set('Trace', trace)
+        elif req_msg.has('Trace'):
+            req_msg.set('Trace', None)  # only the gateway stamps traces
+
         try:
+            forward_time = time.time()
             resp_message = self.trade_client.sendMessage(req_msg)
+            reply_time = time.time()
+            self.application.metrics.record_round_trip(req_msg.type, reply_time - forward_time)
+            if trace:
+                trace['GatewayReply'] = reply_time
+
+            if resp_message and resp_message.isTraceStatsResponse():
+                # the trade engine only knows its own stages
+                stages = resp_message.get('Stages') or {}
+                stages.update(self.application.trace_stages.to_dict())
+                if req_msg.get('Reset'):
+                    self.application.trace_stages.reset()
+                resp_message.set('Stages', stages)
+
             if resp_message:
                 self.write_message(resp_message.raw_message)
 
+            if trace:
+                trace['GatewaySend'] = time.time()
+                self.application.trace_stages.record_trace(trace, GATEWAY_TRACE_STAMPS)
+
             if resp_message and resp_message.isUserResponse():
                 self.user_response = resp_message
 
@@ -271,6 +335,22 @@ class WebSocketHandler(websocket.WebSocketHandler):
             self.trade_client.close()
             self.close()
 
+    def on_query_request(self, msg):
+        user_id = None
+        if self.is_user_logged():
+            user_id = self.user_response.get('UserID')
+
+        try:
+            resp_message = self.application.query_client.sendMessage(msg, user_id)
+            if resp_message:
+                self.write_message(resp_message.raw_message)
+        except TradeClientException as e:
+            self.write_message(json.dumps({
+                'MsgType': 'ERROR',
+                'Description': e.error_message,
+                'Detail': str(e)
+            }))
+
     def is_user_logged(self):
         if not self.user_response:
             return False
@@ -303,19 +383,29 @@ class WebSocketHandler(websocket.WebSocketHandler):
         page        = msg.get('Page', 0)
         page_size   = msg.get('PageSize', 100)
         filter      = msg.get('Filter')
+        cursor      = msg.get('Cursor')
 
         offset      = page * page_size
 
         columns = [ 'TradeID'           , 'Market',  'Side', 'Price', 'Size', 
                     'Buyer'             , 'Seller', 'Created' ]
 
-        trade_list = generate_trade_history(page_size, offset)
+        try:
+            trade_list = generate_trade_history(page_size, offset, cursor=cursor)
+        except ValueError:
+            self.write_message('{"MsgType":"ERROR", "Description":"Invalid message", "Detail": "Invalid cursor"}')
+            return
+
+        next_cursor = None
+        if page_size and len(trade_list) == page_size:
+            next_cursor = encode_cursor(trade_list[-1][7], trade_list[-1][0])
 
         response_msg = {
             'MsgType'           : 'U33', # TradeHistoryResponse
             'TradeHistoryReqID' : msg.get('TradeHistoryReqID'),
             'Page'              : page,
             'PageSize'          : page_size,
+            'NextCursor'        : next_cursor,
             'Columns'           : columns,
             'TradeHistoryGrp'   : trade_list
         }
@@ -403,19 +493,34 @@ class WebSocketGatewayApplication(tornado.web.Application):
             (r'/_webhook/verification_form', VerificationWebHookHandler),
             (r'/_webhook/deposit_receipt', DepositReceiptWebHookHandler),
             (r'/process_deposit(.*)', ProcessDepositHandler),
-            (r'/api/(?P<version>[^\/]+)/(?P<symbol>[^\/]+)/(?P<resource>[^\/]+)', RestApiHandler)
+            (r'/api/(?P<version>[^\/]+)/(?P<symbol>[^\/]+)/(?P<resource>[^\/]+)', RestApiHandler),
+            (r'/_metrics', MetricsHandler),
+            (r'/_profile', ProfileHandler),
+            (r'/_memory', MemoryHandler)
         ]
         settings = dict(
             cookie_secret='cookie_secret'
         )
         tornado.web.Application.__init__(self, handlers, **settings)
 
-        self.replay_logger = logging.getLogger("REPLAY")
-        self.replay_logger.setLevel(logging.INFO)
-        self.replay_logger.addHandler(input_log_file_handler)
-        self.replay_logger.info('START')
+        self.replay_log_writer = None
+        if options.gateway_log_format == 'binary':
+            from bitex.replay_log import ReplayLogWriter
+            self.replay_log_writer = ReplayLogWriter(options.gateway_log)
+            self.replay_log_writer.info('START')
+        else:
+            self.replay_logger = logging.getLogger("REPLAY")
+            self.replay_logger.setLevel(logging.INFO)
+            self.replay_logger.addHandler(input_log_file_handler)
+            self.replay_logger.info('START')
         self.log_start_data()
 
+        self.trace_stages = StageHistograms()
+
+        self.metrics = GatewayMetrics()
+        self.metrics_allowed_ips = set( ip.strip() for ip in options.gateway_metrics_allowed_ips.split(',') if ip.strip() )
+        self.profiler = SamplingProfiler('ws_gateway', options.gateway_profile_dir)
+        self.heap_snapshots = HeapSnapshots()
 
         from models import ENGINE, db_bootstrap
         self.db_session = scoped_session(sessionmaker(bind=ENGINE))
@@ -432,6 +537,12 @@ class WebSocketGatewayApplication(tornado.web.Application):
             self.trade_in_socket)
         self.application_trade_client.connect()
 
+        self.query_client = None
+        if opt.query_in:
+            self.query_in_socket = self.zmq_context.socket(zmq.REQ)
+            self.query_in_socket.connect(opt.query_in)
+            self.query_client = QueryClient(self.zmq_context, self.query_in_socket)
+
         instruments = self.application_trade_client.getSecurityList()
         self.md_subscriber = {}
 
@@ -444,7 +555,10 @@ class WebSocketGatewayApplication(tornado.web.Application):
                 self.application_trade_client)
 
         last_trade_id = Trade.get_last_trade_id()
-        trade_list = self.application_trade_client.getLastTrades(last_trade_id)
+        if self.query_client:
+            trade_list = self.query_client.getLastTrades(last_trade_id)
+        else:
+            trade_list = self.application_trade_client.getLastTrades(last_trade_id)
 
         for trade in trade_list:
             msg = dict()
@@ -481,12 +595,19 @@ class WebSocketGatewayApplication(tornado.web.Application):
             30000)
         self.heart_beat_timer.start()
 
+        self.metrics.start()
+
     def log_start_data(self):
         self.log('PARAM','BEGIN')
         self.log('PARAM','callback_url'         ,options.callback_url)
         self.log('PARAM','port'                 ,options.port)
         self.log('PARAM','trade_in'             ,options.trade_in)
         self.log('PARAM','trade_pub'            ,options.trade_pub)
+        self.log('PARAM','gateway_log_format'   ,options.gateway_log_format)
+        self.log('PARAM','query_in'             ,options.query_in)
+        self.log('PARAM','gateway_trace_rate'   ,options.gateway_trace_rate)
+        self.log('PARAM','gateway_metrics_allowed_ips',options.gateway_metrics_allowed_ips)
+        self.log('PARAM','gateway_profile_dir'  ,options.gateway_profile_dir)
         self.log('PARAM','url_payment_processor',options.url_payment_processor)
         self.log('PARAM','session_timeout_limit',options.session_timeout_limit)
         self.log('PARAM','db_echo'              ,options.db_echo)
@@ -495,6 +616,10 @@ class WebSocketGatewayApplication(tornado.web.Application):
 
 
     def log(self, command, key, value=None):
+        if self.replay_log_writer:
+            self.replay_log_writer.log(command, key, value)
+            return
+
         log_msg = command + ',' + key
         if value:
             try:
@@ -521,15 +646,39 @@ class WebSocketGatewayApplication(tornado.web.Application):
         if ws_client.trade_client.connection_id in self.connections:
             return False
         self.connections[ws_client.trade_client.connection_id] = ws_client
+        self.metrics.increment('connections_opened')
         return True
 
     def unregister_connection(self, ws_client):
         self.log('INFO', 'UNREGISTER_CONNECTION',  {'remote_ip': ws_client.remote_ip, 'trade.connection_id':  ws_client.trade_client.connection_id  }  )
         if ws_client.trade_client.connection_id in self.connections:
             del self.connections[ws_client.trade_client.connection_id]
+            self.metrics.increment('connections_closed')
             return True
         return False
 
+    def get_memory_structures(self):
+        md_subscriptions = []
+        sec_status_subscriptions = []
+        for connection in self.connections.itervalues():
+            for publishers in connection.md_subscriptions.itervalues():
+                md_subscriptions.extend(publishers)
+            for publishers in connection.sec_status_subscriptions.itervalues():
+                sec_status_subscriptions.extend(publishers)
+
+        structures = {
+            'Connections': self.connections,
+            'MarketDataSubscriptions': md_subscriptions,
+            'SecurityStatusSubscriptions': sec_status_subscriptions,
+            'IdentityMap': self.db_session().identity_map
+        }
+        for symbol, subscriber in self.md_subscriber.iteritems():
+            structures['MarketData.' + symbol + '.BuySide'] = subscriber.buy_side
+            structures['MarketData.' + symbol + '.SellSide'] = subscriber.sell_side
+            structures['MarketData.' + symbol + '.VolumeDict'] = subscriber.volume_dict
+            structures['MarketData.' + symbol + '.ProcessLater'] = subscriber.process_later
+        return structures
+
     def clean_up(self):
         self.heart_beat_timer.stop()
         self.application_trade_client.close()
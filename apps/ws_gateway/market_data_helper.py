@@ -99,16 +99,17 @@ class MarketDataSubscriber(object):
     def on_md_publish(self, publish_msg):
         """" on_md_publish. """
         topic = publish_msg[0]
-        raw_message = publish_msg[1]
-        self.application.log('IN', 'TRADE_PUB', raw_message )
+        self.application.metrics.increment('zmq_md_received.' + self.symbol, len(publish_msg) - 1)
+        for raw_message in publish_msg[1:]:
+            self.application.log('IN', 'TRADE_PUB', raw_message )
 
-        msg = JsonMessage(raw_message)
+            msg = JsonMessage(raw_message)
 
-        if msg.type == 'W':  # Full Refresh
-            self.on_md_full_refresh(msg)
+            if msg.type == 'W':  # Full Refresh
+                self.on_md_full_refresh(msg)
 
-        elif msg.type == 'X':  # Incremental
-            self.on_md_incremental(msg)
+            elif msg.type == 'X':  # Incremental
+                self.on_md_incremental(msg)
 
     def on_md_full_refresh(self, msg):
         """" on_md_full_refresh. """
@@ -331,6 +332,7 @@ class MarketDataPublisher(object):
     def __init__(self, req_id, market_depth, entries, instrument, handler):
         self.handler = handler
         self.req_id = req_id
+        self.symbol = instrument
 
         self.entry_list_order_depth = []
         for entry in entries:
@@ -360,8 +362,8 @@ class MarketDataPublisher(object):
             self.handler(sender, md)
             self.entry_list_order_depth = []
 
-def generate_trade_history(page_size = None, offset = None, sort_column = None, sort_order='ASC'):
-    trades = Trade.get_last_trades(page_size, offset, sort_column, sort_order)
+def generate_trade_history(page_size = None, offset = None, sort_column = None, sort_order='ASC', cursor=None):
+    trades = Trade.get_last_trades(page_size, offset, sort_column, sort_order, cursor)
     trade_list = []
     for trade in  trades:
         trade_list.append([ 
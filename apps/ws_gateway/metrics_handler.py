@@ -0,0 +1,197 @@
+import time
+import json
+from collections import deque
+
+import tornado.ioloop
+import tornado.web
+
+from bitex.histogram import Histogram, StageHistograms
+from bitex.json_encoder import JsonEncoder
+from bitex.memory import get_memory_report
+
+
+class GatewayMetrics(object):
+    """Operational counters of the gateway.
+
+    Counters only grow. Once per tick_interval a sample of them is kept, so the rates of the last window seconds
+    are computed when the metrics are read, no matter how often they are scraped. The same tick measures the
+    IOLoop lag, how late the callback ran.
+    """
+    def __init__(self, io_loop=None, tick_interval=1., window=10):
+        self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+        self.tick_interval = tick_interval
+        self.start_time = time.time()
+
+        self.counters = {}
+        self.samples = deque(maxlen=int(window / tick_interval) + 1)
+        self.round_trips = StageHistograms()  # by MsgType
+        self.ioloop_lag = Histogram()
+        self.last_ioloop_lag = 0.
+
+        self.tick_deadline = None
+
+    def start(self):
+        self.samples.append( (time.time(), dict(self.counters)) )
+        self.schedule_tick()
+
+    def schedule_tick(self):
+        self.tick_deadline = time.time() + self.tick_interval
+        self.io_loop.add_timeout(self.tick_deadline, self.on_tick)
+
+    def on_tick(self):
+        now = time.time()
+        self.last_ioloop_lag = (now - self.tick_deadline) * 1000
+        self.ioloop_lag.record(self.last_ioloop_lag)
+        self.samples.append( (now, dict(self.counters)) )
+        self.schedule_tick()
+
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def record_round_trip(self, msg_type, elapsed):
+        self.round_trips.record(msg_type, elapsed * 1000)
+
+    def get_rates(self):
+        if not self.samples:
+            return {}
+        now = time.time()
+        sample_time, sample_counters = self.samples[0]
+        elapsed = now - sample_time
+        if not elapsed:
+            return {}
+        return dict( (name, (value - sample_counters.get(name, 0)) / elapsed)
+                     for name, value in self.counters.iteritems() )
+
+    def get_report(self, application, top_write_buffers=10):
+        md_subscriptions = {}
+        security_status_subscriptions = {}
+        write_buffers = []
+        for connection_id, connection in application.connections.items():
+            for publishers in connection.md_subscriptions.itervalues():
+                for publisher in publishers:
+                    md_subscriptions[publisher.symbol] = md_subscriptions.get(publisher.symbol, 0) + 1
+            for publishers in connection.sec_status_subscriptions.itervalues():
+                for publisher in publishers:
+                    security_status_subscriptions[publisher.symbol] = \
+                        security_status_subscriptions.get(publisher.symbol, 0) + 1
+            write_buffers.append( (connection.get_write_buffer_size(), connection_id, connection.remote_ip) )
+
+        write_buffers.sort(reverse=True)
+
+        now = time.time()
+        return {
+            'Timestamp': now,
+            'Uptime': now - self.start_time,
+            'Connections': len(application.connections),
+            'MarketDataSubscriptions': md_subscriptions,
+            'SecurityStatusSubscriptions': security_status_subscriptions,
+            'Counters': self.counters,
+            'Rates': self.get_rates(),
+            'TradeRoundTrip': self.round_trips.to_dict(),
+            'TraceStages': application.trace_stages.to_dict(),
+            'IOLoopLag': self.last_ioloop_lag,
+            'IOLoopLagHistogram': self.ioloop_lag.to_dict(),
+            'WriteBufferTotal': sum( size for size, connection_id, remote_ip in write_buffers ),
+            'WriteBufferLargest': [ {'ConnectionID': connection_id, 'RemoteIP': remote_ip, 'Bytes': size}
+                                    for size, connection_id, remote_ip in write_buffers[:top_write_buffers] if size ]
+        }
+
+
+def check_metrics_allowed_ip(handler):
+    # the forwarded headers can be set by anyone, only the address of the peer is checked
+    if not handler.application.metrics_allowed_ips:
+        raise tornado.web.HTTPError(404)
+    if handler.request.remote_ip not in handler.application.metrics_allowed_ips:
+        raise tornado.web.HTTPError(403)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def __init__(self, application, request, **kwargs):
+        super(MetricsHandler, self).__init__(application, request, **kwargs)
+
+    def get(self):
+        check_metrics_allowed_ip(self)
+
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(json.dumps(self.application.metrics.get_report(self.application), cls=JsonEncoder))
+
+
+class ProfileHandler(tornado.web.RequestHandler):
+    """Profiles the gateway for the given seconds and answers the collapsed stacks.
+
+    GET /_profile?seconds=30&interval=5&mode=cpu, the interval in milliseconds. The stacks are also written
+    to gateway_profile_dir.
+    """
+    def __init__(self, application, request, **kwargs):
+        super(ProfileHandler, self).__init__(application, request, **kwargs)
+
+    @tornado.web.asynchronous
+    def get(self):
+        check_metrics_allowed_ip(self)
+
+        profiler = self.application.profiler
+        if profiler.running:
+            raise tornado.web.HTTPError(409, 'profiler is already running')
+
+        try:
+            seconds = float(self.get_argument('seconds', 10))
+            interval = float(self.get_argument('interval', 5)) / 1000.
+            profiler.start(seconds, interval, self.get_argument('mode', 'cpu'))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+
+        self.application.log('DEBUG', 'PROFILER', 'started by ' + self.request.remote_ip)
+        tornado.ioloop.IOLoop.current().add_timeout(profiler.stop_time, self.on_profiler_expired)
+
+    def on_profiler_expired(self):
+        status = self.application.profiler.stop()
+        self.application.log('DEBUG', 'PROFILER', json.dumps(status, cls=JsonEncoder))
+
+        self.set_header('Content-Type', 'text/plain')
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(self.application.profiler.get_collapsed_stacks())
+        self.finish()
+
+
+class MemoryHandler(tornado.web.RequestHandler):
+    """Memory introspection of the gateway.
+
+    GET /_memory reports the RSS, the types with most bytes and the sizes of the connections, subscriptions and
+    market data tables. ?action=snapshot&name=before keeps the object counts by type, ?action=diff&from=before
+    compares them with the heap now, or with another snapshot given in to. ?action=list lists the snapshots.
+    """
+    def __init__(self, application, request, **kwargs):
+        super(MemoryHandler, self).__init__(application, request, **kwargs)
+
+    def get(self):
+        check_metrics_allowed_ip(self)
+
+        action = self.get_argument('action', 'report')
+        try:
+            limit = int(self.get_argument('limit', 50))
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'invalid limit')
+
+        heap_snapshots = self.application.heap_snapshots
+        result = {'Action': action}
+        if action == 'report':
+            result['Memory'] = get_memory_report(self.application.get_memory_structures(), limit)
+        elif action == 'snapshot':
+            result['Snapshot'] = heap_snapshots.take(self.get_argument('name', None),
+                                                     self.application.get_memory_structures())
+        elif action == 'diff':
+            try:
+                result['Diff'] = heap_snapshots.diff(self.get_argument('from'),
+                                                     self.get_argument('to', None),
+                                                     limit,
+                                                     self.application.get_memory_structures())
+            except KeyError as e:
+                raise tornado.web.HTTPError(404, 'snapshot %s not found' % e)
+        elif action != 'list':
+            raise tornado.web.HTTPError(400, 'invalid action')
+        result['Snapshots'] = heap_snapshots.list()
+
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Cache-Control', 'no-cache')
+        self.write(json.dumps(result, cls=JsonEncoder))
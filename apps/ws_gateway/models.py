@@ -4,13 +4,15 @@
 from datetime import datetime, timedelta
 
 from sqlalchemy import create_engine, func
-from sqlalchemy.sql.expression import or_
+from sqlalchemy.sql.expression import or_, and_
 from sqlalchemy import Column, Integer, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 from tornado.options import options
 
+from bitex.utils import decode_cursor
+
 ENGINE = create_engine(options.db_engine, echo=options.db_echo)
 BASE = declarative_base()
 
@@ -67,7 +69,7 @@ class Trade(BASE):
         return res[0]
 
     @staticmethod
-    def get_last_trades(page_size = None, offset = None, sort_column = None, sort_order='ASC'):
+    def get_last_trades(page_size = None, offset = None, sort_column = None, sort_order='ASC', cursor=None):
         session = scoped_session(sessionmaker(bind=ENGINE))
 
         today = datetime.now()
@@ -75,12 +77,18 @@ class Trade(BASE):
 
         trades = session.query(Trade).filter(
             Trade.created >= timestamp).order_by(
-            Trade.created.desc())
-
+            Trade.created.desc(), Trade.id.desc())
+
+        # keyset paging: start right after the (created, id) pointed by the cursor instead of skipping offset rows
+        if cursor:
+            created, trade_id = decode_cursor(cursor)
+            trades = trades.filter(or_(
+                Trade.created < created,
+                and_(Trade.created == created, Trade.id < int(trade_id))))
+        elif offset:
+            trades = trades.offset(offset)
         if page_size:
             trades = trades.limit(page_size)
-        if offset:
-            trades = trades.offset(offset)
         if sort_column:
             if sort_order == 'ASC':
                 trades = trades.order(sort_column)
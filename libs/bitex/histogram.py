@@ -0,0 +1,141 @@
+__author__ = 'rodrigo'
+
+import math
+import threading
+
+# Latency histograms with logarithmic buckets. Memory is fixed no matter how many values are recorded and the
+# percentiles are accurate to the bucket width, about 6% with the default of 40 buckets per decade.
+
+PERCENTILES = ( ('P50', 50), ('P90', 90), ('P99', 99), ('P999', 99.9) )
+
+
+def get_trace_stages(trace, stamps):
+  """Returns [(stage, elapsed milliseconds)] for the consecutive stamps present in the trace, and the total.
+
+  A trace is a dict of stamp name => time.time(). Stamps are taken in the order they happened, the expected order
+  given by stamps only breaks ties.
+  """
+  present = [ stamp for stamp in stamps if trace.get(stamp) ]
+  present.sort(key=lambda stamp: trace[stamp])
+  if len(present) < 2:
+    return []
+
+  stages = []
+  for previous_stamp, stamp in zip(present, present[1:]):
+    stages.append( (previous_stamp + '->' + stamp, (trace[stamp] - trace[previous_stamp]) * 1000) )
+  if len(present) > 2:
+    stages.append( (present[0] + '->' + present[-1], (trace[present[-1]] - trace[present[0]]) * 1000) )
+  return stages
+
+
+class Histogram(object):
+  def __init__(self, min_value=0.001, max_value=1000000., buckets_per_decade=40):
+    self.min_value = min_value
+    self.max_value = max_value
+    self.buckets_per_decade = buckets_per_decade
+    self.number_of_buckets = int(math.ceil(math.log10(max_value / min_value) * buckets_per_decade)) + 1
+    self.reset()
+
+  def reset(self):
+    self.buckets = [0] * self.number_of_buckets
+    self.count = 0
+    self.total = 0.
+    self.min = None
+    self.max = None
+
+  def get_bucket(self, value):
+    if value <= self.min_value:
+      return 0
+    return min(int(math.log10(value / self.min_value) * self.buckets_per_decade) + 1, self.number_of_buckets - 1)
+
+  def get_bucket_upper_bound(self, bucket):
+    return self.min_value * 10 ** (float(bucket) / self.buckets_per_decade)
+
+  def record(self, value):
+    self.buckets[self.get_bucket(value)] += 1
+    self.count += 1
+    self.total += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+
+  def merge(self, other):
+    if other.number_of_buckets != self.number_of_buckets or other.min_value != self.min_value:
+      raise ValueError('histograms with different buckets')
+    for bucket, count in enumerate(other.buckets):
+      self.buckets[bucket] += count
+    self.count += other.count
+    self.total += other.total
+    if other.min is not None and (self.min is None or other.min < self.min):
+      self.min = other.min
+    if other.max is not None and (self.max is None or other.max > self.max):
+      self.max = other.max
+
+  def percentile(self, p):
+    if not self.count:
+      return 0
+    rank = int(math.ceil(p / 100. * self.count))
+    seen = 0
+    for bucket, count in enumerate(self.buckets):
+      seen += count
+      if seen >= rank:
+        if bucket == self.number_of_buckets - 1:
+          return self.max # values over max_value
+        return max(self.min, min(self.get_bucket_upper_bound(bucket), self.max))
+    return self.max
+
+  def mean(self):
+    if not self.count:
+      return 0
+    return self.total / self.count
+
+  def get_percentile_distribution(self):
+    """Returns [(percentile, value)] halving the distance to 100 at every step, like HdrHistogram prints"""
+    distribution = [ (0, self.min if self.min is not None else 0) ]
+    p = 50.
+    while self.count and 100 - p >= 100. / self.count / 2 and p < 99.9999:
+      distribution.append( (p, self.percentile(p)) )
+      p += (100 - p) / 2
+    distribution.append( (100, self.max if self.max is not None else 0) )
+    return distribution
+
+  def to_dict(self):
+    result = {
+      'Count': self.count,
+      'Min'  : self.min if self.min is not None else 0,
+      'Mean' : self.mean(),
+      'Max'  : self.max if self.max is not None else 0
+    }
+    for name, p in PERCENTILES:
+      result[name] = self.percentile(p)
+    return result
+
+
+class StageHistograms(object):
+  """Histograms of the time spent between consecutive trace stamps, see get_trace_stages.
+
+  Traces are recorded and read from different threads.
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.histograms = {}
+
+  def record(self, stage, value):
+    with self.lock:
+      histogram = self.histograms.get(stage)
+      if histogram is None:
+        histogram = self.histograms[stage] = Histogram()
+      histogram.record(value)
+
+  def record_trace(self, trace, stamps):
+    for stage, elapsed in get_trace_stages(trace, stamps):
+      self.record(stage, elapsed)
+
+  def reset(self):
+    with self.lock:
+      self.histograms = {}
+
+  def to_dict(self):
+    with self.lock:
+      return dict( (stage, histogram.to_dict()) for stage, histogram in self.histograms.iteritems() )
@@ -0,0 +1,740 @@
+__author__ = 'rodrigo'
+
+import bisect
+import datetime
+
+# The order book and the matching, without a database or the trade application. What happens around a match is
+# delegated to three objects:
+#   risk        - how much of an execution the balances of an account allow
+#   persistence - records the trades and the cancels
+#   publisher   - execution reports and market data
+# The defaults keep nothing and publish nothing, so the book can replay an order flow in memory for simulations.
+# The trade engine plugs in the database and the publications, see apps/trade/execution.py
+
+
+class OrderMixin(object):
+  """Price priority and matching of an order. Needs the attributes of MemoryOrder"""
+  __slots__ = ()  # or every MemoryOrder would get a __dict__ back
+
+  def __cmp__(self, other):
+    if self.is_buy and other.is_buy:
+      if self.type == '1' and other.type == '2':
+        return -1
+      elif self.type == '1' and other.type == '1':
+        if self.created > other.created:
+          return -1
+        else:
+          return 1
+      elif self.price > other.price:
+        return -1
+      elif self.price < other.price:
+        return  1
+      #elif self.created > other.created:
+      #  return  -1
+      else:
+        return  0
+    elif self.is_sell and other.is_sell:
+      if self.price < other.price:
+        return -1
+      elif self.price > other.price:
+        return  1
+      #elif self.created < other.created:
+      #  return  -1
+      else:
+        return  0
+
+  def has_match(self, other):
+    if (self.is_buy and other.is_sell) or (self.is_sell and other.is_buy):
+      if ( self.type == '1' and other.type == '2') or (self.type == '2' and other.type == '1'):
+        return True  # if one of the orders is a market order
+
+    if self.is_buy and other.is_sell and self.price >= other.price:
+        return True
+    elif self.is_sell and other.is_buy and self.price <= other.price:
+        return True
+    return  False
+
+  def match(self, other, execute_qty):
+    if (self.is_buy and other.is_sell) or (self.is_sell and other.is_buy):
+      if ( self.type == '1' and other.type == '2') or (self.type == '2' and other.type == '1'):
+        return min( execute_qty, other.leaves_qty)
+
+    if self.is_buy and other.is_sell:
+      if self.price >= other.price:
+        return min( execute_qty, other.leaves_qty)
+    elif self.is_sell and other.is_buy:
+      if self.price <= other.price:
+        return min( execute_qty, other.leaves_qty)
+    return  0
+
+  def cancel_qty(self, qty):
+    if qty == 0:
+      return
+    self.cxl_qty += qty
+    self.leaves_qty -= qty
+    self._adjust_status()
+
+  def _adjust_status(self):
+    if self.cum_qty == self.order_qty:
+      self.status = '2' # Fill
+    elif self.cum_qty + self.cxl_qty == self.order_qty :
+      self.status = '4' # Canceled
+    elif 0 < self.cum_qty < self.order_qty :
+      self.status = '1' # Partial fill
+    else:
+      self.status = '0' # New Order
+
+  def execute(self, qty, price ):
+    if qty == 0:
+      return
+
+    self.average_price = ((price * qty) + (self.cum_qty * self.average_price )) / ( self.cum_qty + qty )
+    self.cum_qty += qty
+    self.leaves_qty -= qty
+    self.last_price = price
+    self.last_qty = qty
+    self._adjust_status()
+
+  @property
+  def is_cancelled(self):
+    return self.status == '4'
+
+  @property
+  def has_leaves_qty(self):
+    return self.leaves_qty > 0
+
+  @property
+  def is_buy(self):
+    return self.side == '1'
+
+  @property
+  def is_sell(self):
+    return  self.side == '2'
+
+
+class MemoryOrder(OrderMixin):
+  __slots__ = ('id', 'user_id', 'account_id', 'username', 'account_username', 'broker_id', 'broker_username',
+               'client_order_id', 'status', 'symbol', 'side', 'type', 'time_in_force', 'price', 'order_qty',
+               'cum_qty', 'leaves_qty', 'created', 'last_price', 'last_qty', 'average_price', 'cxl_qty', 'fee')
+
+  def __init__(self, id, account_id, symbol, side, price, order_qty, type='2', user_id=None, username=None,
+               account_username=None, broker_id=None, broker_username=None, client_order_id=None,
+               time_in_force='1', fee=0, created=None):
+    self.id = id
+    self.user_id = account_id if user_id is None else user_id
+    self.account_id = account_id
+    self.username = username
+    self.account_username = account_username or username
+    self.broker_id = broker_id
+    self.broker_username = broker_username
+    self.client_order_id = client_order_id
+    self.status = '0'
+    self.symbol = symbol
+    self.side = side
+    self.type = type
+    self.time_in_force = time_in_force
+    self.price = price
+    self.order_qty = order_qty
+    self.cum_qty = 0
+    self.leaves_qty = order_qty
+    self.created = created or datetime.datetime.now()
+    self.last_price = 0
+    self.last_qty = 0
+    self.average_price = 0
+    self.cxl_qty = 0
+    self.fee = fee
+
+  def __repr__(self):
+    return "<MemoryOrder(id=%r, account_id=%r, symbol=%r, side=%r, type=%r, price=%r, order_qty=%r, cum_qty=%r, " \
+           "leaves_qty=%r, cxl_qty=%r, status=%r)>" % (self.id, self.account_id, self.symbol, self.side, self.type,
+           self.price, self.order_qty, self.cum_qty, self.leaves_qty, self.cxl_qty, self.status)
+
+
+class MemoryTrade(object):
+  __slots__ = ('id', 'order_id', 'counter_order_id', 'buyer_username', 'seller_username', 'side', 'symbol', 'size',
+               'price', 'created')
+
+  def __init__(self, id, order, counter_order, symbol, size, price):
+    self.id = id
+    self.order_id = order.id
+    self.counter_order_id = counter_order.id
+    self.buyer_username = order.account_username
+    self.seller_username = counter_order.account_username
+    if order.is_sell:
+      self.buyer_username, self.seller_username = self.seller_username, self.buyer_username
+    self.side = order.side
+    self.symbol = symbol
+    self.size = size
+    self.price = price
+    self.created = datetime.datetime.now()
+
+
+class ExecutionReport(object):
+  execution_id_generator = 0
+  def __init__(self, order, execution_side, execution_type=None, orig_client_order_id=None):
+    ExecutionReport.execution_id_generator += 1
+    self.execution_id = ExecutionReport.execution_id_generator
+
+    self.order_id = order.id
+    self.client_order_id = order.client_order_id
+    self.orig_client_order_id = orig_client_order_id
+    if execution_type:
+      self.execution_type  = execution_type
+    elif order.has_leaves_qty and order.cum_qty == 0:
+      self.execution_type  = '0'  # New
+    elif order.has_leaves_qty and order.cum_qty > 0 :
+      self.execution_type  = '1'  # Partial fill
+    elif not order.has_leaves_qty and (order.cum_qty == order.order_qty ) :
+      self.execution_type  = '2'  # fill
+    else :
+      self.execution_type  = '4'  # Cancel
+
+    self.order_type = order.type
+    self.time_in_force = order.time_in_force
+    self.order_status = order.status
+    self.symbol = order.symbol
+    self.side =  '1' if order.is_buy else '2'
+    self.last_price = order.last_price
+    self.last_shares = order.last_qty
+    self.leaves_qty = order.leaves_qty
+    self.cum_qty = order.cum_qty
+    self.cxl_qty = order.cxl_qty
+    self.average_price = order.average_price
+    self.order_qty = order.order_qty
+    self.price = order.price
+    self.execution_side = execution_side
+
+  def toJson(self):
+    resp = {
+      'MsgType':'8',
+      'OrderID': self.order_id,
+      'ClOrdID': self.client_order_id,
+      'ExecID': self.execution_id,
+      'ExecType':  self.execution_type,
+      'ExecSide': self.execution_side,
+      'OrdStatus': self.order_status,
+      'Symbol': self.symbol,
+      'Side': self.side,
+      'LastPx': self.last_price,
+      'OrderQty': self.order_qty,
+      'Price': self.price,
+      'LastShares': self.last_shares,
+      'LeavesQty': self.leaves_qty,
+      'CxlQty': self.cxl_qty,
+      'AvgPx': self.average_price,
+      'CumQty': self.cum_qty,
+      'TimeInForce': self.time_in_force,
+      'OrdType': self.order_type
+    }
+    if self.orig_client_order_id is not None:
+      resp['OrigClOrdID'] = self.orig_client_order_id
+    return  resp
+
+  def __str__(self):
+    return str(self.toJson())
+
+
+class RiskCheck(object):
+  """Lets every execution through"""
+  def get_available_qty_to_execute(self, context, order, side, qty, price):
+    return qty
+
+  def on_execution(self, context, order, counter_order, qty, price):
+    pass
+
+
+class MemoryBalances(RiskCheck):
+  """Balances kept in a dict of (account_id, currency) => amount, checked before every execution and settled
+  after it. The fees are not charged"""
+  def __init__(self, balances=None):
+    self.balances = balances if balances is not None else {}
+
+  def get_balance(self, account_id, currency):
+    return self.balances.get((account_id, currency), 0)
+
+  def get_available_qty_to_execute(self, context, order, side, qty, price):
+    if side == '1' : # buy
+      return min( qty, int((float(self.get_balance(order.account_id, order.symbol[3:]))/float(price)) * 1e8))
+    elif side == '2': # Sell
+      return min( qty, self.get_balance(order.account_id, order.symbol[:3]) )
+    return qty
+
+  def on_execution(self, context, order, counter_order, qty, price):
+    buyer, seller = (order, counter_order) if order.is_buy else (counter_order, order)
+    total = int(qty * price / 1e8)
+    price_currency = order.symbol[3:]
+    qty_currency = order.symbol[:3]
+    self.balances[(buyer.account_id, qty_currency)] = self.get_balance(buyer.account_id, qty_currency) + qty
+    self.balances[(buyer.account_id, price_currency)] = self.get_balance(buyer.account_id, price_currency) - total
+    self.balances[(seller.account_id, qty_currency)] = self.get_balance(seller.account_id, qty_currency) - qty
+    self.balances[(seller.account_id, price_currency)] = self.get_balance(seller.account_id, price_currency) + total
+
+
+class Persistence(object):
+  """Records nothing. The trades are MemoryTrade numbered from 1"""
+  def __init__(self):
+    self.last_trade_id = 0
+
+  def begin_match(self, session):
+    """ returns the context of a match, handed to every call of the risk check and of the persistence """
+    return None
+
+  def create_trade(self, context, order, counter_order, symbol, qty, price):
+    self.last_trade_id += 1
+    return MemoryTrade(self.last_trade_id, order, counter_order, symbol, qty, price)
+
+  def end_match(self, context, executions):
+    """ executions are (trade, order) for both orders of every trade """
+    pass
+
+  def save_cancel(self, session, order):
+    pass
+
+  def save_replace(self, session, order):
+    pass
+
+  def save_mass_cancel(self, session, orders):
+    pass
+
+
+class Publisher(object):
+  """Publishes nothing. publish_new_order and publish_update_order get the 0 based position of the order,
+  publish_cancel_order the 1 based one and publish_executions the number of orders removed from the top of the book"""
+  def publish_execution_report(self, user_id, execution_report):
+    pass
+
+  def publish_new_order(self, symbol, entry_type, order_position, order):
+    pass
+
+  def publish_executions(self, symbol, entry_type, executed_count, order=None):
+    pass
+
+  def publish_cancel_order(self, symbol, entry_type, order_position):
+    pass
+
+  def publish_cancel_orders(self, symbol, entry_type, order_positions):
+    """ order_positions are the 1 based positions of the orders, in the book before any of them was removed """
+    for order_position in reversed(order_positions):
+      self.publish_cancel_order(symbol, entry_type, order_position)
+
+  def publish_update_order(self, symbol, entry_type, order_position, order):
+    pass
+
+  def publish_trades(self, symbol, trades):
+    pass
+
+
+class OrderBook(object):
+  def __init__(self, symbol, risk=None, persistence=None, publisher=None):
+    self.symbol      = symbol
+    self.buy_side    = []
+    self.sell_side   = []
+    self.bid         = 0
+    self.ask         = 0
+    self.risk        = risk or RiskCheck()
+    self.persistence = persistence or Persistence()
+    self.publisher   = publisher or Publisher()
+
+    # the orders in the book by account_id and by user_id, for the mass cancels
+    self.orders_by_account = {}
+    self.orders_by_user    = {}
+    self.index_keys        = {}
+
+  def __str__(self):
+    res = ""
+    for order in reversed(self.sell_side):
+      res += str(order) + '\n'
+    res += '-' + '\n'
+    for order in self.buy_side:
+      res += str(order) + '\n'
+    return  res[:-1]
+
+
+  def match(self, session, order, rpt_order=None):
+    other_side = []
+    self_side = []
+    if order.is_buy:
+      self_side = self.buy_side
+      other_side = self.sell_side
+    elif order.is_sell:
+      other_side = self.buy_side
+      self_side = self.sell_side
+
+
+    execution_reports = []
+    trades_to_publish = []
+    trades_to_notify = []
+    context = self.persistence.begin_match(session)
+
+    execution_side = '1' if order.is_buy else '2'
+
+    if rpt_order is None:
+      rpt_order  = ExecutionReport( order, execution_side )
+    execution_reports.append( ( order.user_id, rpt_order )  )
+    if order.user_id != order.account_id:
+      execution_reports.append( ( order.account_id, rpt_order )  )
+
+    is_last_match_a_partial_execution_on_counter_order = False
+    execution_counter = 0
+    number_of_filled_counter_market_orders = 0
+    for execution_counter in xrange(0, len(other_side) + 1):
+      if execution_counter == len(other_side):
+        break # workaround to make the execution_counter be counted until the last order.
+
+      counter_order = other_side[execution_counter]
+
+      if not order.has_match(counter_order):
+        break
+
+      # check for self execution
+      if order.account_id == counter_order.account_id:
+        # self execution.... let's cancel the counter order
+        counter_order.cancel_qty( counter_order.leaves_qty )
+
+        # generate a cancel report
+        cancel_rpt_counter_order  = ExecutionReport( counter_order, execution_side )
+        execution_reports.append( ( counter_order.user_id, cancel_rpt_counter_order )  )
+        if counter_order.user_id != counter_order.account_id:
+          execution_reports.append( ( counter_order.account_id, cancel_rpt_counter_order )  )
+
+        # go to the next order
+        is_last_match_a_partial_execution_on_counter_order = False
+        continue
+
+      # Get the desired executed price and qty, by matching against the counter_order
+      executed_qty = order.match( counter_order, order.leaves_qty)
+
+      if counter_order.type == '1': # Market Order
+        executed_price = order.price
+        number_of_filled_counter_market_orders += 1
+      else:
+        executed_price = counter_order.price
+
+      # let's get the available qty to execute on the order side
+      available_qty_on_order_side = self.risk.get_available_qty_to_execute(context,
+                                                                           order,
+                                                                           '1' if order.is_buy else '2',
+                                                                           executed_qty,
+                                                                           executed_price)
+
+      qty_to_cancel_from_order = 0
+      if available_qty_on_order_side <  executed_qty:
+        # ops ... looks like the order.user didn't have enough to execute the order
+        executed_qty = available_qty_on_order_side
+
+        # cancel the remaining  qty
+        qty_to_cancel_from_order = order.leaves_qty - executed_qty
+
+
+      # check if the order got fully cancelled
+      if not executed_qty:
+        order.cancel_qty( qty_to_cancel_from_order )
+        cancel_rpt_order  = ExecutionReport( order, execution_side )
+        execution_reports.append( ( order.user_id, cancel_rpt_order )  )
+        if order.user_id != order.account_id:
+          execution_reports.append( ( order.account_id, cancel_rpt_order )  )
+        break
+
+
+      # let's get the available qty to execute on the counter side
+      available_qty_on_counter_side = self.risk.get_available_qty_to_execute(context,
+                                                                             counter_order,
+                                                                             '1' if counter_order.is_buy else '2',
+                                                                             executed_qty,
+                                                                             executed_price)
+
+      qty_to_cancel_from_counter_order = 0
+      if available_qty_on_counter_side <  executed_qty:
+        if qty_to_cancel_from_order:
+          qty_to_cancel_from_order -= executed_qty - available_qty_on_order_side
+
+          # ops ... looks like the counter_order.user didn't have enough to execute the order
+        executed_qty = available_qty_on_counter_side
+
+        # cancel the remaining  qty
+        qty_to_cancel_from_counter_order = counter_order.leaves_qty - executed_qty
+
+
+      # check if the counter order was fully cancelled due the lack
+      if not executed_qty:
+        # just cancel the counter order, and go to the next order.
+        counter_order.cancel_qty( qty_to_cancel_from_counter_order )
+
+        # generate a cancel report
+        cancel_rpt_counter_order  = ExecutionReport( counter_order, execution_side )
+        execution_reports.append( ( counter_order.user_id, cancel_rpt_counter_order )  )
+        if counter_order.user_id != counter_order.account_id:
+          execution_reports.append( ( counter_order.account_id, cancel_rpt_counter_order )  )
+
+        # go to the next order
+        is_last_match_a_partial_execution_on_counter_order = False
+        continue
+
+      # lets perform the execution
+      if executed_qty:
+        order.execute( executed_qty, executed_price )
+        counter_order.execute(executed_qty, executed_price )
+
+        trade = self.persistence.create_trade(context, order, counter_order, self.symbol, executed_qty,
+                                              executed_price)
+        self.risk.on_execution(context, order, counter_order, executed_qty, executed_price)
+        trades_to_publish.append(trade)
+
+        trades_to_notify.append( (trade, order) )
+        trades_to_notify.append( (trade, counter_order) )
+
+        rpt_order         = ExecutionReport( order, execution_side )
+        execution_reports.append( ( order.user_id, rpt_order )  )
+        if order.user_id != order.account_id:
+          execution_reports.append( ( order.account_id, rpt_order )  )
+
+        rpt_counter_order = ExecutionReport( counter_order, execution_side )
+        execution_reports.append( ( counter_order.user_id, rpt_counter_order )  )
+        if counter_order.user_id != counter_order.account_id:
+          execution_reports.append( ( counter_order.account_id, rpt_counter_order )  )
+
+      #
+      # let's do the partial cancels
+      #
+
+      # Cancel the qty from the current order
+      if qty_to_cancel_from_order:
+        order.cancel_qty(qty_to_cancel_from_order)
+
+        # generate a cancel report
+        cancel_rpt_order  = ExecutionReport( order, execution_side )
+        execution_reports.append( ( order.user_id, cancel_rpt_order )  )
+
+        if order.user_id != order.account_id:
+          execution_reports.append( ( order.account_id, cancel_rpt_order )  )
+
+
+      if qty_to_cancel_from_counter_order:
+        counter_order.cancel_qty(qty_to_cancel_from_counter_order)
+
+        # generate a cancel report
+        cancel_rpt_counter_order  = ExecutionReport( counter_order, execution_side )
+        execution_reports.append( ( counter_order.user_id, cancel_rpt_counter_order )  )
+        if counter_order.user_id != counter_order.account_id:
+          execution_reports.append( ( counter_order.account_id, cancel_rpt_counter_order )  )
+
+      if counter_order.has_leaves_qty:
+        is_last_match_a_partial_execution_on_counter_order = True
+
+    self.persistence.end_match(context, trades_to_notify)
+
+    md_entry_type = '0' if order.is_buy else '1'
+    counter_md_entry_type = '1' if order.is_buy else '0'
+
+    # let's include the order in the book if the order is not fully executed.
+    if order.has_leaves_qty:
+      insert_pos = bisect.bisect_right(self_side, order)
+      self_side.insert( insert_pos, order )
+      self._add_to_index(order)
+
+      if order.type == '2': # Limited orders go to the book.
+        self.publisher.publish_new_order( self.symbol, md_entry_type , insert_pos, order)
+
+    # don't send the first execution report (NEW) if the order was fully cancelled
+    if order.is_cancelled and order.cum_qty == 0:
+      execution_reports.pop(0)
+
+    # Publish all execution reports
+    for user_id, execution_report in execution_reports:
+      self.publisher.publish_execution_report( user_id, execution_report )
+
+    # Publish Market Data for the counter order
+    if execution_counter:
+      if is_last_match_a_partial_execution_on_counter_order:
+        for removed_order in other_side[0: execution_counter-1]:
+          self._remove_from_index(removed_order)
+        del other_side[0: execution_counter-1]
+        self.publisher.publish_executions( self.symbol,
+                                           counter_md_entry_type,
+                                           execution_counter - 1 - number_of_filled_counter_market_orders,
+                                           other_side[0] )
+      else:
+        for removed_order in other_side[0: execution_counter]:
+          self._remove_from_index(removed_order)
+        del other_side[0: execution_counter]
+        self.publisher.publish_executions( self.symbol,
+                                           counter_md_entry_type,
+                                           execution_counter - number_of_filled_counter_market_orders )
+
+    if trades_to_publish:
+      self.publisher.publish_trades(self.symbol, trades_to_publish)
+    return ""
+
+
+  def cancel(self, session, order):
+    if not order:
+      # Generate an Order Cancel Reject - Order not found
+      return
+
+    self_side, order_pos = self.find_order(order)
+    if order_pos is None:
+      # Generate an Order Cancel Reject - Order not found
+      return
+
+    # update the order
+    order.cancel_qty( order.leaves_qty )
+    self.persistence.save_cancel(session, order)
+
+    # remove the order from the book
+    self._remove_from_index(self_side.pop( order_pos ))
+
+
+    # Generate a cancel report
+    cancel_rpt = ExecutionReport( order, '1' if order.is_buy else '2' )
+    self.publisher.publish_execution_report(order.user_id, cancel_rpt )
+
+    if order.user_id != order.account_id:
+      self.publisher.publish_execution_report(order.account_id, cancel_rpt )
+
+
+    # market data
+    md_entry_type = '0' if order.is_buy else '1'
+    self.publisher.publish_cancel_order( self.symbol, md_entry_type, order_pos+1 )
+
+    return ""
+
+
+  def replace(self, session, order, order_qty, price=None, client_order_id=None):
+    if not order:
+      # Generate an Order Cancel Reject - Order not found
+      return
+
+    self_side, order_pos = self.find_order(order)
+    if order_pos is None:
+      # Generate an Order Cancel Reject - Order not found
+      return
+
+    if price is None:
+      price = order.price
+
+    if order_qty - order.cum_qty - order.cxl_qty <= 0:
+      # nothing left to be executed
+      return self.cancel(session, order)
+
+    orig_client_order_id = None
+    if client_order_id is not None and client_order_id != order.client_order_id:
+      orig_client_order_id = order.client_order_id
+      order.client_order_id = client_order_id
+
+    md_entry_type = '0' if order.is_buy else '1'
+    execution_side = '1' if order.is_buy else '2'
+
+    if price == order.price and order_qty <= order.order_qty:
+      # a quantity reduction keeps the order's priority
+      order.leaves_qty -= order.order_qty - order_qty
+      order.order_qty = order_qty
+      order._adjust_status()
+      self.persistence.save_replace(session, order)
+
+      replace_rpt = ExecutionReport( order, execution_side, '5', orig_client_order_id )
+      self.publisher.publish_execution_report(order.user_id, replace_rpt )
+      if order.user_id != order.account_id:
+        self.publisher.publish_execution_report(order.account_id, replace_rpt )
+
+      if order.type == '2':
+        self.publisher.publish_update_order( self.symbol, md_entry_type, order_pos, order )
+      return ""
+
+    # a new price or a bigger quantity sends the order to the end of the queue, where it might also match
+    self._remove_from_index(self_side.pop( order_pos ))
+    if order.type == '2':
+      self.publisher.publish_cancel_order( self.symbol, md_entry_type, order_pos+1 )
+
+    order.leaves_qty += order_qty - order.order_qty
+    order.order_qty = order_qty
+    order.price = price
+    order.created = datetime.datetime.now() # the books are loaded in this order
+    order._adjust_status()
+    self.persistence.save_replace(session, order)
+
+    return self.match(session, order, ExecutionReport( order, execution_side, '5', orig_client_order_id ))
+
+
+  def mass_cancel(self, session, account_id=None, user_id=None, side=None):
+    """ cancels the orders of an account, or the ones sent by an user, optionally only on one side of the book.
+    Returns the cancelled orders """
+    if account_id is not None:
+      orders = self.orders_by_account.get(account_id)
+    else:
+      orders = self.orders_by_user.get(user_id)
+
+    if not orders:
+      return []
+
+    order_ids = set( order.id for order in orders.itervalues() if side is None or order.side == side )
+    if not order_ids:
+      return []
+
+    # a single pass over each side of the book, keeping the positions for the market data
+    cancelled_orders = []
+    removed_positions = {}
+    for md_entry_type, self_side in (('0', self.buy_side), ('1', self.sell_side)):
+      remaining_orders = []
+      for order_pos, order in enumerate(self_side):
+        if order.id in order_ids:
+          cancelled_orders.append(order)
+          removed_positions.setdefault(md_entry_type, []).append(order_pos + 1)
+        else:
+          remaining_orders.append(order)
+      if md_entry_type in removed_positions:
+        self_side[:] = remaining_orders
+
+    for order in cancelled_orders:
+      order.cancel_qty( order.leaves_qty )
+      self._remove_from_index(order)
+    self.persistence.save_mass_cancel(session, cancelled_orders)
+
+    for order in cancelled_orders:
+      cancel_rpt = ExecutionReport( order, '1' if order.is_buy else '2' )
+      self.publisher.publish_execution_report(order.user_id, cancel_rpt )
+      if order.user_id != order.account_id:
+        self.publisher.publish_execution_report(order.account_id, cancel_rpt )
+
+    for md_entry_type, order_positions in sorted(removed_positions.items()):
+      self.publisher.publish_cancel_orders( self.symbol, md_entry_type, order_positions )
+
+    return cancelled_orders
+
+
+  def _add_to_index(self, order):
+    self.orders_by_account.setdefault(order.account_id, {})[order.id] = order
+    self.orders_by_user.setdefault(order.user_id, {})[order.id] = order
+    self.index_keys[order.id] = (order.account_id, order.user_id)
+
+  def _remove_from_index(self, order):
+    keys = self.index_keys.pop(order.id, None)
+    if keys is None:
+      return
+    for index, key in ((self.orders_by_account, keys[0]), (self.orders_by_user, keys[1])):
+      orders = index[key]
+      del orders[order.id]
+      if not orders:
+        del index[key]
+
+
+  def find_order(self, order):
+    """ returns the side of the book of the order and its position there, None if the order isn't in the book """
+    self_side = []
+    if order.is_buy:
+      self_side = self.buy_side
+    elif order.is_sell:
+      self_side = self.sell_side
+
+    order_pos = bisect.bisect_left(self_side, order)
+    for x in xrange( order_pos, len(self_side)):
+      tmp_order = self_side[x]
+
+      if tmp_order.id == order.id:
+        return self_side, order_pos
+
+      if tmp_order.price != order.price:
+        break
+
+      order_pos += 1
+
+    return self_side, None
@@ -0,0 +1,185 @@
+import gc
+import sys
+import time
+import resource
+from collections import deque, OrderedDict
+
+CONTAINER_TYPES = (dict, list, tuple, set, frozenset, deque)
+
+def get_rss():
+  """ resident set size of the process in bytes """
+  try:
+    with open('/proc/self/status') as status_file:
+      for line in status_file:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1]) * 1024
+  except IOError:
+    pass
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # the peak, where there is no /proc
+
+def get_type_name(obj):
+  obj_type = type(obj)
+  module = getattr(obj_type, '__module__', None)
+  if module in (None, '__builtin__'):
+    return obj_type.__name__
+  return module + '.' + obj_type.__name__
+
+def count_objects():
+  """ type name => [ count, bytes ] of the objects tracked by the garbage collector.
+
+  Only containers and instances are tracked, the strings and numbers they hold are not counted.
+  """
+  counts = {}
+  for obj in gc.get_objects():
+    type_name = get_type_name(obj)
+    type_count = counts.get(type_name)
+    if type_count is None:
+      type_count = counts[type_name] = [0, 0]
+    type_count[0] += 1
+    type_count[1] += sys.getsizeof(obj, 0)
+  return counts
+
+def get_deep_size(obj, max_objects=100000):
+  """ bytes and objects reachable from obj through the builtin containers.
+
+  The other objects found are counted with their __dict__, but not followed, so a book of orders doesn't
+  bring in the whole database session the orders are attached to. Stops counting after max_objects.
+  """
+  seen = set()
+  size = 0
+  pending = [ obj ]
+  while pending and len(seen) < max_objects:
+    item = pending.pop()
+    if id(item) in seen:
+      continue
+    seen.add(id(item))
+    size += sys.getsizeof(item, 0)
+
+    if isinstance(item, dict):
+      pending.extend(item.iterkeys())
+      pending.extend(item.itervalues())
+    elif isinstance(item, CONTAINER_TYPES):
+      pending.extend(item)
+    else:
+      attributes = getattr(item, '__dict__', None)
+      if isinstance(attributes, dict) and id(attributes) not in seen:
+        seen.add(id(attributes))
+        size += sys.getsizeof(attributes, 0)
+
+  return size, len(seen), len(seen) >= max_objects
+
+def get_structure_sizes(structures):
+  result = {}
+  for name, obj in structures.iteritems():
+    try:
+      length = len(obj)
+    except TypeError:
+      length = None
+    size, objects, truncated = get_deep_size(obj)
+    result[name] = { 'Length': length, 'Bytes': size, 'Objects': objects, 'Truncated': truncated }
+  return result
+
+def get_memory_report(structures, limit=50):
+  """ RSS, the types with most bytes and the sizes of the structures, a dict of name => object.
+
+  Walks the whole heap, it blocks the process for as long as that takes.
+  """
+  counts = count_objects()
+  types = sorted(counts.iteritems(), key=lambda item: item[1][1], reverse=True)
+  return {
+    'Timestamp' : time.time(),
+    'RSS'       : get_rss(),
+    'GCObjects' : sum( count for count, size in counts.itervalues() ),
+    'GCCounts'  : gc.get_count(),
+    'Types'     : [ { 'Type': type_name, 'Count': count, 'Bytes': size }
+                    for type_name, (count, size) in types[:limit] ],
+    'Structures': get_structure_sizes(structures)
+  }
+
+
+class HeapSnapshots(object):
+  """Object counts by type taken at different times, kept by name so any two of them can be compared.
+
+  Only the counts are kept, never the objects, so a snapshot doesn't hold what it counted alive. The oldest
+  snapshot is dropped when there are more than max_snapshots.
+  """
+  def __init__(self, max_snapshots=10):
+    self.max_snapshots = max_snapshots
+    self.snapshots = OrderedDict()
+
+  def capture(self, name, structures):
+    gc.collect()
+    return {
+      'Name'      : name,
+      'Timestamp' : time.time(),
+      'RSS'       : get_rss(),
+      'Types'     : count_objects(),
+      'Structures': get_structure_sizes(structures or {})
+    }
+
+  def take(self, name=None, structures=None):
+    snapshot = self.capture(name or time.strftime('%Y%m%d-%H%M%S'), structures)
+    self.snapshots.pop(snapshot['Name'], None)
+    self.snapshots[snapshot['Name']] = snapshot
+    while len(self.snapshots) > self.max_snapshots:
+      self.snapshots.popitem(last=False)
+    return self.get_summary(snapshot)
+
+  def get_summary(self, snapshot):
+    return {
+      'Name'      : snapshot['Name'],
+      'Timestamp' : snapshot['Timestamp'],
+      'RSS'       : snapshot['RSS'],
+      'Objects'   : sum( count for count, size in snapshot['Types'].itervalues() )
+    }
+
+  def list(self):
+    return [ self.get_summary(snapshot) for snapshot in self.snapshots.itervalues() ]
+
+  def diff(self, from_name, to_name=None, limit=50, structures=None):
+    """ types whose count changed most between two snapshots. Without to_name, compares with the heap now """
+    if from_name not in self.snapshots:
+      raise KeyError(from_name)
+    before = self.snapshots[from_name]
+    if to_name:
+      if to_name not in self.snapshots:
+        raise KeyError(to_name)
+      after = self.snapshots[to_name]
+    else:
+      after = self.capture(None, structures)
+
+    types = []
+    for type_name in set(before['Types']) | set(after['Types']):
+      count_before, size_before = before['Types'].get(type_name, (0, 0))
+      count_after, size_after = after['Types'].get(type_name, (0, 0))
+      if count_before != count_after or size_before != size_after:
+        types.append({
+          'Type'        : type_name,
+          'Count'       : count_after,
+          'CountDelta'  : count_after - count_before,
+          'Bytes'       : size_after,
+          'BytesDelta'  : size_after - size_before
+        })
+    types.sort(key=lambda item: (abs(item['CountDelta']), abs(item['BytesDelta'])), reverse=True)
+
+    structures_delta = {}
+    for name, sizes in after['Structures'].iteritems():
+      sizes_before = before['Structures'].get(name, { 'Length': 0, 'Bytes': 0 })
+      length_delta = None
+      if sizes['Length'] is not None and sizes_before['Length'] is not None:
+        length_delta = sizes['Length'] - sizes_before['Length']
+      structures_delta[name] = {
+        'Length'      : sizes['Length'],
+        'LengthDelta' : length_delta,
+        'Bytes'       : sizes['Bytes'],
+        'BytesDelta'  : sizes['Bytes'] - sizes_before['Bytes']
+      }
+
+    return {
+      'From'        : before['Name'],
+      'To'          : after['Name'],
+      'Seconds'     : after['Timestamp'] - before['Timestamp'],
+      'RSSDelta'    : after['RSS'] - before['RSS'],
+      'Types'       : types[:limit],
+      'Structures'  : structures_delta
+    }
@@ -27,6 +27,14 @@ class InvalidMessageFieldException(InvalidMessageException):
   def __str__(self):
     return 'Invalid value tag(%s)=%s'%(self.tag, self.value)
 
+# read-only requests that can be answered by the query service instead of the trade engine.
+# U36 (TradersRankRequest) is not one of them: the rank is kept in the memory of the trade engine
+QUERY_SERVICE_MESSAGE_TYPES = ( 'U26',   # WithdrawListRequest
+                                'U30',   # DepositListRequest
+                                'U32',   # TradeHistoryRequest
+                                'U34',   # LedgerListRequest
+                                'B2' )   # CustomerListRequest
+
 class BaseMessage(object):
   MAX_MESSAGE_LENGTH = 4096
   def __init__(self, raw_message):
@@ -47,6 +55,7 @@ class BaseMessage(object):
 
 class JsonMessage(BaseMessage):
   MAX_MESSAGE_LENGTH = 40096*10
+  MAX_NEW_ORDER_LIST_LENGTH = 100
   def raise_exception_if_required_tag_is_missing(self, tag):
     if tag not in self.message:
       raise InvalidMessageMissingTagException(self.raw_message, self.message, tag)
@@ -112,7 +121,11 @@ class JsonMessage(BaseMessage):
       'BE':  'UserRequest',
       'BF':  'UserResponse',
       'D':   'NewOrderSingle',
+      'E':   'NewOrderList',
       'F':   'OrderCancelRequest',
+      'G':   'OrderCancelReplaceRequest',
+      'q':   'OrderMassCancelRequest',
+      'r':   'OrderMassCancelReport',
       'x':   'SecurityListRequest',
       'y':   'SecurityList',
       'e':   'SecurityStatusRequest',
@@ -196,6 +209,14 @@ class JsonMessage(BaseMessage):
       # Administrative messages
       'A0':  'DbQueryRequest',
       'A1':  'DbQueryResponse',
+      'A2':  'TraceStatsRequest',
+      'A3':  'TraceStatsResponse',
+      'A4':  'EngineMetricsRequest',
+      'A5':  'EngineMetricsResponse',
+      'A6':  'ProfilerRequest',
+      'A7':  'ProfilerResponse',
+      'A8':  'MemoryRequest',
+      'A9':  'MemoryResponse',
 
       'ERROR': 'ErrorMessage',
     }
@@ -323,6 +344,24 @@ class JsonMessage(BaseMessage):
 
       #TODO: Validate all fields of New Order Single Message
 
+    elif self.type == 'E':  #New Order List
+      self.raise_exception_if_required_tag_is_missing('ListID')
+      self.raise_exception_if_required_tag_is_missing('ListOrdGrp')
+
+      order_list = self.get('ListOrdGrp')
+      if not isinstance(order_list, list) or not 0 < len(order_list) <= self.MAX_NEW_ORDER_LIST_LENGTH:
+        raise InvalidMessageFieldException(self.raw_message, self.message, 'ListOrdGrp', order_list)
+
+      # every order of the list is validated as a New Order Single
+      self.new_order_list = []
+      for order in order_list:
+        if not isinstance(order, dict):
+          raise InvalidMessageFieldException(self.raw_message, self.message, 'ListOrdGrp', order)
+        try:
+          self.new_order_list.append( JsonMessage( json.dumps( dict(order, MsgType='D') ) ) )
+        except InvalidMessageException, e:
+          raise e.__class__(self.raw_message, self.message, e.tag, e.value)
+
     elif self.type == 'B': # News
       self.raise_exception_if_required_tag_is_missing('Headline')
       self.raise_exception_if_required_tag_is_missing('LinesOfText')
@@ -355,6 +394,31 @@ class JsonMessage(BaseMessage):
       pass
       #TODO: Validate all fields of Order Cancel Message
 
+    elif self.type == 'G':  #Order Cancel Replace Request
+      if "OrigClOrdID" not in self.message and "OrderID" not in self.message:
+        raise InvalidMessageMissingTagException(self.raw_message, self.message, "OrigClOrdID,OrderID")
+
+      self.raise_exception_if_required_tag_is_missing('OrderQty')
+      self.raise_exception_if_not_a_integer('OrderQty')
+      self.raise_exception_if_not_greater_than_zero('OrderQty')
+
+      if 'Price' in self.message:
+        self.raise_exception_if_not_a_integer('Price')
+        self.raise_exception_if_not_greater_than_zero('Price')
+
+    elif self.type == 'q':  #Order Mass Cancel Request
+      self.raise_exception_if_required_tag_is_missing('ClOrdID')
+
+      self.raise_exception_if_required_tag_is_missing('MassCancelRequestType')
+      self.raise_exception_if_not_in('MassCancelRequestType', ( '1', '7' )) # by security or all orders
+
+      if self.get('MassCancelRequestType') == '1':
+        self.raise_exception_if_required_tag_is_missing('Symbol')
+        self.raise_exception_if_empty('Symbol')
+
+      if 'Side' in self.message:
+        self.raise_exception_if_not_in('Side', ( '1', '2' ))
+
     elif self.type == 'U2' :  # User Balance
       self.raise_exception_if_required_tag_is_missing('BalanceReqID')
 
@@ -563,6 +627,30 @@ class JsonMessage(BaseMessage):
     elif self.type == 'B9': # Verify Customer Response
       self.raise_exception_if_required_tag_is_missing('VerifyCustomerReqID')
 
+    elif self.type == 'A2': # Trace Stats Request
+      self.raise_exception_if_required_tag_is_missing('TraceStatsReqID')
+
+    elif self.type == 'A4': # Engine Metrics Request
+      self.raise_exception_if_required_tag_is_missing('EngineMetricsReqID')
+
+    elif self.type == 'A6': # Profiler Request
+      self.raise_exception_if_required_tag_is_missing('ProfilerReqID')
+      self.raise_exception_if_not_in('Action', ['start', 'stop', 'status'])
+      if self.get('Action') == 'start':
+        self.raise_exception_if_not_greater_than_zero('Seconds')
+        if self.has('Interval'):
+          self.raise_exception_if_not_greater_than_zero('Interval')
+        if self.has('Mode'):
+          self.raise_exception_if_not_in('Mode', ['cpu', 'wall'])
+
+    elif self.type == 'A8': # Memory Request
+      self.raise_exception_if_required_tag_is_missing('MemoryReqID')
+      self.raise_exception_if_not_in('Action', ['report', 'snapshot', 'list', 'diff'])
+      if self.get('Action') == 'diff':
+        self.raise_exception_if_empty('From')
+      if self.has('Limit'):
+        self.raise_exception_if_not_greater_than_zero('Limit')
+
 
   def has(self, attr):
     return attr in self.message
@@ -0,0 +1,125 @@
+import os
+import time
+import signal
+import tempfile
+
+TIMERS = {
+  'cpu' : (signal.ITIMER_PROF, signal.SIGPROF),   # process cpu time, a process waiting on its sockets isn't sampled
+  'wall': (signal.ITIMER_REAL, signal.SIGALRM)    # wall clock time, the waits are sampled as well
+}
+
+class SamplingProfiler(object):
+  """Statistical profiler of the main thread of a running process.
+
+  A signal timer interrupts the process every interval seconds and the handler counts the stack it interrupted,
+  keyed by the tag of the work being done (the MsgType of the request being processed). When it stops, the counts
+  are written as collapsed stacks, one "tag;outermost;...;innermost count" line per stack, the input of
+  flamegraph.pl and speedscope.
+
+  Signals are only delivered to the main thread, so other threads are never sampled, and it must be started
+  and stopped from the main thread.
+  """
+  def __init__(self, name, output_dir=None, max_depth=100):
+    self.name = name
+    self.output_dir = output_dir or tempfile.gettempdir()
+    self.max_depth = max_depth
+    self.tag = None
+    self.running = False
+    self.mode = None
+    self.interval = None
+    self.filename = None
+    self.reset()
+
+  def reset(self):
+    self.stacks = {}
+    self.tags = {}
+    self.samples = 0
+    self.start_time = None
+    self.stop_time = None
+
+  def set_tag(self, tag):
+    self.tag = tag
+    if tag is not None and self.running:
+      self.tags[tag] = self.tags.get(tag, 0) + 1
+
+  def start(self, seconds, interval=0.005, mode='cpu'):
+    if self.running:
+      raise ValueError('The profiler is already running')
+    if mode not in TIMERS:
+      raise ValueError('Invalid profiler mode ' + str(mode))
+    if seconds <= 0 or interval <= 0:
+      raise ValueError('Invalid profiler duration')
+
+    self.reset()
+    self.mode = mode
+    self.interval = interval
+    self.filename = None
+    timer, signal_number = TIMERS[mode]
+
+    self.previous_handler = signal.signal(signal_number, self.on_sample)
+    # restart the system calls interrupted by the timer instead of failing them with EINTR
+    signal.siginterrupt(signal_number, False)
+
+    self.start_time = time.time()
+    self.stop_time = self.start_time + seconds
+    self.running = True
+    signal.setitimer(timer, interval, interval)
+
+  def on_sample(self, signal_number, frame):
+    if not self.running:
+      return
+    stack = []
+    while frame is not None and len(stack) < self.max_depth:
+      stack.append(frame.f_code)
+      frame = frame.f_back
+    key = (self.tag, tuple(stack))
+    self.stacks[key] = self.stacks.get(key, 0) + 1
+    self.samples += 1
+
+  def get_timeout(self):
+    """ seconds until the profiler must be stopped, None when it isn't running """
+    if not self.running:
+      return None
+    return max(0, self.stop_time - time.time())
+
+  def is_expired(self):
+    return self.running and time.time() >= self.stop_time
+
+  def stop(self):
+    if not self.running:
+      return self.get_status()
+
+    timer, signal_number = TIMERS[self.mode]
+    signal.setitimer(timer, 0)
+    signal.signal(signal_number, self.previous_handler or signal.SIG_DFL)
+    self.running = False
+    self.stop_time = time.time()
+
+    self.filename = os.path.join(self.output_dir, '%s-%s.collapsed' % (
+      self.name, time.strftime('%Y%m%d-%H%M%S', time.localtime(self.start_time))))
+    with open(self.filename, 'w') as collapsed_file:
+      collapsed_file.write(self.get_collapsed_stacks())
+    return self.get_status()
+
+  def get_collapsed_stacks(self):
+    lines = {}
+    for (tag, stack), count in self.stacks.iteritems():
+      frames = [ 'MsgType=' + str(tag) ]
+      for code in reversed(stack):
+        frames.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+      line = ';'.join(frames)
+      lines[line] = lines.get(line, 0) + count  # truncated stacks may collapse into the same line
+
+    return ''.join( '%s %d\n' % (line, count) for line, count in sorted(lines.iteritems()) )
+
+  def get_status(self):
+    return {
+      'Running'   : self.running,
+      'Mode'      : self.mode,
+      'Interval'  : self.interval,
+      'StartTime' : self.start_time,
+      'StopTime'  : self.stop_time,
+      'Samples'   : self.samples,
+      'MsgTypes'  : self.tags,
+      'Filename'  : self.filename
+    }
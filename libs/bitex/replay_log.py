@@ -0,0 +1,235 @@
+__author__ = 'rodrigo'
+
+import os
+import re
+import glob
+import time
+import struct
+import datetime
+import threading
+from collections import deque
+
+# Append only binary replay log.
+#
+# The log is a sequence of segment files named <filename>.<seq>, each one starting with MAGIC and followed by
+# length prefixed records:
+#
+#   uint32 body length | float64 timestamp | body
+#
+# where body is "command\0key\0value" encoded in utf-8. Whenever a segment is closed a line is appended to
+# <filename>.index with "seq,first timestamp,last timestamp,number of records,segment filename", so a time range
+# can be located without reading the segments.
+#
+# Records are buffered and written by a background thread, so logging never waits for the disk.
+
+MAGIC = 'BTXRLOG1'
+RECORD_HEADER = struct.Struct('<Id')
+
+TEXT_LINE_REGEX = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),(\d{3}) - (.*)$')
+
+
+def to_text(value):
+  if isinstance(value, unicode):
+    return value
+  if isinstance(value, str):
+    return value.decode('utf-8', 'replace')
+  try:
+    return unicode(str(value), 'utf-8', 'replace')
+  except Exception:
+    try:
+      return unicode(value)
+    except Exception:
+      return u' [object]'
+
+
+def format_text_line(timestamp, command, key, value=None):
+  """Returns the record formatted as a line of the text replay log"""
+  log_msg = command + u',' + key if key else command
+  if value:
+    log_msg += u',' + value
+  local_time = time.localtime(timestamp)
+  return u'%s,%03d - %s' % (time.strftime('%Y-%m-%d %H:%M:%S', local_time), int(timestamp * 1000) % 1000, log_msg)
+
+
+def parse_text_line(line):
+  """Parses a line of the text replay log. Returns (timestamp, command, key, value) or None"""
+  match = TEXT_LINE_REGEX.match(line.rstrip('\r\n'))
+  if not match:
+    return None
+
+  log_time, milliseconds, log_msg = match.groups()
+  timestamp = time.mktime(time.strptime(log_time, '%Y-%m-%d %H:%M:%S')) + int(milliseconds) / 1000.
+
+  fields = log_msg.split(',', 2)
+  if len(fields) < 2:
+    return timestamp, fields[0], u'', None
+  if len(fields) == 2:
+    return timestamp, fields[0], fields[1], None
+  return timestamp, fields[0], fields[1], fields[2]
+
+
+def get_segment_filenames(filename):
+  segments = []
+  for segment_filename in glob.glob(filename + '.[0-9]*'):
+    seq = segment_filename[len(filename) + 1:]
+    if seq.isdigit():
+      segments.append( (int(seq), segment_filename) )
+  segments.sort()
+  return [ segment_filename for seq, segment_filename in segments ]
+
+
+def read_segment(segment_filename):
+  with open(segment_filename, 'rb') as segment:
+    if segment.read(len(MAGIC)) != MAGIC:
+      raise ValueError('%s is not a replay log segment' % segment_filename)
+
+    while True:
+      header = segment.read(RECORD_HEADER.size)
+      if len(header) < RECORD_HEADER.size:
+        return # end of the segment, or a record that was being written when the process stopped
+
+      body_length, timestamp = RECORD_HEADER.unpack(header)
+      body = segment.read(body_length)
+      if len(body) < body_length:
+        return
+
+      command, key, value = body.decode('utf-8').split(u'\0', 2)
+      yield timestamp, command, key, value or None
+
+
+def read_replay_log(filename):
+  """Yields (timestamp, command, key, value) for every record of every segment of the log, in order"""
+  for segment_filename in get_segment_filenames(filename):
+    for record in read_segment(segment_filename):
+      yield record
+
+
+def read_log_records(filename):
+  """Yields (timestamp, command, key, value) from a binary log, or from a log in the text format"""
+  if get_segment_filenames(filename):
+    for record in read_replay_log(filename):
+      yield record
+    return
+
+  with open(filename) as log_file:
+    for line in log_file:
+      record = parse_text_line(line.decode('utf-8'))
+      if record:
+        yield record
+
+
+def read_index(filename):
+  """Returns a list of (seq, first timestamp, last timestamp, number of records, segment filename)"""
+  index = []
+  if not os.path.exists(filename + '.index'):
+    return index
+
+  with open(filename + '.index') as index_file:
+    for line in index_file:
+      seq, first_timestamp, last_timestamp, records, segment_filename = line.rstrip('\n').split(',', 4)
+      index.append( (int(seq), float(first_timestamp), float(last_timestamp), int(records), segment_filename) )
+  return index
+
+
+class ReplayLogWriter(object):
+  def __init__(self, filename, max_bytes=256*1024*1024, when='midnight', flush_interval=0.05, max_buffered=1024):
+    self.filename = filename
+    self.max_bytes = max_bytes
+    self.when = when
+    self.flush_interval = flush_interval
+    self.max_buffered = max_buffered
+
+    self.records = deque()
+    self.records_event = threading.Event()
+    self.closed = False
+
+    # never append to a segment of a previous run, it may end with a partial record
+    segments = get_segment_filenames(filename)
+    self.seq = int(segments[-1][len(filename) + 1:]) if segments else 0
+    self.segment = None
+    self.open_segment()
+
+    self.thread = threading.Thread(target=self.run, name='replay-log')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def log(self, command, key, value=None):
+    # only strings are immutable. Anything else, like a model instance, must be converted in the caller thread
+    if value and not isinstance(value, basestring):
+      value = to_text(value)
+    self.records.append( (time.time(), command, key, value) )
+    if len(self.records) >= self.max_buffered:
+      self.records_event.set()
+
+  def info(self, message):
+    self.log(message, u'')
+
+  def close(self):
+    self.closed = True
+    self.records_event.set()
+    self.thread.join()
+
+  def open_segment(self):
+    self.seq += 1
+    self.segment_filename = '%s.%06d' % (self.filename, self.seq)
+    self.segment = open(self.segment_filename, 'wb')
+    self.segment.write(MAGIC)
+    self.segment_size = len(MAGIC)
+    self.segment_records = 0
+    self.segment_first_timestamp = None
+    self.segment_last_timestamp = None
+    self.segment_date = datetime.date.today()
+
+  def close_segment(self):
+    self.segment.close()
+    with open(self.filename + '.index', 'a') as index_file:
+      index_file.write('%d,%f,%f,%d,%s\n' % (self.seq,
+                                             self.segment_first_timestamp or 0,
+                                             self.segment_last_timestamp or 0,
+                                             self.segment_records,
+                                             self.segment_filename))
+
+  def should_rotate(self, timestamp):
+    if not self.segment_records:
+      return False
+    if self.max_bytes and self.segment_size >= self.max_bytes:
+      return True
+    if self.when == 'midnight' and datetime.date.fromtimestamp(timestamp) != self.segment_date:
+      return True
+    return False
+
+  def run(self):
+    while True:
+      self.records_event.wait(self.flush_interval)
+      self.records_event.clear()
+      self.write_records()
+      if self.closed:
+        self.write_records()
+        self.close_segment()
+        return
+
+  def write_records(self):
+    buffer = []
+    while self.records:
+      timestamp, command, key, value = self.records.popleft()
+
+      if self.should_rotate(timestamp):
+        self.segment.write(''.join(buffer))
+        buffer = []
+        self.close_segment()
+        self.open_segment()
+
+      body = u'%s\0%s\0%s' % (to_text(command), to_text(key), to_text(value) if value else u'')
+      body = body.encode('utf-8')
+      record = RECORD_HEADER.pack(len(body), timestamp) + body
+      buffer.append(record)
+
+      self.segment_size += len(record)
+      self.segment_records += 1
+      if self.segment_first_timestamp is None:
+        self.segment_first_timestamp = timestamp
+      self.segment_last_timestamp = timestamp
+
+    if buffer:
+      self.segment.write(''.join(buffer))
+      self.segment.flush()
@@ -0,0 +1,85 @@
+__author__ = 'rodrigo'
+
+import unittest
+
+from histogram import Histogram, StageHistograms
+
+class TestHistogram(unittest.TestCase):
+  def test_empty(self):
+    histogram = Histogram()
+    self.assertEqual(0, histogram.percentile(99))
+    self.assertEqual(0, histogram.to_dict()['Count'])
+
+  def test_percentiles(self):
+    histogram = Histogram()
+    for value in xrange(1, 1001):
+      histogram.record(value)
+
+    self.assertEqual(1000, histogram.count)
+    self.assertEqual(1, histogram.min)
+    self.assertEqual(1000, histogram.max)
+    self.assertAlmostEqual(500.5, histogram.mean())
+
+    # within the width of a bucket
+    self.assertAlmostEqual(500, histogram.percentile(50), delta=500 * 0.06)
+    self.assertAlmostEqual(990, histogram.percentile(99), delta=990 * 0.06)
+    self.assertEqual(1000, histogram.percentile(100))
+
+  def test_out_of_range_values(self):
+    histogram = Histogram(min_value=1, max_value=100)
+    histogram.record(0)
+    histogram.record(-5)
+    histogram.record(10**9)
+    self.assertEqual(3, histogram.count)
+    self.assertEqual(1, histogram.percentile(50))  # upper bound of the first bucket
+    self.assertEqual(10**9, histogram.percentile(100))
+
+  def test_percentile_distribution(self):
+    histogram = Histogram()
+    for value in xrange(1, 1001):
+      histogram.record(value)
+
+    distribution = histogram.get_percentile_distribution()
+    self.assertEqual((0, 1), distribution[0])
+    self.assertEqual((100, 1000), distribution[-1])
+    self.assertEqual([50, 75, 87.5], [ p for p, value in distribution[1:4] ])
+    values = [ value for p, value in distribution ]
+    self.assertEqual(sorted(values), values)
+
+  def test_merge(self):
+    a = Histogram()
+    b = Histogram()
+    for value in xrange(1, 101):
+      a.record(value)
+      b.record(value * 10)
+    a.merge(b)
+    self.assertEqual(200, a.count)
+    self.assertEqual(1, a.min)
+    self.assertEqual(1000, a.max)
+    self.assertRaises(ValueError, a.merge, Histogram(buckets_per_decade=10))
+
+
+class TestStageHistograms(unittest.TestCase):
+  def test_record_trace(self):
+    stages = StageHistograms()
+    stages.record_trace({'A': 1.0, 'B': 1.002, 'D': 1.010}, ('A', 'B', 'C', 'D'))
+
+    result = stages.to_dict()
+    self.assertEqual(set(['A->B', 'B->D', 'A->D']), set(result))
+    self.assertAlmostEqual(2, result['A->B']['Max'])
+    self.assertAlmostEqual(8, result['B->D']['Max'])
+    self.assertAlmostEqual(10, result['A->D']['Max'])
+
+  def test_stamps_out_of_the_expected_order(self):
+    stages = StageHistograms()
+    stages.record_trace({'A': 1.0, 'B': 1.004, 'C': 1.001}, ('A', 'B', 'C'))
+    self.assertEqual(set(['A->C', 'C->B', 'A->B']), set(stages.to_dict()))
+
+  def test_single_stamp(self):
+    stages = StageHistograms()
+    stages.record_trace({'A': 1.0}, ('A', 'B'))
+    self.assertEqual({}, stages.to_dict())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,132 @@
+__author__ = 'rodrigo'
+
+import unittest
+
+from matching import OrderBook, MemoryOrder, MemoryBalances, Publisher
+
+class RecordingPublisher(Publisher):
+  def __init__(self):
+    self.execution_reports = []
+    self.trades = []
+    self.market_data = []
+
+  def publish_execution_report(self, user_id, execution_report):
+    self.execution_reports.append( (user_id, execution_report.execution_type, execution_report.order_id) )
+
+  def publish_trades(self, symbol, trades):
+    self.trades.extend(trades)
+
+  def publish_new_order(self, symbol, entry_type, order_position, order):
+    self.market_data.append( ('0', entry_type, order_position + 1) )
+
+  def publish_update_order(self, symbol, entry_type, order_position, order):
+    self.market_data.append( ('1', entry_type, order_position + 1) )
+
+  def publish_cancel_order(self, symbol, entry_type, order_position):
+    self.market_data.append( ('2', entry_type, order_position) )
+
+class TestOrderBook(unittest.TestCase):
+  def setUp(self):
+    self.publisher = RecordingPublisher()
+    self.book = OrderBook('BTCUSD', publisher=self.publisher)
+
+  def test_memory_order_has_no_dict(self):
+    order = MemoryOrder(1, 10, 'BTCUSD', '2', 500e8, 1e8)
+    self.assertFalse(hasattr(order, '__dict__'))
+    self.assertRaises(AttributeError, setattr, order, 'undeclared', 1)
+
+  def test_sweep(self):
+    self.book.match(None, MemoryOrder(1, 10, 'BTCUSD', '2', 500e8, 1e8))
+    self.book.match(None, MemoryOrder(2, 11, 'BTCUSD', '2', 501e8, 1e8))
+    self.book.match(None, MemoryOrder(3, 12, 'BTCUSD', '1', 501e8, 15e7))
+
+    self.assertEqual([ (500e8, 1e8), (501e8, 5e7) ], [ (trade.price, trade.size) for trade in self.publisher.trades ])
+    self.assertEqual([2], [ order.id for order in self.book.sell_side ])
+    self.assertEqual(5e7, self.book.sell_side[0].leaves_qty)
+    self.assertEqual([], self.book.buy_side)
+
+  def test_self_execution_cancels_the_counter_order(self):
+    self.book.match(None, MemoryOrder(1, 10, 'BTCUSD', '2', 500e8, 1e8))
+    self.book.match(None, MemoryOrder(2, 10, 'BTCUSD', '1', 500e8, 1e8))
+
+    self.assertEqual([], self.publisher.trades)
+    self.assertEqual((10, '4', 1), self.publisher.execution_reports[-1])
+    self.assertEqual([2], [ order.id for order in self.book.buy_side ])
+
+    self.book.cancel(None, self.book.buy_side[0])
+    self.assertEqual([], self.book.buy_side)
+    self.assertEqual((10, '4', 2), self.publisher.execution_reports[-1])
+
+  def test_balances(self):
+    balances = MemoryBalances({ (10, 'BTC'): 1e8, (11, 'USD'): 250e8 })
+    book = OrderBook('BTCUSD', risk=balances, publisher=self.publisher)
+    book.match(None, MemoryOrder(1, 10, 'BTCUSD', '2', 500e8, 1e8))
+    buy = MemoryOrder(2, 11, 'BTCUSD', '1', 500e8, 1e8)
+    book.match(None, buy)
+
+    self.assertEqual(5e7, buy.cum_qty)
+    self.assertEqual(5e7, buy.cxl_qty)
+    self.assertEqual(5e7, balances.get_balance(11, 'BTC'))
+    self.assertEqual(0, balances.get_balance(11, 'USD'))
+    self.assertEqual(250e8, balances.get_balance(10, 'USD'))
+
+  def test_replace(self):
+    first = MemoryOrder(1, 10, 'BTCUSD', '2', 500e8, 1e8)
+    second = MemoryOrder(2, 11, 'BTCUSD', '2', 500e8, 1e8)
+    self.book.match(None, first)
+    self.book.match(None, second)
+    del self.publisher.market_data[:]
+
+    # a smaller quantity keeps the priority
+    self.book.replace(None, first, 5e7)
+    self.assertEqual([1, 2], [ order.id for order in self.book.sell_side ])
+    self.assertEqual(5e7, first.leaves_qty)
+    self.assertEqual((10, '5', 1), self.publisher.execution_reports[-1])
+    self.assertEqual([ ('1', '1', 1) ], self.publisher.market_data)
+
+    # a bigger quantity goes to the end of the queue
+    del self.publisher.market_data[:]
+    self.book.replace(None, first, 2e8)
+    self.assertEqual([2, 1], [ order.id for order in self.book.sell_side ])
+    self.assertEqual(2e8, first.leaves_qty)
+    self.assertEqual([ ('2', '1', 1), ('0', '1', 2) ], self.publisher.market_data)
+
+    # a new price might match
+    self.book.match(None, MemoryOrder(3, 12, 'BTCUSD', '1', 490e8, 1e8))
+    self.book.replace(None, second, 1e8, 490e8, 'second')
+    self.assertEqual([ (490e8, 1e8) ], [ (trade.price, trade.size) for trade in self.publisher.trades ])
+    self.assertEqual('2', second.status)
+    self.assertEqual('second', second.client_order_id)
+    self.assertEqual([1], [ order.id for order in self.book.sell_side ])
+    self.assertEqual([], self.book.buy_side)
+
+  def test_replace_priority_survives_a_reload(self):
+    orders = [ MemoryOrder(order_id, 10 + order_id, 'BTCUSD', '2', 500e8, 1e8) for order_id in (1, 2, 3) ]
+    for order in orders:
+      self.book.match(None, order)
+    self.book.replace(None, orders[0], 2e8)
+
+    # as the trade engine loads the open orders at start up
+    reloaded_book = OrderBook('BTCUSD')
+    for order in sorted(orders, key=lambda order: order.created):
+      reloaded_book.match(None, order)
+    self.assertEqual([2, 3, 1], [ order.id for order in self.book.sell_side ])
+    self.assertEqual([2, 3, 1], [ order.id for order in reloaded_book.sell_side ])
+
+  def test_mass_cancel(self):
+    for order_id, account_id, side, price in ((1, 10, '2', 502e8), (2, 11, '2', 501e8), (3, 10, '2', 500e8),
+                                              (4, 10, '1', 490e8), (5, 11, '1', 489e8)):
+      self.book.match(None, MemoryOrder(order_id, account_id, 'BTCUSD', side, price, 1e8))
+    del self.publisher.market_data[:]
+
+    self.assertEqual([3, 1], [ order.id for order in self.book.mass_cancel(None, account_id=10, side='2') ])
+    self.assertEqual([2], [ order.id for order in self.book.sell_side ])
+    self.assertEqual([ ('2', '1', 3), ('2', '1', 1) ], self.publisher.market_data)
+
+    self.assertEqual([4], [ order.id for order in self.book.mass_cancel(None, user_id=10) ])
+    self.assertEqual([], self.book.mass_cancel(None, account_id=10))
+    self.assertEqual([11], self.book.orders_by_account.keys())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,46 @@
+__author__ = 'rodrigo'
+
+import unittest
+
+from memory import HeapSnapshots, get_deep_size, get_memory_report
+
+class Leaked(object):
+  def __init__(self, value):
+    self.value = value
+
+class TestMemory(unittest.TestCase):
+  def test_deep_size(self):
+    size, objects, truncated = get_deep_size({ 'a': [ 1, 2, 3 ], 'b': (4, 5) })
+    self.assertEqual(10, objects)  # dict, 2 keys, list, 3 ints, tuple, and 4, 5
+    self.assertFalse(truncated)
+
+    size, objects, truncated = get_deep_size(range(1000), max_objects=100)
+    self.assertEqual(100, objects)
+    self.assertTrue(truncated)
+
+  def test_report(self):
+    report = get_memory_report({ 'Book': [ Leaked(i) for i in xrange(10) ] }, limit=5)
+    self.assertEqual(5, len(report['Types']))
+    self.assertEqual(10, report['Structures']['Book']['Length'])
+    self.assertTrue(report['RSS'] > 0)
+
+  def test_snapshot_diff(self):
+    snapshots = HeapSnapshots(max_snapshots=2)
+    structures = { 'Leaks': [] }
+    snapshots.take('before', structures)
+
+    structures['Leaks'].extend( Leaked(i) for i in xrange(100) )
+    snapshots.take('after', structures)
+
+    diff = snapshots.diff('before', 'after')
+    leaked = [ item for item in diff['Types'] if item['Type'] == __name__ + '.Leaked' ]
+    self.assertEqual(100, leaked[0]['CountDelta'])
+    self.assertEqual(100, diff['Structures']['Leaks']['LengthDelta'])
+
+    snapshots.take('third')
+    self.assertEqual(['after', 'third'], [ snapshot['Name'] for snapshot in snapshots.list() ])
+    self.assertRaises(KeyError, snapshots.diff, 'before')
+
+
+if __name__ == '__main__':
+  unittest.main()
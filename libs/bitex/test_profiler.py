@@ -0,0 +1,52 @@
+__author__ = 'rodrigo'
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from profiler import SamplingProfiler
+
+def spin(seconds):
+  end = time.time() + seconds
+  while time.time() < end:
+    pass
+
+class TestSamplingProfiler(unittest.TestCase):
+  def setUp(self):
+    self.output_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.output_dir)
+
+  def test_collapsed_stacks_by_tag(self):
+    profiler = SamplingProfiler('test', self.output_dir)
+    profiler.start(10, 0.001, 'wall')
+    profiler.set_tag('D')
+    spin(0.05)
+    profiler.set_tag(None)
+    spin(0.05)
+    status = profiler.stop()
+
+    self.assertFalse(status['Running'])
+    self.assertEqual({'D': 1}, status['MsgTypes'])
+    self.assertTrue(status['Samples'] > 0)
+
+    lines = open(status['Filename']).read().splitlines()
+    self.assertEqual(status['Samples'], sum( int(line.rsplit(' ', 1)[1]) for line in lines ))
+    tags = set( line.split(';', 1)[0] for line in lines )
+    self.assertEqual(set(['MsgType=D', 'MsgType=None']), tags)
+    self.assertTrue(any( 'spin (test_profiler.py:' in line for line in lines ))
+
+  def test_start_twice(self):
+    profiler = SamplingProfiler('test', self.output_dir)
+    profiler.start(10, 0.01)
+    self.assertRaises(ValueError, profiler.start, 10)
+    self.assertRaises(ValueError, SamplingProfiler('test').start, 10, 0.01, 'invalid')
+    profiler.stop()
+    self.assertTrue(os.path.exists(profiler.filename))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,5 +1,7 @@
 __author__ = 'rodrigo'
 
+import base64
+import datetime
 import types
 
 
@@ -28,3 +30,23 @@ def smart_str(s, encoding='utf-8', strings_only=False, errors='strict'):
     return s.decode('utf-8', errors).encode(encoding, errors)
   else:
     return s
+
+
+CURSOR_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+def encode_cursor(created, record_id):
+  """
+  Returns an opaque cursor pointing to the record with the given (created, id) key.
+  """
+  return base64.urlsafe_b64encode( created.strftime(CURSOR_DATETIME_FORMAT) + '|' + str(record_id) )
+
+def decode_cursor(cursor):
+  """
+  Returns the (created, id) key of an opaque cursor returned by encode_cursor, with the id as a string.
+  Raises ValueError if the cursor is not valid.
+  """
+  try:
+    created, record_id = base64.urlsafe_b64decode( str(cursor) ).split('|', 1)
+    return datetime.datetime.strptime(created, CURSOR_DATETIME_FORMAT), record_id
+  except (TypeError, ValueError, UnicodeError):
+    raise ValueError('Invalid cursor')
@@ -166,4 +166,47 @@ class TradeClient(object):
     return self.sendString(json.dumps(json_msg))
 
   def sendMessage(self, msg):
-    return self.sendString(msg.raw_message)
\ No newline at end of file
+    return self.sendString(msg.raw_message)
+
+class QueryClient(TradeClient):
+  def __init__(self, zmq_context, query_in_socket):
+    super(QueryClient, self).__init__(zmq_context, query_in_socket, reopen=False)
+
+  def connect(self):
+    pass
+
+  def close(self):
+    pass
+
+  def isConnected(self):
+    return True
+
+  def sendString(self, string_msg, user_id=None):
+    if user_id is None:
+      user_id = ''
+    self.trade_in_socket.send_unicode( "QRY," + str(user_id) + ',' + string_msg)
+
+    response_message        = self.trade_in_socket.recv()
+    raw_resp_message_header = response_message[:3]
+    raw_resp_message        = response_message[4:].strip()
+
+    rep_msg = None
+    if raw_resp_message:
+      try:
+        rep_msg = JsonMessage(raw_resp_message)
+      except Exception:
+        pass
+
+    if raw_resp_message_header != 'REP':
+      if rep_msg and rep_msg.isErrorMessage():
+        raise TradeClientException(rep_msg.get('Description'), rep_msg.get('Detail'))
+      raise TradeClientException('Invalid request: ' + raw_resp_message )
+
+    return rep_msg
+
+  def sendJSON(self, json_msg, user_id=None):
+    import json
+    return self.sendString(json.dumps(json_msg), user_id)
+
+  def sendMessage(self, msg, user_id=None):
+    return self.sendString(msg.raw_message, user_id)
@@ -32,6 +32,8 @@ class BlinkTradeArbitrator(object):
     self.order_book_ask_processor.send_new_order_signal.connect(self.on_send_sell_new_order)
     self.order_book_bid_processor.cancel_order_signal.connect(self.on_send_cancel_order)
     self.order_book_ask_processor.cancel_order_signal.connect(self.on_send_cancel_order)
+    self.order_book_bid_processor.cancel_replace_order_signal.connect(self.on_send_cancel_replace_order)
+    self.order_book_ask_processor.cancel_replace_order_signal.connect(self.on_send_cancel_replace_order)
 
     #Signals
     self.signal_connected     = Signal()
@@ -89,7 +91,11 @@ class BlinkTradeArbitrator(object):
     print datetime.datetime.now(), 'RECV', msg
 
   def on_blinktrade_execution_report(self, sender, msg):
-    if msg['ExecType'] == '0' or msg['ExecType'] == '4': # cancel
+    # fills, cancels and replaces change the orders the processors keep
+    self.order_book_bid_processor.process_execution_report(msg)
+    self.order_book_ask_processor.process_execution_report(msg)
+
+    if msg['ExecType'] == '0' or msg['ExecType'] == '4' or msg['ExecType'] == '5': # new, cancel or replace
       return
     self.signal_order(self,  {
       'MsgType'   : 'D',
@@ -125,6 +131,9 @@ class BlinkTradeArbitrator(object):
   def on_send_cancel_order(self,sender, msg):
     self.ws.sendMsg(msg)
 
+  def on_send_cancel_replace_order(self,sender, msg):
+    self.ws.sendMsg(msg)
+
   def process_bid_list(self, bid_list ):
     bid_list = get_funded_entries(bid_list, self.fiat_balance, True)
     bid_list = aggregate_orders(bid_list)
@@ -17,6 +17,7 @@ class OrderBookProcessor():
 
     self.send_new_order_signal = Signal()
     self.cancel_order_signal = Signal()
+    self.cancel_replace_order_signal = Signal()
 
   def _get_order_by_price(self, price):
     if price in self.orders_by_price:
@@ -30,7 +31,7 @@ class OrderBookProcessor():
     now = datetime.datetime.now()
     timestamp = time.mktime(now.timetuple())*1e3 + now.microsecond/1e3
 
-    order = { 'id': order_id, 'price': price, 'vol': volume , 'ts': timestamp }
+    order = { 'id': order_id, 'price': price, 'vol': volume , 'ts': timestamp, 'cum_qty': 0, 'cxl_qty': 0 }
     self.orders_by_price[price] = order
     self.orders_by_id[order_id] = order
 
@@ -54,21 +55,25 @@ class OrderBookProcessor():
 
     original_volume = original_order['vol']
     if original_volume != new_volume:
-      self._cancel_order( original_order['id'] )
-      return self._send_new_order( original_order['price'], new_volume )
-    else:
-      # nothing to do ... let's just update the current order timestamp.
-      now = datetime.datetime.now()
-      new_timestamp = time.mktime(now.timetuple())*1e3 + now.microsecond/1e3
-      original_order['ts'] = new_timestamp
+      # amend the order, it keeps its priority in the book when the volume goes down. The OrderQty of a replace
+      # also counts what was already executed or cancelled
+      original_order['vol'] = new_volume
+      order_qty = original_order['cum_qty'] + original_order['cxl_qty'] + new_volume
+      self.cancel_replace_order_signal(self, { 'MsgType':'G', 'OrigClOrdID': str(order_id), 'OrderQty': int(order_qty) })
+
+    # let's update the current order timestamp.
+    now = datetime.datetime.now()
+    new_timestamp = time.mktime(now.timetuple())*1e3 + now.microsecond/1e3
+    original_order['ts'] = new_timestamp
 
-      pos = 0
-      for order in self.orders_list_ordered_by_timestamp:
-        if order['id'] == order_id:
-          break
-        pos += 1
-      del self.orders_list_ordered_by_timestamp[pos]
-      self.orders_list_ordered_by_timestamp.append( original_order )
+    pos = 0
+    for order in self.orders_list_ordered_by_timestamp:
+      if order['id'] == order_id:
+        break
+      pos += 1
+    del self.orders_list_ordered_by_timestamp[pos]
+    self.orders_list_ordered_by_timestamp.append( original_order )
+    return order_id
 
   def _get_last_timestamp(self):
     if not self.orders_list_ordered_by_timestamp:
@@ -90,18 +95,36 @@ class OrderBookProcessor():
     original_order  = self.orders_by_id[order_id]
 
     self.cancel_order_signal(self, { 'MsgType':'F', 'OrigClOrdID': str(order_id)} )
+    self._remove_order(original_order)
+    return True
 
+  def _remove_order(self, original_order):
     # find the order position
     pos = 0
     for order in self.orders_list_ordered_by_timestamp:
-      if order['id'] == order_id:
+      if order['id'] == original_order['id']:
         break
       pos += 1
     del self.orders_list_ordered_by_timestamp[pos]
 
     del self.orders_by_price[original_order['price']]
     del self.orders_by_id[original_order['id'] ]
-    return True
+
+  def process_execution_report(self, msg):
+    try:
+      order = self.orders_by_id.get(int(msg.get('ClOrdID')))
+    except (TypeError, ValueError):
+      return
+    if not order:
+      return
+
+    order['cum_qty'] = msg['CumQty']
+    order['cxl_qty'] = msg['CxlQty']
+    if msg['OrdStatus'] in ('2', '4'):
+      # filled, cancelled, or a replace that left nothing to execute
+      self._remove_order(order)
+    else:
+      order['vol'] = msg['LeavesQty']
 
   def process_order_list(self, order_list):
     bid_timestamp = self._get_last_timestamp()
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+"""
+Drives the trade engine message handling in process and measures it.
+
+  benchmark.py generate flow.jsonl --orders 20000 --users 20 --cancel-ratio 0.3
+  benchmark.py run --flow flow.jsonl --db both --output results.json
+  benchmark.py run --log trade.log --snapshot bitex.sqlite --db disk --output results.json
+  benchmark.py compare before.json after.json
+
+The flow file has one request per line, {"user": <index>, "msg": {...}}. Every user of the flow is created,
+funded and logged in before the measurement starts. A recorded trade log is fed request by request, starting
+from the database snapshot taken when the log started.
+"""
+
+import os
+import sys
+import math
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import subprocess
+
+ROOT_PATH = os.path.abspath( os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'libs'))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'apps'))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'apps/trade'))
+
+SYMBOL = 'BTCUSD'
+BROKER_ID = 5
+FIRST_USER_ID = 100
+PERCENTILES = ( 50, 99, 99.9 )
+
+def percentile(sorted_values, p):
+  if not sorted_values:
+    return 0
+  index = int(math.ceil(p / 100. * len(sorted_values))) - 1
+  return sorted_values[ min(max(index, 0), len(sorted_values) - 1) ]
+
+def generate_flow(arguments):
+  random.seed(arguments.seed)
+  mid_price = arguments.price
+  open_orders = {} # user => [ClOrdID]
+
+  with open(arguments.flow, 'w') as flow_file:
+    for x in xrange(arguments.orders):
+      user = random.randrange(arguments.users)
+
+      if open_orders.get(user) and random.random() < arguments.cancel_ratio:
+        cl_ord_id = open_orders[user].pop( random.randrange(len(open_orders[user])) )
+        msg = { 'MsgType': 'F', 'OrigClOrdID': cl_ord_id }
+      else:
+        cl_ord_id = 'bm%d' % x
+        side = random.choice(('1', '2'))
+        # buyers mostly below the mid price and sellers above it, so the book builds up and some orders cross
+        offset = random.randint(-arguments.spread, arguments.spread // 4)
+        price = mid_price + offset if side == '2' else mid_price - offset
+        msg = {
+          'MsgType': 'D',
+          'ClOrdID': cl_ord_id,
+          'Symbol': SYMBOL,
+          'Side': side,
+          'OrdType': '2',
+          'Price': int(price * 1e8),
+          'OrderQty': random.randint(1, 100) * 1000000,
+          'BrokerID': BROKER_ID
+        }
+        open_orders.setdefault(user, []).append(cl_ord_id)
+
+      flow_file.write(json.dumps({'user': user, 'msg': msg}) + '\n')
+
+def setup_application(db, snapshot, log_format, db_engine=None):
+  from tornado.options import options
+  import main as trade_main  # defines the trade options
+
+  db_filename = None
+  if db_engine:
+    options.db_engine = db_engine
+  elif db == 'disk':
+    db_filename = tempfile.mktemp(prefix='benchmark_', suffix='.sqlite')
+    options.db_engine = 'sqlite:///' + db_filename
+  else:
+    options.db_engine = 'sqlite://'
+  options.db_echo = False
+  options.trade_in = 'inproc://benchmark_trade_in'
+  options.trade_pub = 'inproc://benchmark_trade_pub'
+  options.trade_log = tempfile.mktemp(prefix='benchmark_', suffix='.log')
+  options.trade_log_format = log_format
+  options.session_timeout_limit = 0
+  options.global_email_language = 'en'
+
+  if snapshot:
+    import sqlite3
+    from models import engine, Base
+    Base.metadata.drop_all(engine) # created when models is imported
+    engine.raw_connection().connection.executescript( '\n'.join(sqlite3.connect(snapshot).iterdump()) )
+    Base.metadata.create_all(engine) # tables newer than the snapshot
+
+    # logged passwords are redacted
+    from models import User
+    check_password = User.check_password
+    User.check_password = lambda self, raw_password: raw_password == '*' or check_password(self, raw_password)
+
+  from trade_application import application
+  application.initialize()
+  application.load_order_book()
+  drop_publications(application)
+  return application, db_filename
+
+def drop_publications(application):
+  application.publish_queue = []
+  application.balance_updates = {}
+
+def bootstrap_users(application, number_of_users):
+  from models import Currency, Instrument, User, Broker, Balance
+  session = application.db_session
+
+  if not Currency.get_currency(session, 'USD'):
+    session.add(Currency(code='USD', sign='$', description='Dollar', is_crypto=False, pip=100,
+                         format_python='{:,.2f}', format_js='', human_format_python='{:,.2f}', human_format_js=''))
+    session.add(Currency(code='BTC', sign='B', description='Bitcoin', is_crypto=True, pip=10000,
+                         format_python='{:,.8f}', format_js='', human_format_python='{:,.4f}', human_format_js=''))
+    session.add(Instrument(symbol=SYMBOL, currency='USD', description='BTC / USD'))
+    session.add(User(id=BROKER_ID, username='benchmark_broker', email='broker@benchmark', password='benchmark',
+                     country_code='US', verified=3, is_broker=True, transaction_fee_buy=0, transaction_fee_sell=0))
+    session.commit()
+    session.add(Broker(id=BROKER_ID, short_name='benchmark', business_name='benchmark', address='-',
+                       signup_label='benchmark', city='-', state='NY', zip_code='-', country_code='US', lang='en',
+                       country='US', email='broker@benchmark', verification_jotform='', upload_jotform='',
+                       currencies='USD', withdraw_structure='{}', crypto_currencies='[]',
+                       accept_customers_from='[["*"],[]]', is_broker_hub=False, support_url='', tos_url='',
+                       fee_structure='[]', transaction_fee_buy=0, transaction_fee_sell=0, deposit_limits='{}',
+                       status='1', ranking=1))
+    session.commit()
+
+  for index in xrange(number_of_users):
+    user_id = FIRST_USER_ID + index
+    username = 'benchmark%d' % index
+    if User.get_user(session, user_id=user_id):
+      continue
+    session.add(User(id=user_id, username=username, email=username + '@benchmark', password='benchmark',
+                     country_code='US', broker_id=BROKER_ID, broker_username='benchmark_broker', verified=3))
+    session.flush()
+    for currency in ('USD', 'BTC'):
+      Balance.update_balance(session, 'CREDIT', user_id, username, BROKER_ID, 'benchmark_broker', currency, 10**16)
+  session.commit()
+  drop_publications(application)
+
+def login_users(application, number_of_users):
+  session_ids = []
+  for index in xrange(number_of_users):
+    session_id = '%016d' % (index + 1)
+    application.process_message('OPN,' + session_id + ',')
+    application.process_message('REQ,' + session_id + ',' + json.dumps({
+      'MsgType': 'BE', 'UserReqID': index, 'UserReqTyp': '1',
+      'Username': 'benchmark%d' % index, 'Password': 'benchmark' }))
+    session_ids.append(session_id)
+  drop_publications(application)
+  return session_ids
+
+def read_flow(flow_filename):
+  flow = []
+  with open(flow_filename) as flow_file:
+    for line in flow_file:
+      if line.strip():
+        flow.append(json.loads(line))
+  return flow
+
+def read_log_requests(log_filename):
+  from bitex.replay_log import read_log_records
+  for timestamp, command, key, value in read_log_records(log_filename):
+    if command == 'IN' and key in ('TRADE_IN_REQ', 'TRADE_IN_REQ_ERROR'):
+      yield value.encode('utf-8')
+
+def get_msg_type(raw_message):
+  from message_scheduler import MSG_TYPE_REGEX
+  match = MSG_TYPE_REGEX.search(raw_message, 20)
+  if match:
+    return match.group(1)
+  return raw_message[:3] # OPN, CLS
+
+def measure(application, raw_messages, publish):
+  """ returns the wall time, the latencies by MsgType and the number of ERR replies by MsgType """
+  latencies = {}
+  errors = {}
+  start = time.time()
+  for raw_message in raw_messages:
+    t0 = time.time()
+    reply = application.process_message(raw_message)
+    application.process_trade_emails()
+    if publish:
+      application.flush_publish_queue()
+    else:
+      drop_publications(application)
+    latency = time.time() - t0
+    msg_type = get_msg_type(raw_message)
+    latencies.setdefault(msg_type, []).append(latency)
+    if reply and reply.startswith('ERR'):
+      errors[msg_type] = errors.get(msg_type, 0) + 1
+  return time.time() - start, latencies, errors
+
+def summarize(wall_time, latencies, errors):
+  by_msg_type = {}
+  for msg_type, values in latencies.iteritems():
+    values.sort()
+    total = sum(values)
+    stats = {
+      'count': len(values),
+      'errors': errors.get(msg_type, 0),
+      'ops_per_sec': len(values) / total if total else 0,
+      'mean_ms': total / len(values) * 1000,
+      'max_ms': values[-1] * 1000
+    }
+    for p in PERCENTILES:
+      stats['p%s_ms' % p] = percentile(values, p) * 1000
+    by_msg_type[msg_type] = stats
+
+  messages = sum( len(values) for values in latencies.itervalues() )
+  return {
+    'wall_time': wall_time,
+    'messages': messages,
+    'errors': sum(errors.itervalues()),
+    'messages_per_sec': messages / wall_time if wall_time else 0,
+    'orders_per_sec': by_msg_type.get('D', {}).get('ops_per_sec', 0),
+    'cancels_per_sec': by_msg_type.get('F', {}).get('ops_per_sec', 0),
+    'by_msg_type': by_msg_type
+  }
+
+def get_git_revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT_PATH).strip()
+  except Exception:
+    return None
+
+def run_single(arguments):
+  application, db_filename = setup_application(arguments.db, arguments.snapshot, arguments.log_format)
+
+  if arguments.flow:
+    flow = read_flow(arguments.flow)
+    number_of_users = max( entry['user'] for entry in flow ) + 1
+    bootstrap_users(application, number_of_users)
+    session_ids = login_users(application, number_of_users)
+    raw_messages = [ 'REQ,' + session_ids[entry['user']] + ',' + json.dumps(entry['msg']) for entry in flow ]
+    source = arguments.flow
+  else:
+    raw_messages = list(read_log_requests(arguments.log))
+    source = arguments.log
+
+  wall_time, latencies, errors = measure(application, raw_messages, arguments.publish)
+
+  result = summarize(wall_time, latencies, errors)
+  result['config'] = {
+    'db': arguments.db,
+    'source': source,
+    'snapshot': arguments.snapshot,
+    'log_format': arguments.log_format,
+    'publish': arguments.publish,
+    'revision': get_git_revision(),
+    'started': datetime.datetime.now().isoformat()
+  }
+
+  os.remove(application.options.trade_log)
+  if db_filename:
+    os.remove(db_filename)
+  return result
+
+def print_result(result):
+  config = result['config']
+  print '%s db, %d messages in %.2fs: %.0f msg/s, %.0f orders/s, %.0f cancels/s' % (
+    config['db'], result['messages'], result['wall_time'], result['messages_per_sec'],
+    result['orders_per_sec'], result['cancels_per_sec'])
+  print '  %-8s %8s %8s %10s %9s %9s %9s %9s' % ('MsgType', 'count', 'errors', 'ops/s', 'p50 ms', 'p99 ms',
+                                                 'p99.9 ms', 'max ms')
+  for msg_type, stats in sorted(result['by_msg_type'].iteritems()):
+    print '  %-8s %8d %8d %10.0f %9.3f %9.3f %9.3f %9.3f' % (msg_type, stats['count'], stats['errors'],
+      stats['ops_per_sec'], stats['p50_ms'], stats['p99_ms'], stats['p99.9_ms'], stats['max_ms'])
+  if result['errors']:
+    # rejected requests are cheap, the rates above are not the ones of the flow being accepted
+    print 'WARNING: %d of the %d messages were answered with ERR' % (result['errors'], result['messages'])
+
+def run(arguments):
+  if not arguments.flow and not arguments.log:
+    print 'run needs --flow or --log'
+    sys.exit(1)
+
+  if arguments.db != 'both':
+    results = [ run_single(arguments) ]
+  else:
+    # the database engine is created when the models are imported, so every configuration runs in its own process
+    results = []
+    for db in ('memory', 'disk'):
+      output = tempfile.mktemp(prefix='benchmark_', suffix='.json')
+      command = [ sys.executable, os.path.abspath(__file__), 'run', '--db', db, '--output', output, '--quiet',
+                  '--log-format', arguments.log_format ]
+      for name in ('flow', 'log', 'snapshot'):
+        if getattr(arguments, name):
+          command += [ '--' + name, getattr(arguments, name) ]
+      if arguments.publish:
+        command.append('--publish')
+      subprocess.check_call(command)
+      with open(output) as output_file:
+        results.extend(json.load(output_file))
+      os.remove(output)
+
+  if not arguments.quiet:
+    for result in results:
+      print_result(result)
+
+  if arguments.output:
+    with open(arguments.output, 'w') as output_file:
+      json.dump(results, output_file, indent=2, sort_keys=True)
+
+def compare(arguments):
+  with open(arguments.before) as before_file:
+    before = dict( (result['config']['db'], result) for result in json.load(before_file) )
+  with open(arguments.after) as after_file:
+    after = dict( (result['config']['db'], result) for result in json.load(after_file) )
+
+  def change(old, new):
+    return (new - old) / old * 100 if old else 0
+
+  for db in sorted(set(before) & set(after)):
+    print '%s db: %.0f -> %.0f msg/s (%+.1f%%)' % (db, before[db]['messages_per_sec'], after[db]['messages_per_sec'],
+      change(before[db]['messages_per_sec'], after[db]['messages_per_sec']))
+    if before[db].get('errors') or after[db].get('errors'):
+      print '  ERR replies: %d -> %d' % (before[db].get('errors', 0), after[db]['errors'])
+    for msg_type in sorted(set(before[db]['by_msg_type']) & set(after[db]['by_msg_type'])):
+      old = before[db]['by_msg_type'][msg_type]
+      new = after[db]['by_msg_type'][msg_type]
+      print '  %-8s p50 %8.3f -> %8.3f ms (%+.1f%%)   p99 %8.3f -> %8.3f ms (%+.1f%%)' % (msg_type,
+        old['p50_ms'], new['p50_ms'], change(old['p50_ms'], new['p50_ms']),
+        old['p99_ms'], new['p99_ms'], change(old['p99_ms'], new['p99_ms']))
+
+def main():
+  parser = argparse.ArgumentParser(description='Trade engine benchmark')
+  subparsers = parser.add_subparsers()
+
+  generate_parser = subparsers.add_parser('generate', help='writes a synthetic order flow')
+  generate_parser.add_argument('flow')
+  generate_parser.add_argument('--orders', type=int, default=10000)
+  generate_parser.add_argument('--users', type=int, default=20)
+  generate_parser.add_argument('--cancel-ratio', type=float, default=0.3)
+  generate_parser.add_argument('--price', type=int, default=500, help='mid price in USD')
+  generate_parser.add_argument('--spread', type=int, default=20, help='maximum distance from the mid price in USD')
+  generate_parser.add_argument('--seed', type=int, default=1)
+  generate_parser.set_defaults(function=generate_flow)
+
+  run_parser = subparsers.add_parser('run', help='runs the benchmark')
+  run_parser.add_argument('--flow', help='synthetic order flow file')
+  run_parser.add_argument('--log', help='recorded trade log, text or binary')
+  run_parser.add_argument('--snapshot', help='sqlite database with the state when the log started')
+  run_parser.add_argument('--db', choices=('memory', 'disk', 'both'), default='memory')
+  run_parser.add_argument('--log-format', choices=('text', 'binary'), default='text', help='replay log format of the engine')
+  run_parser.add_argument('--publish', action='store_true', help='hands the publications to the publisher thread')
+  run_parser.add_argument('--output', help='JSON results file')
+  run_parser.add_argument('--quiet', action='store_true')
+  run_parser.set_defaults(function=run)
+
+  compare_parser = subparsers.add_parser('compare', help='compares two results files')
+  compare_parser.add_argument('before')
+  compare_parser.add_argument('after')
+  compare_parser.set_defaults(function=compare)
+
+  arguments = parser.parse_args()
+  arguments.function(arguments)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+"""
+Microbenchmarks of the order book: OrderMatcher of apps/trade/execution.py and the Order comparison and matching
+of apps/trade/models.py.
+
+  matcher_benchmark.py run
+  matcher_benchmark.py run --scenario sweep --scenario market_orders --repeat 5 --output matcher.json
+  matcher_benchmark.py run --save-baseline
+  matcher_benchmark.py compare matcher.json
+
+The books run without the database, with the in memory risk check and persistence of bitex.matching, so the
+results are the cost of the algorithms: every account has enough balance, the trades are plain objects without
+ledger records and no trade email is queued. The execution reports and the market data are built as the engine
+does, and only counted. The orders are real Order instances, built without a session.
+
+Every scenario reports the operations per second, the best of --repeat runs, and the objects retained per
+operation. Python 2 has no allocation hook, so instead of every allocation the count is the objects tracked by
+the garbage collector allocated and not freed from the start of an iteration until its operation is done, with
+the collector disabled. An order left resting in the book counts, temporaries like the execution report dicts
+don't. The scenarios that refill the book free the orders of the previous iteration, they should stay around 0,
+anything above it is kept alive by the matcher.
+
+run compares the results with the stored baseline, baselines/matcher.json, and exits with 1 when a scenario got
+slower or retains more objects by over --tolerance percent. The baseline is only meaningful on the machine it was
+saved on: save it again with --save-baseline before changing the book, then compare.
+"""
+
+import os
+import gc
+import sys
+import json
+import bisect
+import random
+import argparse
+import datetime
+import platform
+import subprocess
+from timeit import default_timer
+
+ROOT_PATH = os.path.abspath( os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'libs'))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'apps'))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'apps/trade'))
+
+from bitex.matching import OrderBook
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'matcher.json')
+SYMBOL = 'BTCUSD'
+BROKER_ID = 5
+MID_PRICE = 500 * 10**8
+TICK = 10**6  # 0.01 USD
+
+execution = None
+Order = None
+
+
+class Publications(object):
+  count = 0
+
+  @staticmethod
+  def publish(key, data):
+    Publications.count += 1
+
+
+def load_matcher():
+  """ imports the models on an in memory database, and counts the publications instead of queueing them """
+  global execution, Order
+  from tornado.options import options
+  import main as trade_main  # defines the trade options
+  options.db_engine = 'sqlite://'
+  options.db_echo = False
+
+  import execution as execution_module
+  from models import Order as OrderModel
+  from trade_application import application
+  execution = execution_module
+  Order = OrderModel
+
+  application.publish = Publications.publish
+
+def create_book():
+  """ the book of the trade engine without the database: the messages are built as the engine does """
+  return OrderBook(SYMBOL, publisher=execution.ApplicationPublisher())
+
+
+class OrderFactory(object):
+  def __init__(self):
+    self.last_id = 0
+
+  def create(self, account_id, side, price, qty, type='2'):
+    self.last_id += 1
+    # without a session the column defaults are never applied, all of them are set here
+    return Order(id=self.last_id, user_id=account_id, account_id=account_id, username='trader%d' % account_id,
+                 account_username='trader%d' % account_id, broker_id=BROKER_ID, broker_username='broker',
+                 client_order_id='bm%d' % self.last_id, status='0', symbol=SYMBOL, side=side, type=type,
+                 time_in_force='1', price=price, order_qty=qty, leaves_qty=qty, cum_qty=0, cxl_qty=0,
+                 last_price=0, last_qty=0, average_price=0, fee=0, created=datetime.datetime.now())
+
+
+class Measurement(object):
+  """ times the operations, and counts the objects from the start of every iteration until its operation is done,
+  so the orders created or refilled for the operation are counted too """
+  def __init__(self):
+    self.ops = 0
+    self.seconds = 0.
+    self.objects = 0
+    self.objects_mark = None
+    self.publications = 0
+
+  def start(self):
+    self.objects_mark = gc.get_count()[0]
+
+  def call(self, function, *args):
+    publications = Publications.count
+    objects = self.objects_mark if self.objects_mark is not None else gc.get_count()[0]
+    start = default_timer()
+    function(*args)
+    self.seconds += default_timer() - start
+    self.objects += gc.get_count()[0] - objects
+    self.objects_mark = None
+    self.publications += Publications.count - publications
+    self.ops += 1
+
+  def get_result(self, overhead):
+    return {
+      'Ops'                 : self.ops,
+      'Seconds'             : self.seconds,
+      'OpsPerSec'           : self.ops / self.seconds if self.seconds else 0,
+      'MicrosecondsPerOp'   : self.seconds * 1e6 / self.ops if self.ops else 0,
+      'RetainedObjectsPerOp': float(self.objects) / self.ops - overhead if self.ops else 0,
+      'PublicationsPerOp'   : float(self.publications) / self.ops if self.ops else 0
+    }
+
+
+def build_book(matcher, factory, rand, orders_per_side, accounts, spread_ticks=2000):
+  """ fills both sides, the bids below the mid price and the asks above it, without crossing """
+  for side, sign, book_side in (('1', -1, matcher.buy_side), ('2', 1, matcher.sell_side)):
+    for x in xrange(orders_per_side):
+      price = MID_PRICE + sign * rand.randint(1, spread_ticks) * TICK
+      order = factory.create(rand.randrange(accounts), side, price, rand.randint(1, 100) * TICK)
+      book_side.insert(bisect.bisect_right(book_side, order), order)
+
+def clear_book(matcher):
+  """ empties both sides without publishing cancels, and the index of the orders by account and user with them """
+  del matcher.buy_side[:]
+  del matcher.sell_side[:]
+  matcher.orders_by_account.clear()
+  matcher.orders_by_user.clear()
+  matcher.index_keys.clear()
+
+def fill_levels(matcher, factory, account_id, side, levels, qty):
+  """ replaces the book by one order on each of the first levels of a side """
+  clear_book(matcher)
+  book_side = matcher.sell_side if side == '2' else matcher.buy_side
+  sign = 1 if side == '2' else -1
+  for level in xrange(levels):
+    book_side.append(factory.create(account_id, side, MID_PRICE + sign * (level + 1) * TICK, qty))
+
+
+def deep_book_insert(rand, scale):
+  """ limit orders resting in a deep book, no execution """
+  matcher = create_book()
+  factory = OrderFactory()
+  build_book(matcher, factory, rand, int(5000 * scale), 100)
+
+  measurement = Measurement()
+  for x in xrange(int(5000 * scale)):
+    measurement.start()
+    side = rand.choice(('1', '2'))
+    sign = -1 if side == '1' else 1
+    order = factory.create(rand.randrange(100), side, MID_PRICE + sign * rand.randint(1, 2000) * TICK,
+                           rand.randint(1, 100) * TICK)
+    measurement.call(matcher.match, None, order)
+  return measurement
+
+def cancel_heavy_market_making(rand, scale):
+  """ quotes cancelled and replaced near the top of the book, three cancels for every new quote """
+  matcher = create_book()
+  factory = OrderFactory()
+  build_book(matcher, factory, rand, int(2000 * scale), 50, spread_ticks=200)
+
+  measurement = Measurement()
+  for x in xrange(int(10000 * scale)):
+    measurement.start()
+    side = rand.choice(('1', '2'))
+    book_side = matcher.buy_side if side == '1' else matcher.sell_side
+    if rand.random() < 0.75 and book_side:
+      order = book_side[ min(int(rand.expovariate(0.05)), len(book_side) - 1) ]
+      measurement.call(matcher.cancel, None, order)
+    else:
+      sign = -1 if side == '1' else 1
+      order = factory.create(rand.randrange(50), side, MID_PRICE + sign * rand.randint(1, 200) * TICK,
+                             rand.randint(1, 100) * TICK)
+      measurement.call(matcher.match, None, order)
+  return measurement
+
+def sweep(rand, scale, levels=50):
+  """ a buy crossing every level of the asks, refilled before each sweep """
+  matcher = create_book()
+  factory = OrderFactory()
+
+  measurement = Measurement()
+  for x in xrange(int(200 * scale)):
+    measurement.start()
+    fill_levels(matcher, factory, 1, '2', levels, 10 * TICK)
+    order = factory.create(2, '1', MID_PRICE + (levels + 1) * TICK, levels * 10 * TICK)
+    measurement.call(matcher.match, None, order)
+  return measurement
+
+def self_trade_cancel(rand, scale, levels=20):
+  """ a buy crossing asks of its own account, every counter order is cancelled and the buy rests """
+  matcher = create_book()
+  factory = OrderFactory()
+
+  measurement = Measurement()
+  for x in xrange(int(500 * scale)):
+    measurement.start()
+    fill_levels(matcher, factory, 1, '2', levels, 10 * TICK)
+    order = factory.create(1, '1', MID_PRICE + (levels + 1) * TICK, 10 * TICK)
+    measurement.call(matcher.match, None, order)
+  return measurement
+
+def market_orders(rand, scale, levels=10):
+  """ market buys filled by the first levels of the asks """
+  matcher = create_book()
+  factory = OrderFactory()
+
+  measurement = Measurement()
+  for x in xrange(int(1000 * scale)):
+    measurement.start()
+    fill_levels(matcher, factory, 1, '2', levels, 10 * TICK)
+    order = factory.create(2, '1', 0, rand.randint(1, levels / 2) * 10 * TICK, type='1')
+    measurement.call(matcher.match, None, order)
+  return measurement
+
+def order_compare(rand, scale):
+  """ Order.__cmp__, finding the position of an order in a deep book """
+  matcher = create_book()
+  factory = OrderFactory()
+  build_book(matcher, factory, rand, int(10000 * scale), 100)
+
+  measurement = Measurement()
+  for x in xrange(int(20000 * scale)):
+    measurement.start()
+    side = rand.choice(('1', '2'))
+    book_side = matcher.buy_side if side == '1' else matcher.sell_side
+    sign = -1 if side == '1' else 1
+    order = factory.create(rand.randrange(100), side, MID_PRICE + sign * rand.randint(1, 2000) * TICK, TICK)
+    measurement.call(bisect.bisect_right, book_side, order)
+  return measurement
+
+def order_match(rand, scale):
+  """ Order.has_match and Order.match against the top of the other side """
+  factory = OrderFactory()
+  counter_orders = [ factory.create(1, '2', MID_PRICE + rand.randint(-100, 100) * TICK, 10 * TICK)
+                     for x in xrange(1000) ]
+
+  def has_match_and_match(order, counter_order):
+    if order.has_match(counter_order):
+      order.match(counter_order, order.leaves_qty)
+
+  measurement = Measurement()
+  for x in xrange(int(50000 * scale)):
+    measurement.start()
+    order = factory.create(2, '1', MID_PRICE, 5 * TICK)
+    measurement.call(has_match_and_match, order, counter_orders[x % len(counter_orders)])
+  return measurement
+
+SCENARIOS = [
+  ('deep_book_insert', deep_book_insert),
+  ('cancel_heavy_market_making', cancel_heavy_market_making),
+  ('sweep', sweep),
+  ('self_trade_cancel', self_trade_cancel),
+  ('market_orders', market_orders),
+  ('order_compare', order_compare),
+  ('order_match', order_match),
+]
+
+
+def get_measurement_overhead():
+  """ objects counted by Measurement.call for a call that allocates nothing """
+  measurement = Measurement()
+  for x in xrange(1000):
+    measurement.call(int)
+  return float(measurement.objects) / measurement.ops
+
+def get_git_revision():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT_PATH).strip()
+  except Exception:
+    return None
+
+def run_scenarios(arguments):
+  load_matcher()
+  names = arguments.scenario or [ name for name, function in SCENARIOS ]
+  functions = dict(SCENARIOS)
+
+  gc.disable()
+  try:
+    overhead = get_measurement_overhead()
+    results = {}
+    for name in names:
+      best = None
+      for repeat in xrange(arguments.repeat):
+        result = functions[name](random.Random(arguments.seed), arguments.scale).get_result(overhead)
+        gc.collect()
+        if best is None or result['OpsPerSec'] > best['OpsPerSec']:
+          best = result
+      results[name] = best
+      if not arguments.quiet:
+        print_scenario(name, best)
+  finally:
+    gc.enable()
+
+  return {
+    'Config': {
+      'scale'   : arguments.scale,
+      'repeat'  : arguments.repeat,
+      'seed'    : arguments.seed,
+      'python'  : platform.python_version(),
+      'platform': platform.platform(),
+      'machine' : platform.node(),
+      'revision': get_git_revision(),
+      'started' : datetime.datetime.now().isoformat()
+    },
+    'Scenarios': results
+  }
+
+def print_scenario(name, result):
+  print '  %-28s %10.0f ops/s %10.2f us/op %8.2f retained/op %6.2f publications/op' % (name, result['OpsPerSec'],
+    result['MicrosecondsPerOp'], result['RetainedObjectsPerOp'], result['PublicationsPerOp'])
+  sys.stdout.flush()
+
+def change(old, new):
+  return (new - old) / old * 100 if old else 0
+
+def compare_results(baseline, results, tolerance):
+  """ prints the changes from the baseline, returns the names of the scenarios that regressed """
+  if baseline['Config'].get('machine') != results['Config'].get('machine'):
+    print 'the baseline was saved on %s, the numbers are not comparable' % baseline['Config'].get('machine')
+
+  regressions = []
+  for name in sorted(set(baseline['Scenarios']) & set(results['Scenarios'])):
+    old = baseline['Scenarios'][name]
+    new = results['Scenarios'][name]
+    ops_change = change(old['OpsPerSec'], new['OpsPerSec'])
+    objects_change = change(old['RetainedObjectsPerOp'], new['RetainedObjectsPerOp'])
+    # the retained objects are near 0 in most scenarios, a fraction of an object more is noise
+    regressed = ops_change < -tolerance or (objects_change > tolerance and
+                                           new['RetainedObjectsPerOp'] - old['RetainedObjectsPerOp'] > 0.5)
+    if regressed:
+      regressions.append(name)
+    print '  %-28s %10.0f -> %10.0f ops/s (%+6.1f%%)  %8.2f -> %8.2f retained/op%s' % (name,
+      old['OpsPerSec'], new['OpsPerSec'], ops_change, old['RetainedObjectsPerOp'], new['RetainedObjectsPerOp'],
+      '  REGRESSION' if regressed else '')
+  return regressions
+
+def write_json(filename, data):
+  directory = os.path.dirname(filename)
+  if directory and not os.path.exists(directory):
+    os.makedirs(directory)
+  with open(filename, 'w') as output_file:
+    json.dump(data, output_file, indent=2, sort_keys=True)
+
+def run(arguments):
+  results = run_scenarios(arguments)
+  if arguments.output:
+    write_json(arguments.output, results)
+
+  if arguments.save_baseline:
+    write_json(arguments.baseline, results)
+    print 'baseline saved to %s' % arguments.baseline
+  elif os.path.exists(arguments.baseline):
+    with open(arguments.baseline) as baseline_file:
+      baseline = json.load(baseline_file)
+    print 'compared with %s (%s)' % (arguments.baseline, baseline['Config'].get('revision'))
+    if compare_results(baseline, results, arguments.tolerance):
+      sys.exit(1)
+
+def compare(arguments):
+  with open(arguments.baseline) as baseline_file:
+    baseline = json.load(baseline_file)
+  with open(arguments.results) as results_file:
+    results = json.load(results_file)
+  if compare_results(baseline, results, arguments.tolerance):
+    sys.exit(1)
+
+def main():
+  parser = argparse.ArgumentParser(description='Order book microbenchmarks')
+  subparsers = parser.add_subparsers()
+
+  run_parser = subparsers.add_parser('run', help='runs the scenarios and compares them with the baseline')
+  run_parser.add_argument('--scenario', action='append', choices=[ name for name, function in SCENARIOS ],
+                          help='runs only this scenario, repeatable')
+  run_parser.add_argument('--scale', type=float, default=1., help='multiplies the operations of every scenario')
+  run_parser.add_argument('--repeat', type=int, default=3, help='runs of every scenario, the fastest is kept')
+  run_parser.add_argument('--seed', type=int, default=1)
+  run_parser.add_argument('--tolerance', type=float, default=20,
+                          help='percent slower or retaining more objects to fail')
+  run_parser.add_argument('--baseline', default=BASELINE_FILE)
+  run_parser.add_argument('--save-baseline', action='store_true', help='stores the results as the baseline')
+  run_parser.add_argument('--output', help='JSON results file')
+  run_parser.add_argument('--quiet', action='store_true')
+  run_parser.set_defaults(function=run)
+
+  compare_parser = subparsers.add_parser('compare', help='compares a results file with the baseline')
+  compare_parser.add_argument('results')
+  compare_parser.add_argument('--baseline', default=BASELINE_FILE)
+  compare_parser.add_argument('--tolerance', type=float, default=20)
+  compare_parser.set_defaults(function=compare)
+
+  arguments = parser.parse_args()
+  arguments.function(arguments)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,620 @@
+#!/usr/bin/env python
+"""
+Measures the market data fan-out of the websocket gateway, without the trade engine.
+
+  md_fanout.py --clients 100,1000,5000,20000 --rate 200 --duration 30 --output fanout.json
+  md_fanout.py --log trade.log --clients 100,1000 --rate 500 --depths 0,5,20 --processes 8
+
+For every number of clients a gateway is started against a stub trade engine, which answers the requests the
+gateway makes at start up (OPN, CLS, x, V, U32 and heartbeats) and publishes a market data stream at --rate
+messages per second. The stream is the MD_INCREMENTAL and MD_TRADE publications of a recorded trade log, looped,
+or a synthetic one with orders added, removed and traded on every symbol. The stub stamps every entry it
+publishes with a PublishTime field, which the gateway forwards untouched to the subscribers.
+
+The clients are spread over --processes processes. Each subscribes one or all of the symbols with a depth taken
+from --depths, some of them to the trades as well. Measured for every run:
+  - the delay from the stub publishing an entry until a client receives it, in milliseconds
+  - the CPU seconds of the gateway per published message and per message delivered to the clients
+  - the resident memory of the gateway per connection, between the idle gateway and all clients subscribed
+
+The clients run on the same host as the stub, so their clocks are the same. Each client holds a socket, and the
+gateway a websocket and a zmq socket per client: the open files limit is raised to the hard limit, and it may
+have to be raised further (ulimit -n) for tens of thousands of clients.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import urllib2
+import argparse
+import datetime
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from decimal import Decimal
+
+ROOT_PATH = os.path.abspath( os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'libs'))
+
+from bitex.json_encoder import JsonEncoder
+from bitex.histogram import Histogram
+
+MD_TOPIC_PREFIXES = ( 'MD_INCREMENTAL_', 'MD_TRADE_' )
+PUBLICATION_GLOBALS = { 'datetime': datetime, 'Decimal': Decimal, '__builtins__': {} }
+
+def get_symbol(topic):
+  for prefix in MD_TOPIC_PREFIXES:
+    if topic.startswith(prefix):
+      return topic[len(prefix):].split('.')[0]
+
+def load_recorded_stream(filename):
+  """ [(topic, message)] of the market data publications of a trade log, OUT,TRADE_PUB,[topic, message] """
+  from bitex.replay_log import read_log_records
+  stream = []
+  for timestamp, command, key, value in read_log_records(filename):
+    if command != 'OUT' or key != 'TRADE_PUB' or not value:
+      continue
+    topic, message = eval(value, PUBLICATION_GLOBALS)
+    topic = str(topic)  # the execution reports are published on the user id
+    if get_symbol(topic) and message.get('MDIncGrp'):
+      stream.append( (topic, message) )
+  return stream
+
+def generate_stream(symbols, count, seed, price=50000000000, max_orders=200):
+  """ a consistent incremental stream, starting from empty books: orders are added and deleted by position,
+  and the best order of a side is traded now and then """
+  rand = random.Random(seed)
+  books = dict( (symbol, { '0': [], '1': [] }) for symbol in symbols )
+  stream = []
+  next_id = 1
+  now = datetime.datetime.now()
+
+  def book_entry(symbol, action, side, position, **fields):
+    entry = { 'MDUpdateAction': action, 'MDEntryType': side, 'MDEntryPositionNo': position + 1, 'Symbol': symbol }
+    entry.update(fields)
+    return ('MD_INCREMENTAL_%s.%s' % (symbol, side), { 'MsgType': 'X', 'MDBkTyp': '3', 'MDIncGrp': [ entry ] })
+
+  while len(stream) < count:
+    symbol = rand.choice(symbols)
+    side = rand.choice(('0', '1'))
+    orders = books[symbol][side]
+    action = rand.random()
+
+    if not orders or (action < 0.55 and len(orders) < max_orders):
+      # bids sorted from the highest price, asks from the lowest
+      offset = rand.randint(1, 500) * 1000000
+      order_price = price - offset if side == '0' else price + offset
+      position = 0
+      while position < len(orders) and (orders[position][0] >= order_price if side == '0'
+                                        else orders[position][0] <= order_price):
+        position += 1
+      size = rand.randint(1, 100) * 1000000
+      orders.insert(position, (order_price, next_id))
+      stream.append(book_entry(symbol, '0', side, position, MDEntryPx=order_price, MDEntrySize=size,
+                               OrderID=next_id, MDEntryID=next_id, Username='md_fanout', Broker='md_fanout',
+                               MDEntryDate=now.date(), MDEntryTime=now.time()))
+      next_id += 1
+
+    elif action < 0.9:
+      position = rand.randrange(len(orders))
+      orders.pop(position)
+      stream.append(book_entry(symbol, '2', side, position))
+
+    else:
+      order_price, order_id = orders.pop(0)
+      stream.append( ('MD_TRADE_' + symbol, { 'MsgType': 'X', 'MDBkTyp': '3', 'MDIncGrp': [ {
+        'MDUpdateAction': '0', 'MDEntryType': '2', 'Symbol': symbol, 'TradeID': next_id,
+        'MDEntryPx': order_price, 'MDEntrySize': rand.randint(1, 100) * 1000000,
+        'OrderID': next_id, 'SecondaryOrderID': order_id, 'Side': '1' if side == '1' else '2',
+        'MDEntryBuyer': 'md_fanout', 'MDEntrySeller': 'md_fanout',
+        'MDEntryDate': now.date(), 'MDEntryTime': now.time() } ] }) )
+      stream.append(book_entry(symbol, '2', side, 0))
+      next_id += 1
+
+  return stream
+
+
+class StubTradeEngine(object):
+  """ answers the requests of the gateway on trade_in and publishes the stream on trade_pub, in its own process """
+  def __init__(self, trade_in, trade_pub, stream, symbols, rate):
+    self.trade_in = trade_in
+    self.trade_pub = trade_pub
+    self.stream = stream
+    self.symbols = symbols
+    self.rate = rate
+    self.max_trade_id = max([ entry.get('TradeID') or 0 for topic, message in stream
+                              for entry in message['MDIncGrp'] ] or [ 0 ])
+
+    self.publishing = multiprocessing.Event()
+    self.stopped = multiprocessing.Event()
+    self.published_messages = multiprocessing.RawValue('L', 0)
+    self.published_entries = multiprocessing.RawValue('L', 0)
+    self.process = None
+
+  def start(self):
+    self.process = multiprocessing.Process(target=self.run)
+    self.process.daemon = True
+    self.process.start()
+
+  def stop(self):
+    self.stopped.set()
+    self.process.join(5)
+
+  def get_reply(self, msg):
+    msg_type = msg.get('MsgType')
+    if msg_type == 'x':
+      return { 'MsgType': 'y', 'SecurityReqID': msg.get('SecurityReqID'), 'SecurityResponseID': '1',
+               'SecurityRequestResult': 0, 'Currencies': [],
+               'Instruments': [ { 'Symbol': symbol, 'Currency': symbol[3:], 'Description': symbol }
+                                for symbol in self.symbols ] }
+    elif msg_type == 'V':
+      return { 'MsgType': 'W', 'MDReqID': msg.get('MDReqID'), 'MarketDepth': msg.get('MarketDepth'),
+               'MDFullGrp': [] }
+    elif msg_type == 'U32':
+      return { 'MsgType': 'U33', 'TradeHistoryReqID': msg.get('TradeHistoryReqID'), 'Page': msg.get('Page'),
+               'PageSize': msg.get('PageSize'), 'TradeHistoryGrp': [] }
+    elif msg_type == '1':
+      return { 'MsgType': '0', 'TestReqID': msg.get('TestReqID') }
+    return { 'MsgType': 'ERROR', 'Description': 'Not supported by the stub trade engine', 'Detail': msg_type }
+
+  def on_request(self, socket):
+    frames = socket.recv_multipart()
+    request = frames[-1]
+    operation = request[:3]
+    if operation in ('OPN', 'CLS'):
+      reply = request
+    elif operation == 'REQ':
+      reply = 'REP,' + json.dumps(self.get_reply(json.loads(request.split(',', 2)[2])), cls=JsonEncoder)
+    else:
+      reply = 'ERR,Invalid operation'
+    socket.send_multipart(frames[:-1] + [ reply ])
+
+  def publish(self, socket, position, loop):
+    if position == 0:
+      # the books of the gateway are cleared at every pass, the positions of the stream start from empty books
+      for symbol in self.symbols:
+        socket.send_multipart([ 'MD_FULL_REFRESH_' + symbol, json.dumps({
+          'MsgType': 'W', 'MDReqID': '0', 'Symbol': symbol, 'MarketDepth': 0, 'MDFullGrp': [] }) ])
+
+    topic, message = self.stream[position]
+    publish_time = time.time()
+    group = []
+    for entry in message['MDIncGrp']:
+      entry = dict(entry, PublishTime=publish_time)
+      if loop and 'TradeID' in entry:
+        # the gateway stores the trades it receives, every pass gets new trade ids
+        entry['TradeID'] += loop * self.max_trade_id
+      group.append(entry)
+    socket.send_multipart([ topic, json.dumps(dict(message, MDIncGrp=group), cls=JsonEncoder) ])
+
+    self.published_messages.value += 1
+    self.published_entries.value += len(group)
+
+  def run(self):
+    import zmq
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    context = zmq.Context()
+    trade_in_socket = context.socket(zmq.ROUTER)
+    trade_in_socket.bind(self.trade_in)
+    trade_pub_socket = context.socket(zmq.PUB)
+    trade_pub_socket.bind(self.trade_pub)
+    poller = zmq.Poller()
+    poller.register(trade_in_socket, zmq.POLLIN)
+
+    interval = 1. / self.rate
+    next_publish = None
+    position = 0
+    loop = 0
+    while not self.stopped.is_set():
+      timeout = 100
+      if self.publishing.is_set() and self.stream:
+        now = time.time()
+        if next_publish is None:
+          next_publish = now
+        while next_publish <= now:
+          self.publish(trade_pub_socket, position, loop)
+          position += 1
+          if position == len(self.stream):
+            position = 0
+            loop += 1
+          next_publish += interval
+        timeout = max(0, (next_publish - time.time()) * 1000)
+      else:
+        next_publish = None
+
+      for socket, event in poller.poll(timeout):
+        self.on_request(socket)
+
+    trade_in_socket.close(0)
+    trade_pub_socket.close(0)
+    context.term()
+
+
+class MarketDataClient(object):
+  def __init__(self, index, url, symbols, market_depth, entry_types, stats, io_loop):
+    self.index = index
+    self.url = url
+    self.symbols = symbols
+    self.market_depth = market_depth
+    self.entry_types = entry_types
+    self.stats = stats
+    self.io_loop = io_loop
+    self.connection = None
+    self.subscriptions = 0
+
+  def connect(self, on_done, connect_timeout):
+    from tornado.websocket import websocket_connect
+    self.on_done = on_done
+    websocket_connect(self.url, self.io_loop, callback=self.on_connect, connect_timeout=connect_timeout)
+
+  def on_connect(self, future):
+    try:
+      self.connection = future.result()
+    except Exception:
+      self.stats.increment('connect_errors')
+      self.on_done()
+      return
+    self.stats.increment('connections')
+    self.read_message()
+    self.connection.write_message(json.dumps({
+      'MsgType': 'V',
+      'MDReqID': self.index,
+      'SubscriptionRequestType': '1',
+      'MarketDepth': self.market_depth,
+      'MDUpdateType': '1',
+      'MDEntryTypes': self.entry_types,
+      'Instruments': self.symbols }))
+
+  def read_message(self):
+    self.connection.read_message(self.on_read_message)
+
+  def on_read_message(self, future):
+    raw_message = future.result()
+    if raw_message is None:
+      if self.connection:
+        self.stats.increment('disconnects')
+      self.connection = None
+      return
+
+    now = time.time()
+    msg = json.loads(raw_message)
+    msg_type = msg.get('MsgType')
+    if msg_type == 'W':
+      self.subscriptions += 1
+      if self.subscriptions == len(self.symbols):
+        self.stats.increment('subscribed')
+        self.on_done()
+    elif msg_type == 'X':
+      self.stats.on_incremental(msg, now, len(raw_message))
+    if self.connection:
+      self.read_message()
+
+  def close(self):
+    if self.connection:
+      connection, self.connection = self.connection, None
+      connection.protocol.close()
+
+
+class ClientStats(object):
+  def __init__(self):
+    self.counters = {}
+    self.reset()
+
+  def reset(self):
+    self.start_time = time.time()
+    self.messages = 0
+    self.entries = 0
+    self.bytes = 0
+    self.latency = Histogram()
+
+  def increment(self, name, value=1):
+    self.counters[name] = self.counters.get(name, 0) + value
+
+  def on_incremental(self, msg, now, size):
+    self.messages += 1
+    self.bytes += size
+    for entry in msg.get('MDIncGrp', ()):
+      self.entries += 1
+      publish_time = entry.get('PublishTime')
+      if publish_time:
+        self.latency.record((now - publish_time) * 1000)
+
+
+def run_clients(arguments, process_index, first_index, count, symbols, measuring, done, results):
+  """ connects count clients to the gateway, the entry point of a client process """
+  import tornado.ioloop
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  io_loop = tornado.ioloop.IOLoop.instance()
+  rand = random.Random(arguments.seed + process_index)
+  stats = ClientStats()
+  depths = [ int(depth) for depth in arguments.depths.split(',') ]
+  clients = []
+  for index in xrange(first_index, first_index + count):
+    if rand.random() < arguments.all_symbols_ratio:
+      client_symbols = symbols
+    else:
+      client_symbols = [ rand.choice(symbols) ]
+    entry_types = [ '0', '1', '2' ] if rand.random() < arguments.trades_ratio else [ '0', '1' ]
+    clients.append(MarketDataClient(index, arguments.url, client_symbols, rand.choice(depths), entry_types, stats,
+                                    io_loop))
+
+  state = { 'pending': len(clients), 'measuring': False }
+  def on_client_done():
+    state['pending'] -= 1
+    if state['pending'] == 0:
+      results.put( ('ready', process_index, stats.counters) )
+
+  def on_check():
+    if measuring.is_set() and not state['measuring']:
+      state['measuring'] = True
+      stats.reset()
+    if done.is_set():
+      checker.stop()
+      elapsed = time.time() - stats.start_time
+      results.put( ('result', process_index, {
+        'Counters': stats.counters,
+        'Seconds' : elapsed,
+        'Messages': stats.messages,
+        'Entries' : stats.entries,
+        'Bytes'   : stats.bytes,
+        'Latency' : stats.latency }) )
+      for client in clients:
+        client.close()
+      io_loop.add_timeout(time.time() + 1, io_loop.stop)
+
+  ramp_up_interval = float(arguments.ramp_up) / len(clients) if clients else 0
+  for position, client in enumerate(clients):
+    io_loop.add_timeout(time.time() + position * ramp_up_interval,
+                        lambda client=client: client.connect(on_client_done, arguments.timeout))
+  if not clients:
+    results.put( ('ready', process_index, stats.counters) )
+
+  checker = tornado.ioloop.PeriodicCallback(on_check, 100, io_loop=io_loop)
+  checker.start()
+  io_loop.start()
+
+
+def get_process_cpu(pid):
+  """ user + system CPU seconds of a process """
+  with open('/proc/%d/stat' % pid) as stat_file:
+    fields = stat_file.read().rsplit(')', 1)[1].split()
+  return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+def get_process_rss(pid):
+  with open('/proc/%d/status' % pid) as status_file:
+    for line in status_file:
+      if line.startswith('VmRSS:'):
+        return int(line.split()[1]) * 1024
+  return 0
+
+def get_gateway_metrics(port):
+  return json.loads(urllib2.urlopen('http://127.0.0.1:%d/_metrics' % port, timeout=30).read())
+
+def wait_results(results, kind, processes, timeout):
+  received = {}
+  deadline = time.time() + timeout
+  while len(received) < processes and time.time() < deadline:
+    try:
+      result_kind, process_index, value = results.get(timeout=max(0.1, deadline - time.time()))
+    except Exception:
+      break
+    if result_kind == kind:
+      received[process_index] = value
+  return received
+
+def start_gateway(arguments, work_dir, trade_in, trade_pub):
+  command = [ arguments.python, arguments.gateway,
+              '--port=%d' % arguments.port,
+              '--trade_in=' + trade_in,
+              '--trade_pub=' + trade_pub,
+              '--gateway_log=' + os.path.join(work_dir, 'ws_gateway.log'),
+              '--gateway_log_format=' + arguments.gateway_log_format,
+              '--db_engine=sqlite:///' + os.path.join(work_dir, 'ws_gateway.sqlite'),
+              '--callback_url=http://127.0.0.1/',
+              '--gateway_metrics_allowed_ips=127.0.0.1' ] + arguments.gateway_option  # /_metrics is off by default
+  with open(os.path.join(work_dir, 'ws_gateway.out'), 'w') as output_file:
+    gateway = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(arguments.gateway)),
+                               stdout=output_file, stderr=subprocess.STDOUT)
+
+  deadline = time.time() + arguments.timeout
+  while time.time() < deadline:
+    if gateway.poll() is not None:
+      raise RuntimeError('the gateway exited with %s, see %s' % (gateway.returncode,
+                                                                  os.path.join(work_dir, 'ws_gateway.out')))
+    try:
+      get_gateway_metrics(arguments.port)
+      return gateway
+    except Exception:
+      time.sleep(0.2)
+  gateway.kill()
+  raise RuntimeError('the gateway did not start in %s seconds' % arguments.timeout)
+
+def stop_gateway(gateway):
+  gateway.send_signal(signal.SIGINT)
+  deadline = time.time() + 10
+  while gateway.poll() is None and time.time() < deadline:
+    time.sleep(0.1)
+  if gateway.poll() is None:
+    gateway.kill()
+    gateway.wait()
+
+def run_step(arguments, clients, stream, symbols):
+  work_dir = tempfile.mkdtemp(prefix='md_fanout')
+  trade_in = 'tcp://127.0.0.1:%d' % arguments.trade_port
+  trade_pub = 'tcp://127.0.0.1:%d' % (arguments.trade_port + 1)
+  stub = StubTradeEngine(trade_in, trade_pub, stream, symbols, arguments.rate)
+  stub.start()
+  gateway = None
+  client_processes = []
+  try:
+    gateway = start_gateway(arguments, work_dir, trade_in, trade_pub)
+    time.sleep(1)
+    rss_idle = get_process_rss(gateway.pid)
+
+    measuring = multiprocessing.Event()
+    done = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    processes = min(arguments.processes, clients)
+    first_index = 0
+    for process_index in xrange(processes):
+      count = clients // processes + (1 if process_index < clients % processes else 0)
+      process = multiprocessing.Process(target=run_clients, args=(arguments, process_index, first_index, count,
+                                                                  symbols, measuring, done, results))
+      process.daemon = True
+      process.start()
+      client_processes.append(process)
+      first_index += count
+
+    ready = wait_results(results, 'ready', processes, arguments.ramp_up + arguments.timeout * 2)
+    time.sleep(1)
+    rss_connected = get_process_rss(gateway.pid)
+
+    stub.publishing.set()
+    time.sleep(arguments.warmup)
+
+    metrics_before = get_gateway_metrics(arguments.port)
+    cpu_before = get_process_cpu(gateway.pid)
+    published_before = stub.published_messages.value, stub.published_entries.value
+    measuring.set()
+    time.sleep(arguments.duration)
+    cpu_after = get_process_cpu(gateway.pid)
+    published_after = stub.published_messages.value, stub.published_entries.value
+    metrics_after = get_gateway_metrics(arguments.port)
+    done.set()
+    stub.publishing.clear()
+    rss_end = get_process_rss(gateway.pid)
+
+    client_results = wait_results(results, 'result', processes, arguments.timeout * 2)
+  finally:
+    for process in client_processes:
+      process.join(5)
+      if process.is_alive():
+        process.terminate()
+    if gateway:
+      stop_gateway(gateway)
+    stub.stop()
+    if not arguments.keep_files:
+      shutil.rmtree(work_dir, ignore_errors=True)
+
+  counters = {}
+  latency = Histogram()
+  delivered_messages = delivered_entries = delivered_bytes = 0
+  for result in client_results.itervalues():
+    for name, value in result['Counters'].iteritems():
+      counters[name] = counters.get(name, 0) + value
+    latency.merge(result['Latency'])
+    delivered_messages += result['Messages']
+    delivered_entries += result['Entries']
+    delivered_bytes += result['Bytes']
+
+  published_messages = published_after[0] - published_before[0]
+  published_entries = published_after[1] - published_before[1]
+  cpu = cpu_after - cpu_before
+  gateway_counters_before = metrics_before['Counters']
+  gateway_messages_out = metrics_after['Counters'].get('ws_messages_out', 0) - \
+                         gateway_counters_before.get('ws_messages_out', 0)
+  connections = metrics_after['Connections']
+
+  return {
+    'Clients'         : clients,
+    'Connected'       : counters.get('connections', 0),
+    'Subscribed'      : counters.get('subscribed', 0),
+    'ConnectErrors'   : counters.get('connect_errors', 0),
+    'Disconnects'     : counters.get('disconnects', 0),
+    'ProcessesReady'  : len(ready),
+    'Seconds'         : arguments.duration,
+    'Published'       : { 'Messages': published_messages, 'Entries': published_entries,
+                          'Rate': published_messages / float(arguments.duration) },
+    'Delivered'       : { 'Messages': delivered_messages, 'Entries': delivered_entries, 'Bytes': delivered_bytes,
+                          'Rate': delivered_messages / float(arguments.duration),
+                          'GatewayMessagesOut': gateway_messages_out },
+    'Latency'         : latency.to_dict(),
+    'LatencyDistribution': latency.get_percentile_distribution(),
+    'GatewayCPU'      : { 'Seconds': cpu,
+                          'Utilization': cpu / arguments.duration,
+                          'MicrosecondsPerPublished': cpu * 1e6 / published_messages if published_messages else 0,
+                          'MicrosecondsPerDelivered': cpu * 1e6 / gateway_messages_out if gateway_messages_out else 0 },
+    'GatewayMemory'   : { 'RSSIdle': rss_idle, 'RSSConnected': rss_connected, 'RSSEnd': rss_end,
+                          'Connections': connections,
+                          'BytesPerConnection': (rss_connected - rss_idle) / float(connections) if connections else 0 },
+    'IOLoopLag'       : metrics_after['IOLoopLagHistogram'],
+    'WriteBufferTotal': metrics_after['WriteBufferTotal']
+  }
+
+def print_step(result):
+  latency = result['Latency']
+  print '%6d clients %6d subscribed  published %7.0f/s  delivered %9.0f/s  latency p50 %8.2f p99 %8.2f ' \
+        'p99.9 %8.2f max %8.2f ms  cpu %5.1f%% %7.1f us/published %6.2f us/delivered  %7.1f KB/connection' % (
+    result['Clients'], result['Subscribed'], result['Published']['Rate'], result['Delivered']['Rate'],
+    latency['P50'], latency['P99'], latency['P999'], latency['Max'],
+    result['GatewayCPU']['Utilization'] * 100, result['GatewayCPU']['MicrosecondsPerPublished'],
+    result['GatewayCPU']['MicrosecondsPerDelivered'], result['GatewayMemory']['BytesPerConnection'] / 1024.)
+  sys.stdout.flush()
+
+def raise_open_files_limit():
+  soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+  if hard != resource.RLIM_INFINITY and soft < hard:
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def run(arguments):
+  if arguments.log:
+    stream = load_recorded_stream(arguments.log)
+    symbols = sorted(set( get_symbol(topic) for topic, message in stream ))
+  else:
+    symbols = arguments.symbols.split(',')
+    stream = generate_stream(symbols, arguments.messages, arguments.seed)
+  if not stream:
+    raise SystemExit('no market data in the stream')
+
+  raise_open_files_limit()
+  arguments.url = 'ws://127.0.0.1:%d/' % arguments.port
+  results = []
+  for clients in [ int(clients) for clients in arguments.clients.split(',') ]:
+    result = run_step(arguments, clients, stream, symbols)
+    print_step(result)
+    results.append(result)
+
+  report = {
+    'Config'  : dict( (name, value) for name, value in vars(arguments).iteritems() ),
+    'Symbols' : symbols,
+    'StreamMessages': len(stream),
+    'Steps'   : results
+  }
+  report['Config']['started'] = datetime.datetime.now().isoformat()
+  if arguments.output:
+    with open(arguments.output, 'w') as output_file:
+      json.dump(report, output_file, indent=2, sort_keys=True)
+
+def main():
+  parser = argparse.ArgumentParser(description='Market data fan-out benchmark of the websocket gateway')
+  parser.add_argument('--clients', default='100,1000,5000,20000', help='comma separated numbers of clients, a run each')
+  parser.add_argument('--rate', type=float, default=100, help='market data messages published per second')
+  parser.add_argument('--log', help='trade log whose MD_INCREMENTAL and MD_TRADE publications are replayed')
+  parser.add_argument('--symbols', default='BTCUSD,BTCBRL', help='symbols of the synthetic stream')
+  parser.add_argument('--messages', type=int, default=10000, help='messages of the synthetic stream, it is looped')
+  parser.add_argument('--depths', default='0,1,5,20', help='market depths the clients subscribe with')
+  parser.add_argument('--all-symbols-ratio', type=float, default=0.2, help='fraction of the clients on every symbol')
+  parser.add_argument('--trades-ratio', type=float, default=0.5, help='fraction of the clients subscribing trades')
+  parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help='client processes')
+  parser.add_argument('--ramp-up', type=float, default=10, help='seconds to connect all the clients')
+  parser.add_argument('--warmup', type=float, default=5, help='seconds publishing before measuring')
+  parser.add_argument('--duration', type=float, default=30, help='seconds measured')
+  parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for the gateway and the clients')
+  parser.add_argument('--port', type=int, default=18445, help='port of the gateway')
+  parser.add_argument('--trade-port', type=int, default=15757, help='trade_in of the stub, trade_pub is the next one')
+  parser.add_argument('--gateway', default=os.path.join(ROOT_PATH, 'apps/ws_gateway/main.py'))
+  parser.add_argument('--gateway-log-format', choices=('text', 'binary'), default='text')
+  parser.add_argument('--gateway-option', action='append', default=[], help='extra option of the gateway, repeatable')
+  parser.add_argument('--python', default=sys.executable)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--keep-files', action='store_true', help='keeps the gateway log and database of every run')
+  parser.add_argument('--output', help='JSON results file')
+  run(parser.parse_args())
+
+if __name__ == '__main__':
+  main()
@@ -15,7 +15,8 @@ csv_writer = csv.writer(csv_file)
 csv_writer.writerow( ('Timestamp','LineNumber', 'MessageType', 'ClOrdID', 'Latency(ms)') )
 
 def latency_in_ms(t1, t2):
-  return ( t2 - t1 ).microseconds / 1000
+  # timedelta.microseconds is only the sub second part
+  return ( t2 - t1 ).total_seconds() * 1000
 
 for line in fileinput.input(sys.argv[1]):
   timestamp = line[:23]
@@ -0,0 +1,500 @@
+#!/usr/bin/env python
+"""
+Latency percentiles from the gateway and trade replay logs.
+
+  log_analytics.py --trade /opt/bitex/logs/trade.log* --gateway /opt/bitex/logs/gateway.log* --output day.csv
+
+Every log file, or every chunk of a large text log, is parsed by a worker process into a stream of events in
+time order. The streams are merged by time and the requests are correlated across the processes:
+
+  D/F   gateway receive -> trade request -> trade execution report -> gateway send, by user and ClOrdID
+  X     trade publish -> gateway receive -> gateway send to every subscriber, by the first entry of the update
+  trace the stages stamped in the Trace field of the requests (TRADE_TRACE records)
+
+Requests not completed within --ttl seconds are dropped, so memory only depends on the message rate. Text and
+binary logs are accepted; a binary log is given by its name, without the segment number.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import heapq
+import marshal
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from collections import OrderedDict
+
+ROOT_PATH = os.path.abspath( os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'libs'))
+
+from bitex.histogram import Histogram, get_trace_stages, PERCENTILES
+from bitex.replay_log import MAGIC, get_segment_filenames, read_segment
+
+# events with the same timestamp are processed in the order they happen in the pipeline
+RANK_SESSION       = 0
+RANK_GATEWAY_IN    = 1
+RANK_TRADE_IN      = 2
+RANK_TRADE_OUT     = 3
+RANK_GATEWAY_MD_IN = 4
+RANK_GATEWAY_OUT   = 5
+
+FIELDS_REGEX = re.compile(r"""['"](MsgType|ClOrdID|OrigClOrdID|ExecType|UserID|UserStatus)['"]\s*:\s*u?['"]?([^'",}\s]*)""")
+MD_ENTRY_FIELDS_REGEX = re.compile(r"""['"](Symbol|MDEntryType|MDUpdateAction|OrderID|TradeID)['"]\s*:\s*u?['"]?([^'",}\s]*)""")
+
+ORDER_ENTRY_STAGES = ( ('gateway_to_trade' , 'gateway_in', 'trade_in'),
+                       ('trade'            , 'trade_in'  , 'trade_out'),
+                       ('trade_to_gateway' , 'trade_out' , 'gateway_out'),
+                       ('end_to_end'       , 'gateway_in', 'gateway_out') )
+
+# the request answered by an execution report, by its ExecType. Everything else answers a new order
+EXEC_TYPE_REQUESTS = { '4': 'F',    # cancel
+                       '5': 'G' }   # replace
+
+def get_fields(message, regex=FIELDS_REGEX):
+  """ the first value of every field, from json or from the repr of a python dict """
+  fields = {}
+  for name, value in regex.findall(message):
+    if name not in fields:
+      fields[name] = value
+  return fields
+
+def get_md_key(message):
+  """ identifies an incremental update by its first entry. Deletes carry no id and are not followed """
+  start = message.find('MDIncGrp')
+  if start < 0:
+    return None
+  start = message.find('{', start)
+  end = message.find('}', start)
+  if start < 0 or end < 0:
+    return None
+  entry = get_fields(message[start:end], MD_ENTRY_FIELDS_REGEX)
+  if entry.get('MDUpdateAction') not in ('0', '1') and entry.get('MDEntryType') != '2':
+    return None
+  if not entry.get('OrderID') and not entry.get('TradeID'):
+    return None
+  return '|'.join( entry.get(name, '') for name in ('Symbol', 'MDEntryType', 'MDUpdateAction', 'OrderID', 'TradeID') )
+
+
+class TextLogReader(object):
+  """ reads the records of a byte range of a text replay log """
+  def __init__(self, filename, start, end):
+    self.filename = filename
+    self.start = start
+    self.end = end
+    self.last_second = None
+    self.last_second_time = None
+
+  def get_time(self, line):
+    second = line[:19]
+    if second != self.last_second:
+      self.last_second = second
+      self.last_second_time = time.mktime(time.strptime(second, '%Y-%m-%d %H:%M:%S'))
+    return self.last_second_time + int(line[20:23]) / 1000.
+
+  def __iter__(self):
+    with open(self.filename, 'rb') as log_file:
+      position = self.start
+      log_file.seek(position)
+      if position:
+        position += len(log_file.readline()) # the line is read by the previous chunk
+
+      while position <= self.end:
+        line = log_file.readline()
+        if not line:
+          return
+        position += len(line)
+
+        if len(line) < 27 or line[19] != ',' or line[23:26] != ' - ':
+          continue
+        try:
+          timestamp = self.get_time(line)
+        except ValueError:
+          continue
+
+        fields = line[26:].rstrip('\r\n').split(',', 2)
+        if len(fields) < 3:
+          continue
+        yield timestamp, fields[0], fields[1], fields[2]
+
+
+def parse_trade_records(records, write):
+  last_session_id = None
+  for timestamp, command, key, value in records:
+    if command == 'IN' and key == 'TRADE_IN_REQ':
+      if not value.startswith('REQ,'):
+        continue
+      last_session_id = value[4:20]
+      fields = get_fields(value[21:])
+      msg_type = fields.get('MsgType')
+      if msg_type == 'D' and fields.get('ClOrdID'):
+        write( (timestamp, RANK_TRADE_IN, 'REQUEST', 'trade_in', last_session_id, 'D', fields['ClOrdID']) )
+      elif msg_type == 'F' and fields.get('OrigClOrdID'):
+        write( (timestamp, RANK_TRADE_IN, 'REQUEST', 'trade_in', last_session_id, 'F', fields['OrigClOrdID']) )
+      elif msg_type == 'G' and (fields.get('ClOrdID') or fields.get('OrigClOrdID')):
+        write( (timestamp, RANK_TRADE_IN, 'REQUEST', 'trade_in', last_session_id, 'G', fields.get('ClOrdID') or fields['OrigClOrdID']) )
+
+    elif command == 'OUT' and key == 'TRADE_IN_REP':
+      if '"BF"' in value and last_session_id:
+        fields = get_fields(value)
+        if fields.get('UserStatus') == '1' and fields.get('UserID'):
+          write( (timestamp, RANK_SESSION, 'SESSION', last_session_id, fields['UserID']) )
+
+    elif command == 'OUT' and key == 'TRADE_PUB':
+      topic = value[1:value.find(',')].strip("u'")
+      fields = get_fields(value)
+      msg_type = fields.get('MsgType')
+      if msg_type == '8' and fields.get('ClOrdID'):
+        request_type = EXEC_TYPE_REQUESTS.get(fields.get('ExecType'), 'D')
+        write( (timestamp, RANK_TRADE_OUT, 'EXECUTION', 'trade_out', topic, request_type, fields['ClOrdID']) )
+      elif msg_type == 'X':
+        md_key = get_md_key(value)
+        if md_key:
+          write( (timestamp, RANK_TRADE_OUT, 'MD', 'trade_out', md_key) )
+
+    elif command == 'OUT' and key == 'TRADE_TRACE':
+      try:
+        trace = json.loads(value)
+      except ValueError:
+        continue
+      write( (timestamp, RANK_TRADE_OUT, 'TRACE', trace.get('MsgType') or '', value) )
+
+
+def parse_gateway_records(records, write):
+  for timestamp, command, key, value in records:
+    if command == 'IN' and key == 'TRADE_PUB':
+      if '"X"' in value:
+        md_key = get_md_key(value)
+        if md_key:
+          write( (timestamp, RANK_GATEWAY_MD_IN, 'MD', 'gateway_in', md_key) )
+
+    elif command == 'IN':
+      fields = get_fields(value)
+      msg_type = fields.get('MsgType')
+      if msg_type == 'D' and fields.get('ClOrdID'):
+        write( (timestamp, RANK_GATEWAY_IN, 'REQUEST', 'gateway_in', key, 'D', fields['ClOrdID']) )
+      elif msg_type == 'F' and fields.get('OrigClOrdID'):
+        write( (timestamp, RANK_GATEWAY_IN, 'REQUEST', 'gateway_in', key, 'F', fields['OrigClOrdID']) )
+      elif msg_type == 'G' and (fields.get('ClOrdID') or fields.get('OrigClOrdID')):
+        write( (timestamp, RANK_GATEWAY_IN, 'REQUEST', 'gateway_in', key, 'G', fields.get('ClOrdID') or fields['OrigClOrdID']) )
+
+    elif command == 'OUT':
+      fields = get_fields(value)
+      msg_type = fields.get('MsgType')
+      if msg_type == '8' and fields.get('ClOrdID'):
+        request_type = EXEC_TYPE_REQUESTS.get(fields.get('ExecType'), 'D')
+        write( (timestamp, RANK_GATEWAY_OUT, 'EXECUTION', 'gateway_out', key, request_type, fields['ClOrdID']) )
+      elif msg_type == 'X':
+        md_key = get_md_key(value)
+        if md_key:
+          write( (timestamp, RANK_GATEWAY_OUT, 'MD', 'gateway_out', md_key) )
+      elif msg_type == 'BF' and fields.get('UserStatus') == '1' and fields.get('UserID'):
+        write( (timestamp, RANK_SESSION, 'SESSION', key, fields['UserID']) )
+
+
+def parse_job(job):
+  """ runs in a worker process. Writes the events of the job to a file and returns its name """
+  source, kind, filename, start, end, events_filename = job
+
+  if kind == 'binary':
+    records = read_segment(filename)
+  else:
+    records = TextLogReader(filename, start, end)
+
+  with open(events_filename, 'wb') as events_file:
+    def write(event):
+      marshal.dump(event, events_file)
+
+    if source == 'trade':
+      parse_trade_records(records, write)
+    else:
+      parse_gateway_records(records, write)
+  return events_filename
+
+def read_events(events_filename):
+  with open(events_filename, 'rb') as events_file:
+    while True:
+      try:
+        yield marshal.load(events_file)
+      except EOFError:
+        return
+
+def get_jobs(source, paths, chunk_size, events_directory):
+  jobs = []
+  for path in paths:
+    filenames = [ path ]
+    if not os.path.exists(path):
+      filenames = get_segment_filenames(path)
+
+    for filename in filenames:
+      with open(filename, 'rb') as log_file:
+        is_binary = log_file.read(len(MAGIC)) == MAGIC
+
+      if is_binary:
+        chunks = [ ('binary', 0, 0) ]
+      else:
+        size = os.path.getsize(filename)
+        chunks = [ ('text', start, min(start + chunk_size, size)) for start in xrange(0, size or 1, chunk_size) ]
+
+      for kind, start, end in chunks:
+        events_filename = os.path.join(events_directory, '%s.%06d.events' % (source, len(jobs)))
+        jobs.append( (source, kind, filename, start, end, events_filename) )
+  return jobs
+
+
+class TTLDict(object):
+  """ keys inserted in time order, expired ttl seconds after they were inserted """
+  def __init__(self, ttl):
+    self.ttl = ttl
+    self.items = OrderedDict()
+    self.expired = 0
+
+  def expire(self, now):
+    while self.items:
+      key, (inserted, value) = next(self.items.iteritems())
+      if now - inserted <= self.ttl:
+        return
+      del self.items[key]
+      self.expired += 1
+
+  def get(self, key):
+    item = self.items.get(key)
+    return item[1] if item else None
+
+  def set(self, key, value, now):
+    self.items.pop(key, None)
+    self.items[key] = (now, value)
+
+  def pop(self, key):
+    item = self.items.pop(key, None)
+    return item[1] if item else None
+
+  def __len__(self):
+    return len(self.items)
+
+
+class LatencyReport(object):
+  """ histograms of every (message type, stage), for the whole period and for every minute """
+  def __init__(self, ttl, on_minute):
+    self.ttl = ttl
+    self.on_minute = on_minute
+    self.histograms = {}
+    self.minutes = OrderedDict()
+
+  def record(self, timestamp, msg_type, stage, elapsed):
+    key = (msg_type, stage)
+    histogram = self.histograms.get(key)
+    if histogram is None:
+      histogram = self.histograms[key] = Histogram()
+    histogram.record(elapsed)
+
+    minute = int(timestamp // 60 * 60)
+    minute_histograms = self.minutes.get(minute)
+    if minute_histograms is None:
+      minute_histograms = self.minutes[minute] = {}
+    histogram = minute_histograms.get(key)
+    if histogram is None:
+      histogram = minute_histograms[key] = Histogram(buckets_per_decade=10)
+    histogram.record(elapsed)
+
+  def flush_minutes(self, now=None):
+    # a minute is complete once no request started in it can still be completed
+    while self.minutes:
+      minute = next(iter(self.minutes))
+      if now is not None and now < minute + 60 + self.ttl:
+        return
+      self.on_minute(minute, self.minutes.pop(minute))
+
+
+class Correlator(object):
+  def __init__(self, report, ttl, has_gateway_logs):
+    self.report = report
+    self.has_gateway_logs = has_gateway_logs
+    self.users_by_session = {}
+    self.requests = TTLDict(ttl)
+    self.market_data = TTLDict(ttl)
+    self.completed = 0
+
+  def process(self, event):
+    timestamp, rank, kind = event[:3]
+    self.requests.expire(timestamp)
+    self.market_data.expire(timestamp)
+
+    if kind == 'SESSION':
+      session_id, user_id = event[3:]
+      self.users_by_session[session_id] = user_id
+
+    elif kind == 'REQUEST':
+      stamp, session_id, msg_type, cl_ord_id = event[3:]
+      user_id = self.users_by_session.get(session_id)
+      if user_id is None:
+        return
+      key = (user_id, msg_type, cl_ord_id)
+      request = self.requests.get(key)
+      if request is None or stamp in request:
+        request = { 'sessions': set() }
+        self.requests.set(key, request, timestamp)
+      request[stamp] = timestamp
+      request['sessions'].add(session_id)
+
+    elif kind == 'EXECUTION':
+      stamp, destination, msg_type, cl_ord_id = event[3:]
+      if stamp == 'trade_out':
+        user_id = destination
+      else:
+        user_id = self.users_by_session.get(destination)
+      key = (user_id, msg_type, cl_ord_id)
+      request = self.requests.get(key)
+      if request is None or stamp in request:
+        return # not the first execution report of the request
+      if stamp == 'gateway_out' and destination not in request['sessions']:
+        return # the report sent to another connection of the user
+      request[stamp] = timestamp
+
+      if stamp == 'gateway_out' or not self.has_gateway_logs:
+        self.requests.pop(key)
+        self.complete(msg_type, request)
+
+    elif kind == 'MD':
+      stamp, md_key = event[3:]
+      if stamp == 'trade_out':
+        self.market_data.set(md_key, { 'trade_out': timestamp }, timestamp)
+        return
+
+      update = self.market_data.get(md_key)
+      if update is None:
+        return
+      if stamp == 'gateway_in':
+        if 'gateway_in' not in update:
+          update['gateway_in'] = timestamp
+          self.report.record(update['trade_out'], 'X', 'trade_to_gateway', (timestamp - update['trade_out']) * 1000)
+      else:
+        # every subscriber
+        self.report.record(update['trade_out'], 'X', 'publish_to_send', (timestamp - update['trade_out']) * 1000)
+
+    elif kind == 'TRACE':
+      msg_type, raw_trace = event[3:]
+      trace = json.loads(raw_trace)
+      stamps = [ stamp for stamp, value in trace.iteritems() if isinstance(value, (int, float)) ]
+      start = min( trace[stamp] for stamp in stamps ) if stamps else timestamp
+      for stage, elapsed in get_trace_stages(trace, stamps):
+        self.report.record(start, msg_type, 'trace:' + stage, elapsed)
+
+    self.report.flush_minutes(timestamp)
+
+  def complete(self, msg_type, request):
+    self.completed += 1
+    start = min( request[stamp] for stamp in ('gateway_in', 'trade_in', 'trade_out') if stamp in request )
+    for stage, from_stamp, to_stamp in ORDER_ENTRY_STAGES:
+      if from_stamp in request and to_stamp in request:
+        self.report.record(start, msg_type, stage, (request[to_stamp] - request[from_stamp]) * 1000)
+
+
+def format_minute(minute):
+  if minute is None:
+    return 'ALL'
+  return time.strftime('%Y-%m-%d %H:%M', time.localtime(minute))
+
+def get_row(minute, msg_type, stage, histogram):
+  summary = histogram.to_dict()
+  row = OrderedDict()
+  row['Minute'] = format_minute(minute)
+  row['MsgType'] = msg_type
+  row['Stage'] = stage
+  for name in ('Count', 'Min', 'Mean') + tuple( name for name, p in PERCENTILES ) + ('Max',):
+    row[name] = summary[name]
+  return row
+
+class CsvWriter(object):
+  def __init__(self, output_file):
+    import csv
+    self.writer = csv.writer(output_file)
+    self.has_header = False
+
+  def write_minute(self, minute, histograms):
+    for (msg_type, stage), histogram in sorted(histograms.iteritems()):
+      self.write_row( get_row(minute, msg_type, stage, histogram) )
+
+  def write_row(self, row):
+    if not self.has_header:
+      self.writer.writerow( row.keys() )
+      self.has_header = True
+    self.writer.writerow( [ '%.3f' % value if isinstance(value, float) else value for value in row.values() ] )
+
+  def close(self, report, stats):
+    self.write_minute(None, report.histograms)
+
+class JsonWriter(object):
+  def __init__(self, output_file):
+    self.output_file = output_file
+    self.minutes = []
+
+  def write_minute(self, minute, histograms):
+    for (msg_type, stage), histogram in sorted(histograms.iteritems()):
+      self.minutes.append( get_row(minute, msg_type, stage, histogram) )
+
+  def close(self, report, stats):
+    summary = {}
+    for (msg_type, stage), histogram in sorted(report.histograms.iteritems()):
+      result = histogram.to_dict()
+      result['Distribution'] = histogram.get_percentile_distribution()
+      summary.setdefault(msg_type, {})[stage] = result
+    json.dump( { 'Summary': summary, 'Minutes': self.minutes, 'Stats': stats }, self.output_file, indent=2 )
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Latency percentiles from the gateway and trade replay logs')
+  parser.add_argument('--trade', nargs='*', default=[], help='trade replay logs')
+  parser.add_argument('--gateway', nargs='*', default=[], help='gateway replay logs')
+  parser.add_argument('--output', help='output file, stdout by default')
+  parser.add_argument('--format', choices=('csv', 'json'), default='csv')
+  parser.add_argument('--ttl', type=float, default=60, help='seconds a request waits for its response')
+  parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+  parser.add_argument('--chunk-size', type=float, default=128, help='MB of a text log parsed by a single worker')
+  arguments = parser.parse_args()
+
+  if not arguments.trade and not arguments.gateway:
+    parser.error('no log files')
+
+  events_directory = tempfile.mkdtemp(prefix='log_analytics_')
+  output_file = open(arguments.output, 'wb') if arguments.output else sys.stdout
+  try:
+    chunk_size = max(1, int(arguments.chunk_size * 1024 * 1024))
+    jobs = get_jobs('trade', arguments.trade, chunk_size, events_directory) + \
+           get_jobs('gateway', arguments.gateway, chunk_size, events_directory)
+
+    pool = multiprocessing.Pool(arguments.workers)
+    try:
+      events_filenames = pool.map(parse_job, jobs, chunksize=1)
+    finally:
+      pool.terminate()
+
+    writer = JsonWriter(output_file) if arguments.format == 'json' else CsvWriter(output_file)
+    report = LatencyReport(arguments.ttl, writer.write_minute)
+    correlator = Correlator(report, arguments.ttl, bool(arguments.gateway))
+
+    events = 0
+    for event in heapq.merge( *[ read_events(events_filename) for events_filename in events_filenames ] ):
+      correlator.process(event)
+      events += 1
+    report.flush_minutes()
+
+    stats = {
+      'Files': len(jobs),
+      'Events': events,
+      'Completed': correlator.completed,
+      'Expired': correlator.requests.expired,
+      'Pending': len(correlator.requests)
+    }
+    writer.close(report, stats)
+    sys.stderr.write( ' '.join( '%s=%s' % item for item in sorted(stats.iteritems()) ) + '\n' )
+  finally:
+    if arguments.output:
+      output_file.close()
+    shutil.rmtree(events_directory)
+
+if __name__ == '__main__':
+  main()
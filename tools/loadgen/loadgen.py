@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+"""
+Simulates thousands of traders against a running gateway, all of them on the IOLoop of a single process.
+
+  loadgen.py bootstrap --db-engine sqlite:////opt/bitex/db/bitex.sqlite --users 2000
+  loadgen.py run --url ws://127.0.0.1:8445/ --traders 2000 --rate 0.5 --duration 300 --output load.json
+
+bootstrap creates and funds the users benchmark0 .. benchmarkN-1 (password benchmark) of tools/benchmark, it
+must run before the trade engine is started on that database. Every trader logs in with BE, optionally
+subscribes to market data, and sends orders with Poisson arrivals, cancelling one of its open orders instead
+with the cancel ratio. The latency is measured as the client sees it, from the request until its first answer:
+the execution report of the order (D) or of the cancel (F), the BF of the login and the W of a subscription.
+Requests without an answer after --timeout seconds are counted as timeouts.
+
+Each trader holds a socket, raise the open files limit (ulimit -n) before running thousands of them.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+
+ROOT_PATH = os.path.abspath( os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'libs'))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'tools/benchmark'))
+
+import tornado.ioloop
+from tornado.websocket import websocket_connect
+
+from bitex.histogram import StageHistograms
+
+SYMBOL = 'BTCUSD'
+BROKER_ID = 5
+
+class LoadStats(object):
+  def __init__(self):
+    self.start_time = time.time()
+    self.counters = {}
+    self.latencies = StageHistograms()  # by MsgType of the request
+
+  def increment(self, name, value=1):
+    self.counters[name] = self.counters.get(name, 0) + value
+
+  def record(self, msg_type, elapsed):
+    self.latencies.record(msg_type, elapsed * 1000)
+
+  def get_report(self):
+    elapsed = time.time() - self.start_time
+    return {
+      'Seconds'   : elapsed,
+      'Counters'  : self.counters,
+      'Rates'     : dict( (name, value / elapsed) for name, value in self.counters.iteritems() ) if elapsed else {},
+      'Latency'   : self.latencies.to_dict()
+    }
+
+
+class OrderFlow(object):
+  """ prices, quantities and arrival times of the orders of a trader """
+  def __init__(self, arguments, seed):
+    self.random = random.Random(seed)
+    self.rate = arguments.rate
+    self.price = arguments.price
+    self.offset_distribution = arguments.offset_distribution
+    self.offset_mean = arguments.offset_mean
+    self.offset_scale = arguments.offset_scale
+    self.qty_min = arguments.qty_min
+    self.qty_max = arguments.qty_max
+    self.cancel_ratio = arguments.cancel_ratio
+
+  def get_next_delay(self):
+    return self.random.expovariate(self.rate)
+
+  def get_offset(self):
+    # distance from the mid price, away from the other side. Negative offsets cross the spread
+    if self.offset_distribution == 'normal':
+      return self.random.gauss(self.offset_mean, self.offset_scale)
+    elif self.offset_distribution == 'exponential':
+      return self.offset_mean - self.offset_scale + self.random.expovariate(1. / self.offset_scale)
+    return self.random.uniform(self.offset_mean - self.offset_scale, self.offset_mean + self.offset_scale)
+
+  def should_cancel(self, open_orders):
+    return open_orders and self.random.random() < self.cancel_ratio
+
+  def choose_order_to_cancel(self, open_orders):
+    return self.random.choice(open_orders)
+
+  def get_new_order(self, cl_ord_id):
+    side = self.random.choice(('1', '2'))
+    offset = self.get_offset()
+    price = self.price - offset if side == '1' else self.price + offset
+    qty = self.random.uniform(self.qty_min, self.qty_max)
+    return {
+      'MsgType' : 'D',
+      'ClOrdID' : cl_ord_id,
+      'Symbol'  : SYMBOL,
+      'Side'    : side,
+      'OrdType' : '2',
+      'Price'   : int(round(max(price, 0.01), 2) * 1e8),
+      'OrderQty': max(int(qty * 100), 1) * 1000000,
+      'BrokerID': BROKER_ID
+    }
+
+
+class Trader(object):
+  def __init__(self, index, arguments, stats, io_loop):
+    self.index = index
+    self.username = arguments.username_format % index
+    self.password = arguments.password
+    self.url = arguments.url
+    self.subscribe_market_data = random.Random(arguments.seed - index).random() < arguments.market_data_ratio
+    self.market_depth = arguments.market_depth
+    self.connect_timeout = arguments.timeout
+    self.flow = OrderFlow(arguments, arguments.seed + index)
+    self.stats = stats
+    self.io_loop = io_loop
+
+    self.connection = None
+    self.logged = False
+    self.stopped = False
+    self.next_order_id = 0
+    self.open_orders = []
+    self.pending = {}  # (MsgType, ID) => sent time
+
+  def connect(self):
+    websocket_connect(self.url, self.io_loop, callback=self.on_connect, connect_timeout=self.connect_timeout)
+
+  def on_connect(self, future):
+    try:
+      self.connection = future.result()
+    except Exception:
+      self.stats.increment('connect_errors')
+      return
+    self.stats.increment('connections')
+    self.read_message()
+    self.send_request(('BE', self.index), {
+      'MsgType'   : 'BE',
+      'UserReqID' : self.index,
+      'UserReqTyp': '1',
+      'Username'  : self.username,
+      'Password'  : self.password })
+
+  def read_message(self):
+    self.connection.read_message(self.on_read_message)
+
+  def on_read_message(self, future):
+    raw_message = future.result()
+    if raw_message is None:
+      if not self.stopped:
+        self.stats.increment('disconnects')
+      self.connection = None
+      self.logged = False
+      return
+
+    self.stats.increment('received')
+    try:
+      self.on_message(json.loads(raw_message))
+    except ValueError:
+      self.stats.increment('invalid_messages')
+    if self.connection:
+      self.read_message()
+
+  def send_request(self, key, msg):
+    self.pending[key] = time.time()
+    self.send(msg)
+
+  def send(self, msg):
+    self.stats.increment('sent.' + msg['MsgType'])
+    self.connection.write_message(json.dumps(msg))
+
+  def on_answer(self, key):
+    sent_time = self.pending.pop(key, None)
+    if sent_time is not None:
+      self.stats.record(key[0], time.time() - sent_time)
+
+  def on_message(self, msg):
+    msg_type = msg.get('MsgType')
+    if msg_type == 'BF':
+      self.on_answer(('BE', msg.get('UserReqID')))
+      if msg.get('UserStatus') != 1:
+        self.stats.increment('login_errors')
+        self.close()
+        return
+      self.logged = True
+      self.stats.increment('logins')
+      if self.subscribe_market_data:
+        self.send_request(('V', self.index), {
+          'MsgType'                 : 'V',
+          'MDReqID'                 : self.index,
+          'SubscriptionRequestType' : '1',
+          'MarketDepth'             : self.market_depth,
+          'MDUpdateType'            : '1',
+          'MDEntryTypes'            : ['0', '1', '2'],
+          'Instruments'             : [SYMBOL] })
+      self.schedule_next_order()
+
+    elif msg_type == '8':
+      cl_ord_id = msg.get('ClOrdID')
+      exec_type = msg.get('ExecType')
+      self.on_answer(('D', cl_ord_id))
+      if exec_type == '0':
+        self.open_orders.append(cl_ord_id)
+      elif exec_type == '4':
+        self.on_answer(('F', cl_ord_id))
+      if msg.get('OrdStatus') in ('2', '4', '8') and cl_ord_id in self.open_orders:
+        self.open_orders.remove(cl_ord_id)
+      self.stats.increment('execution_reports.' + str(exec_type))
+
+    elif msg_type == 'W':
+      self.on_answer(('V', msg.get('MDReqID')))
+      self.stats.increment('market_data_full_refresh')
+
+    elif msg_type == 'X':
+      self.stats.increment('market_data_incremental')
+
+    elif msg_type == 'ERROR':
+      self.stats.increment('errors')
+
+  def schedule_next_order(self):
+    self.io_loop.add_timeout(time.time() + self.flow.get_next_delay(), self.on_order_timer)
+
+  def on_order_timer(self):
+    if self.stopped or not self.logged:
+      return
+    if self.flow.should_cancel(self.open_orders):
+      cl_ord_id = self.flow.choose_order_to_cancel(self.open_orders)
+      self.open_orders.remove(cl_ord_id)
+      self.send_request(('F', cl_ord_id), { 'MsgType': 'F', 'OrigClOrdID': cl_ord_id })
+    else:
+      self.next_order_id += 1
+      cl_ord_id = 'lg%d.%d.%d' % (self.index, int(self.stats.start_time), self.next_order_id)
+      self.send_request(('D', cl_ord_id), self.flow.get_new_order(cl_ord_id))
+    self.schedule_next_order()
+
+  def expire_pending(self, timeout):
+    now = time.time()
+    for key, sent_time in self.pending.items():
+      if now - sent_time > timeout:
+        del self.pending[key]
+        self.stats.increment('timeouts.' + key[0])
+
+  def stop(self, cancel_orders):
+    self.stopped = True
+    if self.connection and self.logged and cancel_orders:
+      self.send({ 'MsgType': 'F' })  # cancels every open order of the user
+
+  def close(self):
+    self.stopped = True
+    if self.connection:
+      self.connection.protocol.close()  # the client connection of this tornado has no close()
+      self.connection = None
+
+
+class LoadGenerator(object):
+  def __init__(self, arguments):
+    self.arguments = arguments
+    self.io_loop = tornado.ioloop.IOLoop.instance()
+    self.stats = LoadStats()
+    self.traders = [ Trader(arguments.first_user + index, arguments, self.stats, self.io_loop)
+                     for index in xrange(arguments.traders) ]
+    self.last_report = (time.time(), {})
+
+  def start(self):
+    ramp_up_interval = float(self.arguments.ramp_up) / len(self.traders) if self.traders else 0
+    for position, trader in enumerate(self.traders):
+      self.io_loop.add_timeout(time.time() + position * ramp_up_interval, trader.connect)
+
+    self.reporter = tornado.ioloop.PeriodicCallback(self.on_report, self.arguments.report_interval * 1000,
+                                                    io_loop=self.io_loop)
+    self.reporter.start()
+    self.io_loop.add_timeout(time.time() + self.arguments.ramp_up + self.arguments.duration, self.stop)
+    self.io_loop.start()
+
+  def on_report(self):
+    for trader in self.traders:
+      trader.expire_pending(self.arguments.timeout)
+
+    if self.arguments.quiet:
+      return
+    now = time.time()
+    last_time, last_counters = self.last_report
+    counters = dict(self.stats.counters)
+    sent = sum( value - last_counters.get(name, 0) for name, value in counters.iteritems() if name.startswith('sent.') )
+    received = counters.get('received', 0) - last_counters.get('received', 0)
+    latency = self.stats.latencies.to_dict().get('D', {})
+    print '%6.0fs  logged %5d  sent %7.0f/s  received %8.0f/s  open orders %6d  D p50 %7.2f ms  p99 %7.2f ms' % (
+      now - self.stats.start_time, sum( 1 for trader in self.traders if trader.logged ),
+      sent / (now - last_time), received / (now - last_time),
+      sum( len(trader.open_orders) for trader in self.traders ),
+      latency.get('P50', 0), latency.get('P99', 0))
+    sys.stdout.flush()
+    self.last_report = (now, counters)
+
+  def stop(self):
+    self.reporter.stop()
+    report = self.stats.get_report()
+    for trader in self.traders:
+      trader.stop(not self.arguments.keep_orders)
+    # let the cancels go out before closing the connections
+    self.io_loop.add_timeout(time.time() + 2, lambda: self.finish(report))
+
+  def finish(self, report):
+    for trader in self.traders:
+      trader.close()
+    self.io_loop.stop()
+
+    report['Config'] = dict( (name, value) for name, value in vars(self.arguments).iteritems() if name != 'function' )
+    report['Config']['started'] = datetime.datetime.fromtimestamp(self.stats.start_time).isoformat()
+    print_report(report)
+    if self.arguments.output:
+      with open(self.arguments.output, 'w') as output_file:
+        json.dump(report, output_file, indent=2, sort_keys=True)
+
+
+def print_report(report):
+  counters = report['Counters']
+  print '%d traders, %d connected, %d logged in, %.0fs' % (report['Config']['traders'],
+    counters.get('connections', 0), counters.get('logins', 0), report['Seconds'])
+  print '  %-8s %8s %9s %9s %9s %9s %9s' % ('MsgType', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'p99.9 ms', 'max ms')
+  for msg_type, latency in sorted(report['Latency'].iteritems()):
+    print '  %-8s %8d %9.2f %9.2f %9.2f %9.2f %9.2f' % (msg_type, latency['Count'], latency['P50'],
+      latency['P90'], latency['P99'], latency['P999'], latency['Max'])
+  for name, value in sorted(counters.iteritems()):
+    print '  %-32s %10d %10.1f/s' % (name, value, report['Rates'].get(name, 0))
+
+def run(arguments):
+  LoadGenerator(arguments).start()
+
+def bootstrap(arguments):
+  from benchmark import setup_application, bootstrap_users
+  application, db_filename = setup_application(None, None, 'text', db_engine=arguments.db_engine)
+  bootstrap_users(application, arguments.users)
+  os.remove(application.options.trade_log)
+  print '%d users ready' % arguments.users
+
+def main():
+  parser = argparse.ArgumentParser(description='Multi trader load generator')
+  subparsers = parser.add_subparsers()
+
+  bootstrap_parser = subparsers.add_parser('bootstrap', help='creates and funds the users of the traders')
+  bootstrap_parser.add_argument('--db-engine', required=True, help='SQLAlchemy database engine string of the trade engine')
+  bootstrap_parser.add_argument('--users', type=int, default=1000)
+  bootstrap_parser.set_defaults(function=bootstrap)
+
+  run_parser = subparsers.add_parser('run', help='runs the traders against a gateway')
+  run_parser.add_argument('--url', default='ws://127.0.0.1:8445/', help='websocket url of the gateway')
+  run_parser.add_argument('--traders', type=int, default=100)
+  run_parser.add_argument('--first-user', type=int, default=0, help='index of the first user')
+  run_parser.add_argument('--username-format', default='benchmark%d')
+  run_parser.add_argument('--password', default='benchmark')
+  run_parser.add_argument('--duration', type=float, default=60, help='seconds sending orders, after the ramp up')
+  run_parser.add_argument('--ramp-up', type=float, default=10, help='seconds to connect all the traders')
+  run_parser.add_argument('--rate', type=float, default=0.2, help='mean orders and cancels per second of each trader')
+  run_parser.add_argument('--cancel-ratio', type=float, default=0.3)
+  run_parser.add_argument('--price', type=float, default=500, help='mid price in USD')
+  run_parser.add_argument('--offset-distribution', choices=('uniform', 'normal', 'exponential'), default='uniform',
+                          help='distribution of the distance of the price from the mid price')
+  run_parser.add_argument('--offset-mean', type=float, default=5, help='USD')
+  run_parser.add_argument('--offset-scale', type=float, default=10, help='USD, the half width, deviation or mean')
+  run_parser.add_argument('--qty-min', type=float, default=0.01, help='BTC')
+  run_parser.add_argument('--qty-max', type=float, default=1, help='BTC')
+  run_parser.add_argument('--market-data-ratio', type=float, default=0.5, help='fraction of the traders subscribed')
+  run_parser.add_argument('--market-depth', type=int, default=10)
+  run_parser.add_argument('--timeout', type=float, default=10, help='seconds without an answer to count a timeout')
+  run_parser.add_argument('--report-interval', type=float, default=5)
+  run_parser.add_argument('--keep-orders', action='store_true', help="doesn't cancel the open orders at the end")
+  run_parser.add_argument('--seed', type=int, default=1)
+  run_parser.add_argument('--output', help='JSON results file')
+  run_parser.add_argument('--quiet', action='store_true')
+  run_parser.set_defaults(function=run)
+
+  arguments = parser.parse_args()
+  arguments.function(arguments)
+
+if __name__ == '__main__':
+  main()
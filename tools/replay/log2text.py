@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""
+Converts a binary replay log to the text format written by the logging module.
+
+  log2text.py /opt/surbitcoin/logs/trade.log > trade.txt
+  log2text.py /opt/surbitcoin/logs/trade.log --from "2014-05-01 10:00:00" --to "2014-05-01 11:00:00"
+"""
+
+import os
+import sys
+import time
+import argparse
+
+ROOT_PATH = os.path.abspath( os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'libs'))
+
+from bitex.replay_log import read_segment, read_index, get_segment_filenames, format_text_line
+
+def parse_time(value):
+  return time.mktime(time.strptime(value, '%Y-%m-%d %H:%M:%S'))
+
+def main():
+  parser = argparse.ArgumentParser(description='Converts a binary replay log to text')
+  parser.add_argument('log', help='binary replay log, without the segment number')
+  parser.add_argument('--from', dest='from_time', help='first record time, YYYY-MM-DD HH:MM:SS')
+  parser.add_argument('--to', dest='to_time', help='last record time, YYYY-MM-DD HH:MM:SS')
+  arguments = parser.parse_args()
+
+  from_timestamp = parse_time(arguments.from_time) if arguments.from_time else None
+  to_timestamp = parse_time(arguments.to_time) if arguments.to_time else None
+
+  # the index tells which closed segments can be skipped, the active one is not indexed yet
+  skipped_segments = set()
+  for seq, first_timestamp, last_timestamp, records, segment_filename in read_index(arguments.log):
+    if (from_timestamp and last_timestamp < from_timestamp) or (to_timestamp and first_timestamp > to_timestamp):
+      skipped_segments.add(segment_filename)
+
+  for segment_filename in get_segment_filenames(arguments.log):
+    if segment_filename in skipped_segments:
+      continue
+    for timestamp, command, key, value in read_segment(segment_filename):
+      if from_timestamp and timestamp < from_timestamp:
+        continue
+      if to_timestamp and timestamp > to_timestamp:
+        continue
+      sys.stdout.write( (format_text_line(timestamp, command, key, value) + u'\n').encode('utf-8') )
+
+if __name__ == '__main__':
+  main()
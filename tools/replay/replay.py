@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Feeds the requests of a trade replay log into a fresh TradeApplication, running against an in memory
+database, and verifies that the replies and the publications are identical to the ones in the log.
+
+  replay.py /opt/surbitcoin/logs/trade.log --snapshot bitex.sqlite
+
+The snapshot must be a copy of the database taken when the log started. Passwords are not written in the
+log, so the replayed logins are accepted without checking them.
+"""
+
+import os
+import re
+import sys
+import argparse
+import sqlite3
+import tempfile
+
+ROOT_PATH = os.path.abspath( os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'libs'))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'apps'))
+sys.path.insert( 0, os.path.join(ROOT_PATH, 'apps/trade'))
+
+from bitex.replay_log import read_log_records
+
+# options of the recorded engine that change how the requests are processed
+REPLAYED_PARAMS = ( 'session_timeout_limit', 'test_mode', 'dev_mode', 'satoshi_mode' )
+
+NORMALIZE_REGEXES = [
+  re.compile(r'\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(\.\d+)?'),
+  re.compile(r'datetime\.(datetime|date|time)\([^)]*\)'),
+]
+
+def normalize(message):
+  """ wall clock times can't be reproduced """
+  if not message:
+    return u''
+  if isinstance(message, str):
+    message = message.decode('utf-8')
+  for regex in NORMALIZE_REGEXES:
+    message = regex.sub('<datetime>', message)
+  return message
+
+def setup_application(snapshot, params):
+  from tornado.options import options
+  import main as trade_main  # defines the trade options
+
+  options.db_engine = 'sqlite://'
+  options.db_echo = False
+  options.trade_in = 'inproc://replay_trade_in'
+  options.trade_pub = 'inproc://replay_trade_pub'
+  options.trade_log = tempfile.mktemp(prefix='replay_', suffix='.log')
+  options.trade_log_format = 'text'
+  options.session_timeout_limit = 0
+  options.global_email_language = options.global_email_language or 'en'
+  for name, value in params.iteritems():
+    options._options[name].parse(value)
+
+  from models import engine, Base, User
+  if snapshot:
+    Base.metadata.drop_all(engine) # created when models is imported
+    engine.raw_connection().connection.executescript( '\n'.join(sqlite3.connect(snapshot).iterdump()) )
+    Base.metadata.create_all(engine) # tables newer than the snapshot
+
+  check_password = User.check_password
+  User.check_password = lambda self, raw_password: raw_password == '*' or check_password(self, raw_password)
+
+  from trade_application import application
+  application.initialize()
+  return application
+
+def collect_publications(application):
+  publications = [ str([key, message]) for key, message in application.publish_queue ]
+  application.publish_queue = []
+  application.balance_updates = {}
+  return publications
+
+def compare(kind, expected, produced, max_mismatches):
+  mismatches = 0
+  for index in xrange(max(len(expected), len(produced))):
+    expected_message = normalize(expected[index]) if index < len(expected) else None
+    produced_message = normalize(produced[index]) if index < len(produced) else None
+    if expected_message != produced_message:
+      mismatches += 1
+      if mismatches <= max_mismatches:
+        print '%s #%d differs' % (kind, index)
+        print '  log   :', expected_message
+        print '  replay:', produced_message
+  print '%s: %d in the log, %d replayed, %d mismatches' % (kind, len(expected), len(produced), mismatches)
+  return mismatches
+
+def main():
+  parser = argparse.ArgumentParser(description='Replays a trade log and verifies the outputs')
+  parser.add_argument('log', help='text or binary trade replay log')
+  parser.add_argument('--snapshot', help='sqlite database with the state when the log started')
+  parser.add_argument('--max-mismatches', type=int, default=10, help='mismatches printed per kind')
+  arguments = parser.parse_args()
+
+  records = read_log_records(arguments.log)
+
+  # the parameters are logged before the first request
+  params = {}
+  pending_records = []
+  for record in records:
+    timestamp, command, key, value = record
+    if command == 'PARAM' and key in REPLAYED_PARAMS and value: # false values are not logged
+      params[key] = value
+    pending_records.append(record)
+    if command == 'PARAM' and key == 'END':
+      break
+
+  application = setup_application(arguments.snapshot, params)
+  application.load_order_book()
+
+  expected_replies = []
+  expected_publications = []
+  replies = []
+  publications = collect_publications(application)
+
+  def all_records():
+    for record in pending_records:
+      yield record
+    for record in records:
+      yield record
+
+  has_started = False
+  for timestamp, command, key, value in all_records():
+    if command == 'START':
+      if has_started:
+        print 'The engine was restarted, stopping the replay'
+        break
+      has_started = True
+
+    elif command == 'IN' and key in ('TRADE_IN_REQ', 'TRADE_IN_REQ_ERROR'):
+      replies.append( application.process_message(value.encode('utf-8')) )
+      application.process_trade_emails()
+      publications.extend( collect_publications(application) )
+
+    elif command == 'OUT' and key == 'TRADE_IN_REP':
+      expected_replies.append(value)
+
+    elif command == 'OUT' and key == 'TRADE_PUB':
+      expected_publications.append(value)
+
+  mismatches =  compare('replies', expected_replies, replies, arguments.max_mismatches)
+  mismatches += compare('publications', expected_publications, publications, arguments.max_mismatches)
+
+  os.remove(application.options.trade_log)
+  sys.exit(1 if mismatches else 0)
+
+if __name__ == '__main__':
+  main()